@@ -0,0 +1,481 @@
+"""
+Service discovery between axonal nodes.
+
+Every `ClusterNode` sends a UDP heartbeat to its peers each `interval`
+seconds, advertising the (service, expanded version) entries of its
+registry, the methods its services declare idempotent, the endpoint
+serving them, its load and health. Heartbeats
+also carry the addresses of the members the sender knows about, so a
+node started with one seed learns the rest of the cluster.
+
+From the heartbeats each node keeps a routing table of (service,
+version) to the endpoints of live members. `ClusterBroker` dispatches
+through it and can be given to a `Router` next to the local broker:
+
+    node = ClusterNode('http://10.0.0.1:8080', bind=('10.0.0.1', 7946),
+                       seeds=[('10.0.0.2', 7946)], secret=secret)
+    broker = Router([RegistryBroker(GlobalRegistry()), ClusterBroker(node)])
+
+Members silent for `suspect_after` seconds are dropped from the routing
+table and forgotten after `remove_after`. A node shutting down says so
+in a final heartbeat so peers stop routing to it straight away.
+
+Heartbeats are signed with an HMAC of a secret shared by the cluster,
+datagrams without a valid signature are dropped before they are even
+decoded. Only `max_learned` peer addresses are learned from them.
+
+Every member sends to every other, which suits clusters of tens of
+nodes, and each heartbeat must fit in one datagram.
+"""
+import functools
+import hashlib
+import hmac
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import weakref
+
+from .interface import Dispatcher
+from .middleware.balance import Backend, PowerOfTwoPolicy
+from .registry import _expand_versions, idempotent_methods
+from .struct import Fault, TransportFault
+from .utils import json_dumpb, json_loads
+
+__all__ = ('ClusterNode', 'ClusterBroker', 'Member')
+
+LOGGER = logging.getLogger(__name__)
+
+HEALTH_OK = 'ok'
+HEALTH_LEAVING = 'leaving'
+
+MAX_DATAGRAM = 65507
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+
+def _advertised(registry):
+    """
+    (service, version) entries of the registry, versions expanded
+    """
+    return sorted([name, ver] for name, versions in
+                  list(registry.services.items()) for ver in list(versions))
+
+
+def _advertised_idempotent(registry):
+    """
+    (service, method) pairs declared idempotent by the registry's classes
+    """
+    return sorted(set((cls._service_name, method)
+                      for cls in list(registry.classes)
+                      for method in idempotent_methods(cls)))
+
+
+def _sign(secret, data):
+    return hmac.new(secret, data, hashlib.sha256).digest() + data
+
+
+def _verify(secret, data):
+    """
+    The signed heartbeat without its signature, raising ValueError if
+    the signature doesn't match.
+    """
+    signature, data = data[:SIGNATURE_SIZE], data[SIGNATURE_SIZE:]
+    expected = hmac.new(secret, data, hashlib.sha256).digest()
+    if not hmac.compare_digest(signature, expected):
+        raise ValueError('Bad heartbeat signature')
+    return data
+
+
+def _parse_heartbeat(data):
+    """
+    Decode and validate a heartbeat, raising ValueError if any part of
+    it is malformed.
+    """
+    try:
+        msg = json_loads(data)
+        if not isinstance(msg, dict) or msg.get('v') != 1:
+            raise ValueError('Unknown heartbeat version')
+        node_id = msg['id']
+        endpoint = msg.get('ep')
+        health = msg.get('health', HEALTH_OK)
+        if not all(isinstance(value, str)
+                   for value in (node_id, endpoint, health)):
+            raise ValueError('Invalid heartbeat fields')
+        services = tuple(sorted(set(
+            (str(name), str(ver)) for name, ver in msg.get('svc', ()))))
+        idempotent = frozenset(
+            (str(name), str(method)) for name, method in msg.get('idem', ()))
+        peers = [(str(host), int(port))
+                 for host, port in msg.get('peers', ())]
+        return (node_id, int(msg['seq']), endpoint, health, services,
+                idempotent, float(msg.get('load', 0.0)), peers)
+    except (KeyError, TypeError, ValueError) as ex:
+        raise ValueError('Bad heartbeat: %s' % (ex,))
+
+
+def _load_average():
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0.0
+
+
+class Member(object):
+    __slots__ = ('node_id', 'address', 'endpoint', 'services',
+                 'idempotent', 'load', 'health', 'seq', 'last_seen')
+
+    def __init__(self, node_id, address):
+        self.node_id = node_id
+        self.address = address
+        self.endpoint = None
+        self.services = ()
+        self.idempotent = frozenset()
+        self.load = 0.0
+        self.health = HEALTH_OK
+        self.seq = -1
+        self.last_seen = 0.0
+
+    def __repr__(self):
+        return '<Member %s %s %s>' % (self.node_id, self.endpoint,
+                                      self.health)
+
+
+class ClusterNode(object):
+    """
+    :param endpoint: URL peers use to reach this node's RpcHttpApp
+    :param bind: UDP (host, port) heartbeats are received on
+    :param seeds: UDP addresses of members to contact at start
+    :param registry: registry to advertise, the global one by default
+    :param load: callable returning this node's load, defaults to the
+        one minute load average
+    :param secret: key every member signs its heartbeats with
+    :param max_learned: peer addresses learned from heartbeats, beyond
+        the seeds and members, that are kept
+    """
+    def __init__(self, endpoint, bind=('127.0.0.1', 0), seeds=(),
+                 registry=None, interval=1.0, suspect_after=None,
+                 remove_after=None, node_id=None, load=None, secret=None,
+                 max_learned=256):
+        if not secret:
+            raise ValueError('Cluster heartbeats need a shared secret')
+        if isinstance(secret, str):
+            secret = secret.encode('utf-8')
+        if registry is None:
+            from .registry import GlobalRegistry
+            registry = GlobalRegistry()
+        self.endpoint = endpoint
+        self.registry = registry
+        self.interval = interval
+        self.suspect_after = suspect_after or interval * 3
+        self.remove_after = remove_after or interval * 10
+        self.node_id = node_id or '%s-%d-%s' % (
+            socket.gethostname(), os.getpid(),
+            '%08x' % (random.getrandbits(32),))
+        self.load = load or _load_average
+        self.max_learned = max_learned
+        self.health = HEALTH_OK
+        self.members = dict()
+        self.routes = dict()
+        self.idempotent = frozenset()
+        self._seeds = set(tuple(seed) for seed in seeds)
+        self._secret = secret
+        self._learned = dict()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(bind)
+        self.address = self._sock.getsockname()
+        self._thread = None
+        self._listeners = []
+
+    def add_listener(self, method):
+        """
+        Call the bound method with no arguments whenever the routing
+        table changes, only a weak reference to it is kept.
+        """
+        self._listeners.append(weakref.WeakMethod(method))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='axonal-cluster')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _peers(self):
+        peers = set(self._seeds)
+        peers.update(self._learned)
+        for member in list(self.members.values()):
+            peers.add(member.address)
+        peers.discard(self.address)
+        return peers
+
+    def _heartbeat(self):
+        self._seq += 1
+        live = self._live_members(time.monotonic())
+        return _sign(self._secret, json_dumpb({
+            'v': 1,
+            'id': self.node_id,
+            'ep': self.endpoint,
+            'seq': self._seq,
+            'load': self.load(),
+            'health': self.health,
+            'svc': _advertised(self.registry),
+            'idem': _advertised_idempotent(self.registry),
+            'peers': [list(member.address) for member in live],
+        }))
+
+    def _send_heartbeats(self):
+        data = self._heartbeat()
+        if len(data) > MAX_DATAGRAM:
+            LOGGER.error('Heartbeat too large: %d bytes', len(data))
+            return
+        for peer in self._peers():
+            try:
+                self._sock.sendto(data, peer)
+            except OSError as ex:
+                LOGGER.debug('Heartbeat to %s failed: %s', peer, ex)
+
+    def _receive(self, data, address):
+        try:
+            (node_id, seq, endpoint, health, services, idempotent, load,
+             peers) = _parse_heartbeat(_verify(self._secret, data))
+        except ValueError as ex:
+            LOGGER.debug('%s from %s', ex, address)
+            return
+        if node_id == self.node_id:
+            return
+        now = time.monotonic()
+        with self._lock:
+            member = self.members.get(node_id)
+            if member is not None and seq <= member.seq:
+                return
+            if member is None:
+                member = Member(node_id, address)
+                LOGGER.info('Member joined: %s at %s', node_id, endpoint)
+                changed = True
+            else:
+                changed = (services != member.services or
+                           idempotent != member.idempotent or
+                           health != member.health or
+                           endpoint != member.endpoint or
+                           not self._is_live(member, now))
+            member.address = address
+            member.endpoint = endpoint
+            member.services = services
+            member.idempotent = idempotent
+            member.health = health
+            member.load = load
+            member.seq = seq
+            member.last_seen = now
+            self.members[node_id] = member
+            for peer in peers:
+                if peer == self.address:
+                    continue
+                if (peer in self._learned or
+                        len(self._learned) < self.max_learned):
+                    self._learned[peer] = now
+        if changed:
+            self._rebuild()
+
+    def _is_live(self, member, now):
+        return (member.health == HEALTH_OK and
+                now - member.last_seen < self.suspect_after)
+
+    def _live_members(self, now):
+        return [member for member in list(self.members.values())
+                if self._is_live(member, now)]
+
+    def _sweep(self):
+        """
+        Forget members and learned peers silent for `remove_after`
+        """
+        cutoff = time.monotonic() - self.remove_after
+        with self._lock:
+            for node_id, member in list(self.members.items()):
+                if member.last_seen < cutoff:
+                    LOGGER.info('Member removed: %s', node_id)
+                    del self.members[node_id]
+            for peer, learned in list(self._learned.items()):
+                if learned < cutoff:
+                    del self._learned[peer]
+
+    def _rebuild(self):
+        routes = dict()
+        idempotent = set()
+        for member in self._live_members(time.monotonic()):
+            for key in member.services:
+                routes.setdefault(key, []).append(member.endpoint)
+            idempotent.update(member.idempotent)
+        routes = {key: tuple(sorted(eps)) for key, eps in routes.items()}
+        self.idempotent = frozenset(idempotent)
+        if routes == self.routes:
+            return
+        # Swapped in one assignment, readers never see a partial table
+        self.routes = routes
+        for ref in list(self._listeners):
+            method = ref()
+            if method is None:
+                self._listeners.remove(ref)
+            else:
+                method()
+
+    def _run(self):
+        self._sock.settimeout(self.interval / 4.0)
+        next_beat = 0.0
+        while not self._stopped.is_set():
+            now = time.monotonic()
+            if now >= next_beat:
+                next_beat = now + self.interval
+                self._send_heartbeats()
+                self._sweep()
+                # Members may have gone quiet since the last heartbeat
+                self._rebuild()
+            try:
+                data, address = self._sock.recvfrom(MAX_DATAGRAM)
+            except socket.timeout:
+                continue
+            except OSError:
+                if self._stopped.is_set():
+                    return
+                raise
+            try:
+                self._receive(data, address)
+            except Exception:
+                # One bad datagram must not stop the node
+                LOGGER.exception('Heartbeat from %s failed', address)
+
+    def endpoints(self, service, version):
+        """
+        Endpoints of live members serving the service, for the most
+        specific of the compatible versions any member advertises.
+        """
+        routes = self.routes
+        for ver in _expand_versions([version]):
+            endpoints = routes.get((service, ver))
+            if endpoints:
+                return endpoints
+        return ()
+
+    def is_idempotent(self, service, method):
+        """
+        Whether a live member serving the service declares the method
+        idempotent
+        """
+        return (service, method) in self.idempotent
+
+    def stop(self):
+        """
+        Tell peers this node is leaving, then stop
+        """
+        self.health = HEALTH_LEAVING
+        try:
+            self._send_heartbeats()
+        finally:
+            self._stopped.set()
+            if self._thread is not None:
+                self._thread.join()
+            self._sock.close()
+
+
+def _http_transport(endpoint, idempotent=None):
+    from .middleware.httpclient import HttpTransport
+    return HttpTransport(endpoint, idempotent=idempotent)
+
+
+class ClusterBroker(Dispatcher):
+    """
+    Dispatches to the members of the cluster serving each request.
+
+    :param transport_factory: callable(endpoint) returning a Transport,
+        by default an HttpTransport posting to the member's /rpc, which
+        only resends calls the cluster declares idempotent
+    :param protocol: internal protocol used over the transports
+    :param policy: chooses between members, see `middleware.balance`
+
+    A member whose transport fails `max_failures` times in a row is
+    skipped for `retry_after` seconds, unless it is the last serving a
+    key. Faults raised by a member's services never count.
+    """
+    def __init__(self, node, transport_factory=None, protocol=None,
+                 policy=None, max_failures=3, retry_after=None):
+        if protocol is None:
+            from .proto.internal import JsonInternalProtocol
+            protocol = JsonInternalProtocol()
+        self.node = node
+        self.transport_factory = transport_factory or functools.partial(
+            _http_transport, idempotent=node.is_idempotent)
+        self.protocol = protocol
+        self.policy = policy or PowerOfTwoPolicy()
+        self.max_failures = max_failures
+        self.retry_after = retry_after or node.suspect_after
+        self._backends = dict()
+        self._lock = threading.Lock()
+
+    def add_listener(self, method):
+        self.node.add_listener(method)
+
+    def is_idempotent(self, request):
+        target = request.context.target
+        return self.node.is_idempotent(target.service, target.method)
+
+    def _backend(self, endpoint):
+        backend = self._backends.get(endpoint)
+        if backend is None:
+            from .middleware.dispatcher import ProtocolTransportDispatcher
+            with self._lock:
+                backend = self._backends.get(endpoint)
+                if backend is None:
+                    backend = self._backends[endpoint] = Backend(
+                        ProtocolTransportDispatcher(
+                            self.protocol, self.transport_factory(endpoint)))
+        return backend
+
+    def _candidates(self, request):
+        target = request.context.target
+        now = time.monotonic()
+        candidates = []
+        for endpoint in self.node.endpoints(target.service, target.version):
+            backend = self._backend(endpoint)
+            if backend.evicted_until is not None:
+                if backend.evicted_until > now:
+                    continue
+                backend.evicted_until = None
+                backend.failures = 0
+            candidates.append(backend)
+        return candidates
+
+    def can_dispatch(self, request):
+        return len(self._candidates(request)) > 0
+
+    def _failed(self, backend, candidates):
+        backend.failures += 1
+        if backend.failures >= self.max_failures and len(candidates) > 1:
+            backend.evicted_until = time.monotonic() + self.retry_after
+            LOGGER.warning('Member failing: %r', backend.dispatcher.transport)
+
+    def dispatch(self, request):
+        candidates = self._candidates(request)
+        if not candidates:
+            raise Fault(request.context, Fault.SERVICE_UNKNOWN)
+        backend = self.policy.choose(candidates)
+        backend.outstanding += 1
+        try:
+            result = backend.dispatcher.dispatch(request)
+        except TransportFault:
+            self._failed(backend, candidates)
+            raise
+        except Fault:
+            # Raised by the member's service, the member its self is fine
+            backend.failures = 0
+            raise
+        except Exception:
+            self._failed(backend, candidates)
+            raise
+        finally:
+            backend.outstanding -= 1
+        backend.failures = 0
+        return result
@@ -0,0 +1,195 @@
+"""
+Non-blocking logging through a bounded queue.
+
+`install` moves the handlers configured on each logger behind a
+`DroppingQueueHandler`, records are put on a bounded queue and written
+by one background `RoutingQueueListener` thread, so slow handlers never
+block the event loop or dispatch threads. When the queue is full new
+records are dropped, or with the 'old' policy the oldest queued record
+makes way, and the number dropped is reported once there is room again.
+
+Records are tagged with the guid of the request being dispatched, use
+%(guid)s in formats once `install_record_factory` has run, and a
+`RateLimitFilter` on each queue handler suppresses bursts of records
+from the same call site.
+"""
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from .utils import current_guid
+
+__all__ = ('GuidFilter', 'RateLimitFilter', 'DroppingQueueHandler',
+           'RoutingQueueListener', 'install_record_factory', 'install')
+
+DROP_POLICIES = ('new', 'old')
+
+
+class GuidFilter(logging.Filter):
+    """
+    Adds `guid` to records, '-' outside of a request
+    """
+    def filter(self, record):
+        record.guid = current_guid.get() or '-'
+        return True
+
+
+def install_record_factory():
+    """
+    Give every new record a `guid`, so %(guid)s formats on any handler
+    whether or not the log queue is used.
+    """
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, 'adds_guid', False):
+        return
+
+    def make_record(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.guid = current_guid.get() or '-'
+        return record
+    make_record.adds_guid = True
+    logging.setLogRecordFactory(make_record)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Allows `burst` records per call site every `interval` seconds, the
+    first record after a suppressed burst says how many were dropped.
+    """
+    def __init__(self, burst=20, interval=1.0, max_sites=4096):
+        super(RateLimitFilter, self).__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_sites = max_sites
+        self._sites = dict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno, record.levelno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.interval:
+                suppressed = site[2] if site is not None else 0
+                if len(self._sites) >= self.max_sites:
+                    self._sites.clear()
+                self._sites[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = '%s (%d similar suppressed)' % (
+                        record.getMessage(), suppressed)
+                    record.args = None
+                return True
+            if site[1] < self.burst:
+                site[1] += 1
+                return True
+            site[2] += 1
+            return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler which never blocks, records for a full queue are
+    dropped according to `policy`.
+    """
+    def __init__(self, log_queue, route, policy='new'):
+        if policy not in DROP_POLICIES:
+            raise ValueError('Unknown drop policy: %s' % (policy,))
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.route = route
+        self.policy = policy
+        self.dropped = 0
+        self._reported = 0
+
+    def prepare(self, record):
+        record = super(DroppingQueueHandler, self).prepare(record)
+        record.log_route = self.route
+        return record
+
+    def enqueue(self, record):
+        pending = self.dropped - self._reported
+        if pending:
+            record.msg = '%s (%d records dropped)' % (record.msg, pending)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            if self.policy == 'new':
+                return
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(record)
+            except (queue.Empty, queue.Full):
+                return
+        self._reported += pending
+
+
+class RoutingQueueListener(QueueListener):
+    """
+    Passes each record to the handlers of the logger it was queued for,
+    stopping puts the handlers back on their loggers.
+    """
+    def __init__(self, log_queue, routes):
+        super(RoutingQueueListener, self).__init__(
+            log_queue, respect_handler_level=True)
+        self.routes = routes
+        self.installed = []
+
+    def stop(self):
+        super(RoutingQueueListener, self).stop()
+        for logger, handler in self.installed:
+            logger.removeHandler(handler)
+            for old in self.routes[logger.name]:
+                logger.addHandler(old)
+        self.installed = []
+
+    def enqueue_sentinel(self):
+        # Wait for room, the sentinel must not be dropped
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        record = self.prepare(record)
+        route = getattr(record, 'log_route', None)
+        for handler in self.routes.get(route, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def _configured_loggers():
+    yield logging.getLogger()
+    for logger in list(logging.Logger.manager.loggerDict.values()):
+        if isinstance(logger, logging.Logger):
+            yield logger
+
+
+def install(size=10000, policy='new', burst=20, interval=1.0):
+    """
+    Move every logger's handlers behind a shared bounded queue and
+    start the listener thread, returns the listener to `stop()` later.
+    Each queue handler has its own rate limit, so a record propagated to
+    several loggers is counted once by each.
+
+    :param size: records queued before dropping
+    :param policy: 'new' drops incoming records, 'old' the oldest queued
+    :param burst: records per call site per interval, 0 for no limit
+    """
+    log_queue = queue.Queue(size)
+    routes = dict()
+    listener = RoutingQueueListener(log_queue, routes)
+    guid_filter = GuidFilter()
+    install_record_factory()
+    for logger in _configured_loggers():
+        if not logger.handlers:
+            continue
+        routes[logger.name] = list(logger.handlers)
+        handler = DroppingQueueHandler(log_queue, logger.name, policy)
+        handler.addFilter(guid_filter)
+        if burst:
+            handler.addFilter(RateLimitFilter(burst, interval))
+        for old in routes[logger.name]:
+            logger.removeHandler(old)
+        logger.addHandler(handler)
+        listener.installed.append((logger, handler))
+    listener.start()
+    return listener
@@ -0,0 +1,68 @@
+"""
+Load balancing policies used by the Router to choose between several
+dispatchers which can all serve the same service and version.
+"""
+import itertools
+import random
+
+__all__ = ('Backend', 'RoundRobinPolicy', 'LeastOutstandingPolicy',
+           'PowerOfTwoPolicy')
+
+
+class Backend(object):
+    """
+    Book-keeping for one dispatcher, shared by every index entry
+    the dispatcher appears in.
+    """
+    __slots__ = ('dispatcher', 'outstanding', 'failures', 'evicted_until')
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.outstanding = 0
+        self.failures = 0
+        self.evicted_until = None
+
+
+class Policy(object):
+    def choose(self, candidates):
+        """
+        :type candidates: list of Backend, never empty
+        :rtype: Backend
+        """
+        raise NotImplementedError()
+
+
+class RoundRobinPolicy(Policy):
+    __slots__ = ('_counter',)
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def choose(self, candidates):
+        return candidates[next(self._counter) % len(candidates)]
+
+
+class LeastOutstandingPolicy(Policy):
+    __slots__ = ()
+
+    def choose(self, candidates):
+        return min(candidates, key=lambda backend: backend.outstanding)
+
+
+class PowerOfTwoPolicy(Policy):
+    """
+    Picks two candidates at random and uses the least loaded,
+    avoids herding onto a single backend without scanning them all.
+    """
+    __slots__ = ('_random',)
+
+    def __init__(self, rng=None):
+        self._random = rng or random.Random()
+
+    def choose(self, candidates):
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = self._random.sample(candidates, 2)
+        if second.outstanding < first.outstanding:
+            return second
+        return first
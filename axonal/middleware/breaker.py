@@ -0,0 +1,216 @@
+"""
+Circuit breakers in the dispatch chain.
+
+`CircuitBreakerDispatcher` wraps a dispatcher, usually a
+`ProtocolTransportDispatcher` for one endpoint, and keeps a breaker per
+(service, version) it calls. Each breaker counts failures and slow calls
+over a rolling window of time buckets:
+
+    closed     calls pass through, the breaker opens when the error or
+               slow call rate over the window reaches its threshold
+    open       calls fail immediately with Fault.CIRCUIT_OPEN
+    half-open  after `open_seconds` a few probe calls are let through,
+               closing the breaker when they succeed or re-opening it
+"""
+import logging
+import threading
+import time
+
+from ..interface import Dispatcher
+from ..struct import Fault
+
+__all__ = ('CircuitBreaker', 'CircuitBreakerDispatcher',
+           'CLOSED', 'OPEN', 'HALF_OPEN')
+
+LOGGER = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _Bucket(object):
+    __slots__ = ('started', 'calls', 'failures', 'slow')
+
+    def __init__(self, started):
+        self.started = started
+        self.calls = 0
+        self.failures = 0
+        self.slow = 0
+
+
+class CircuitBreaker(object):
+    """
+    :param window: seconds of history used for the error rate
+    :param buckets: number of buckets the window is divided into
+    :param min_calls: calls in the window before the breaker may open
+    :param failure_rate: fraction of failed calls which opens it
+    :param slow_call_seconds: calls slower than this count as slow
+    :param slow_call_rate: fraction of slow calls which opens it
+    :param open_seconds: time spent open before probing
+    :param probes: successful probes needed to close again
+    :param listener: called with (name, old state, new state) after the
+        lock is released
+    """
+    def __init__(self, name, window=10.0, buckets=10, min_calls=20,
+                 failure_rate=0.5, slow_call_seconds=None, slow_call_rate=0.8,
+                 open_seconds=5.0, probes=3, listener=None):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.listener = listener
+        self.state = CLOSED
+        self._bucket_seconds = window / buckets
+        self._buckets = []
+        self._opened_at = None
+        self._probing = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        """
+        Change state with the lock held, returns the change for `_notify`
+        to report once it is released.
+        """
+        old, self.state = self.state, state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state != CLOSED:
+            self._probing = self._probe_successes = 0
+        if state == CLOSED:
+            self._buckets = []
+        return (old, state)
+
+    def _notify(self, change):
+        if change is None:
+            return
+        old, state = change
+        LOGGER.warning('Circuit %s: %s -> %s', self.name, old, state)
+        if self.listener is not None:
+            try:
+                self.listener(self.name, old, state)
+            except Exception:
+                LOGGER.exception('Circuit listener failed')
+
+    def allow(self):
+        """
+        Whether a call may proceed, every allowed call must be followed
+        by `record`.
+        """
+        if self.state == CLOSED:
+            return True
+        change = None
+        try:
+            with self._lock:
+                if self.state == OPEN:
+                    if (time.monotonic() - self._opened_at <
+                            self.open_seconds):
+                        return False
+                    change = self._transition(HALF_OPEN)
+                if self.state == HALF_OPEN:
+                    if self._probing >= self.probes:
+                        return False
+                    self._probing += 1
+                return True
+        finally:
+            self._notify(change)
+
+    def _bucket(self, now):
+        buckets = self._buckets
+        if not buckets or now - buckets[-1].started >= self._bucket_seconds:
+            buckets.append(_Bucket(now))
+            cutoff = now - self.window
+            while buckets[0].started < cutoff:
+                buckets.pop(0)
+        return buckets[-1]
+
+    def record(self, success, seconds):
+        with self._lock:
+            change = self._record(success, seconds)
+        self._notify(change)
+
+    def _record(self, success, seconds):
+        slow = (self.slow_call_seconds is not None and
+                seconds >= self.slow_call_seconds)
+        if self.state == HALF_OPEN:
+            self._probing -= 1
+            if not success or slow:
+                return self._transition(OPEN)
+            self._probe_successes += 1
+            if self._probe_successes >= self.probes:
+                return self._transition(CLOSED)
+            return None
+        if self.state != CLOSED:
+            return None
+        bucket = self._bucket(time.monotonic())
+        bucket.calls += 1
+        bucket.failures += 0 if success else 1
+        bucket.slow += 1 if slow else 0
+        calls = sum(item.calls for item in self._buckets)
+        if calls < self.min_calls:
+            return None
+        failures = sum(item.failures for item in self._buckets)
+        slow_calls = sum(item.slow for item in self._buckets)
+        if (failures >= calls * self.failure_rate or
+                (self.slow_call_seconds is not None and
+                 slow_calls >= calls * self.slow_call_rate)):
+            return self._transition(OPEN)
+        return None
+
+
+class CircuitBreakerDispatcher(Dispatcher):
+    """
+    Fails fast with Fault.CIRCUIT_OPEN while the breaker for a request's
+    (service, version) on this endpoint is open.
+
+    :param endpoint: name of the wrapped endpoint, used in breaker names
+    :param breaker_options: keyword arguments for each CircuitBreaker
+    """
+    FAILURE_FAULTS = frozenset([Fault.INTERNAL_ERROR, Fault.SERVICE_UNKNOWN,
+                                Fault.VERSION_UNKNOWN, Fault.PARSE_ERROR])
+
+    def __init__(self, dispatcher, endpoint=None, **breaker_options):
+        self.dispatcher = dispatcher
+        self.endpoint = endpoint or repr(dispatcher)
+        self.breaker_options = breaker_options
+        self.breakers = dict()
+        self._lock = threading.Lock()
+
+    def breaker(self, service, version):
+        key = (service, version)
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            with self._lock:
+                breaker = self.breakers.get(key)
+                if breaker is None:
+                    name = '%s.%s@%s' % (service, version, self.endpoint)
+                    breaker = self.breakers[key] = CircuitBreaker(
+                        name, **self.breaker_options)
+        return breaker
+
+    def can_dispatch(self, request):
+        return self.dispatcher.can_dispatch(request)
+
+    def _failed(self, ex):
+        if isinstance(ex, Fault):
+            return ex.code in self.FAILURE_FAULTS
+        return True
+
+    def dispatch(self, request):
+        target = request.context.target
+        breaker = self.breaker(target.service, target.version)
+        if not breaker.allow():
+            raise Fault(request.context, Fault.CIRCUIT_OPEN)
+        started = time.monotonic()
+        try:
+            result = self.dispatcher.dispatch(request)
+        except Exception as ex:
+            breaker.record(not self._failed(ex), time.monotonic() - started)
+            raise
+        breaker.record(True, time.monotonic() - started)
+        return result
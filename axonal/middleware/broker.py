@@ -1,39 +1,283 @@
-from .dispatcher import ClassInstanceDispatcher
-from ..struct import Fault
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .balance import Backend, RoundRobinPolicy
+from .dispatcher import ClassInstanceDispatcher, InstancePoolDispatcher
+from ..struct import Fault, TransportFault
 from ..interface import Dispatcher
 
+LOGGER = logging.getLogger(__name__)
+
 
 class Router(Dispatcher):
-    def __init__(self, brokers):
+    """
+    Routes requests to one of many brokers using an index of
+    (service, version) to the brokers which can dispatch it.
+
+    The index is learned by asking every broker `can_dispatch` once per
+    key, after that routing is a dictionary lookup plus the balancing
+    policy. A key is forgotten when its broker no longer knows the
+    service, or when a broker with an `add_listener` method reports a
+    change. Backends whose transport fails `max_failures` times in a
+    row are evicted from the index for `retry_after` seconds, unless
+    they are the last able to serve a key. Faults raised by the
+    services themselves never count. A backend whose circuit breaker is
+    open is skipped in favour of the other candidates for that request.
+    """
+    UNKNOWN_FAULTS = frozenset([Fault.SERVICE_UNKNOWN, Fault.VERSION_UNKNOWN])
+
+    def __init__(self, brokers, policy=None, max_failures=3, retry_after=30.0):
         assert isinstance(brokers, list)
         self.brokers = brokers
+        self.policy = policy or RoundRobinPolicy()
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self._backends = [Backend(broker) for broker in brokers]
+        self._index = dict()
+        self._readmit_at = None
+        self._lock = threading.Lock()
+        for broker in brokers:
+            if hasattr(broker, 'add_listener'):
+                broker.add_listener(self._changed)
+
+    def _changed(self, *_):
+        self.invalidate()
+
+    def invalidate(self, key=None):
+        """
+        Forget the brokers learned for a (service, version) key, or all
+        of them, so they are asked again on the next request.
+        """
+        with self._lock:
+            if key is None:
+                self._index = dict()
+            else:
+                self._index.pop(key, None)
+
+    def _learn(self, request):
+        now = time.monotonic()
+        candidates = []
+        evicted = []
+        for backend in self._backends:
+            if backend.evicted_until is not None:
+                if backend.evicted_until > now:
+                    evicted.append(backend)
+                    continue
+                backend.evicted_until = None
+                backend.failures = 0
+            if backend.dispatcher.can_dispatch(request):
+                candidates.append(backend)
+        if not candidates:
+            # Evicted backends are better than none at all
+            candidates = [backend for backend in evicted
+                          if backend.dispatcher.can_dispatch(request)]
+        return candidates
+
+    def _candidates(self, request):
+        readmit_at = self._readmit_at
+        if readmit_at is not None and readmit_at <= time.monotonic():
+            with self._lock:
+                self._readmit_at = None
+                self._index = dict()
+        target = request.context.target
+        key = (target.service, target.version)
+        candidates = self._index.get(key)
+        if not candidates:
+            candidates = self._learn(request)
+            if candidates:
+                self._index[key] = candidates
+        return candidates
+
+    def _evict(self, backend):
+        with self._lock:
+            until = backend.evicted_until = time.monotonic() + self.retry_after
+            if self._readmit_at is None or until < self._readmit_at:
+                self._readmit_at = until
+            # Keys the backend is the last candidate for keep it
+            self._index = {key: [other for other in candidates
+                                 if other is not backend] or candidates
+                           for key, candidates in self._index.items()}
+        LOGGER.warning('Evicted failing backend: %r', backend.dispatcher)
+
+    def _failed(self, backend, candidates):
+        backend.failures += 1
+        if backend.failures >= self.max_failures and len(candidates) > 1:
+            if backend.evicted_until is None:
+                self._evict(backend)
 
     def can_dispatch(self, request):
-        for broker in self.brokers:
-            if broker.can_dispatch(request):
-                return True
-        return False
+        return len(self._candidates(request)) > 0
 
     def dispatch(self, request):
-        for broker in self.brokers:
-            if broker.can_dispatch(request):
-                return broker.dispatch(request)
-        raise Fault(request.context, Fault.SERVICE_UNKNOWN)
+        candidates = self._candidates(request)
+        if not candidates:
+            raise Fault(request.context, Fault.SERVICE_UNKNOWN)
+        remaining = candidates
+        while True:
+            backend = self.policy.choose(remaining)
+            backend.outstanding += 1
+            try:
+                result = backend.dispatcher.dispatch(request)
+            except TransportFault:
+                self._failed(backend, candidates)
+                raise
+            except Fault as ex:
+                if ex.code == Fault.CIRCUIT_OPEN:
+                    # Its breaker already failed fast, try another replica
+                    remaining = [other for other in remaining
+                                 if other is not backend]
+                    if remaining:
+                        continue
+                elif ex.code in self.UNKNOWN_FAULTS:
+                    target = request.context.target
+                    self.invalidate((target.service, target.version))
+                else:
+                    backend.failures = 0
+                raise
+            except Exception:
+                self._failed(backend, candidates)
+                raise
+            finally:
+                backend.outstanding -= 1
+            backend.failures = 0
+            return result
 
 
 class RegistryBroker(Dispatcher):
-    def __init__(self, registry):
+    """
+    Dispatches to instances of the classes in a registry.
+
+    By default one instance per class is created on first use and shared
+    by every caller. With `pool_size` each call checks out an instance
+    from a bounded pool instead, failing after waiting `pool_timeout`
+    seconds for one to be free, `eager` creates them all up-front,
+    `idle_timeout` frees classes unused for that many seconds and
+    `max_classes` caps how many classes are kept instantiated at once,
+    least recently used first. Memory is capped by class count rather
+    than measured size, which Python can't report cheaply or reliably
+    for an instance and everything it references.
+
+    When the registry replaces a class, e.g. on reload, its instances
+    are dropped: calls already holding them finish there, new calls get
+    instances of the new class.
+    """
+    def __init__(self, registry, pool_size=None, eager=False,
+                 idle_timeout=None, max_classes=None, pool_timeout=30.0):
         self.registry = registry
         self.instances = dict()
         self.services = dict()
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.idle_timeout = idle_timeout
+        self.max_classes = max_classes
+        self._dispatchers = OrderedDict()
+        self._last_used = dict()
+        self._next_sweep = None
+        self._lock = threading.RLock()
+        if hasattr(registry, 'add_listener'):
+            registry.add_listener(self._replaced)
+        if eager:
+            self.warm_up()
+
+    def _create(self, cls):
+        if self.pool_size:
+            return InstancePoolDispatcher(cls, self.pool_size,
+                                          self.pool_timeout)
+        return ClassInstanceDispatcher(cls())
+
+    def _instance(self, cls):
+        """
+        Returns the dispatcher for a class, creating it if necessary.
+        """
+        dispatcher = self._dispatchers.get(cls)
+        if dispatcher is None:
+            with self._lock:
+                dispatcher = self._dispatchers.get(cls)
+                if dispatcher is None:
+                    if self.max_classes:
+                        while len(self._dispatchers) >= self.max_classes:
+                            self._evict(next(iter(self._dispatchers)))
+                    dispatcher = self._dispatchers[cls] = self._create(cls)
+                    self.instances[cls] = frozenset()
+                    self._last_used[cls] = time.monotonic()
+        return dispatcher
 
     def _load(self, key, cls):
-        instance = ClassInstanceDispatcher(cls())
-        self.services[key] = instance
-        if cls in self.instances:
-            self.instances[cls] = self.instances[cls] | {key}
+        instance = self._instance(cls)
+        with self._lock:
+            self.services[key] = instance
+            self.instances[cls] = self.instances.get(cls, frozenset()) | {key}
         return instance
 
+    def _evict(self, cls):
+        with self._lock:
+            self._dispatchers.pop(cls, None)
+            self._last_used.pop(cls, None)
+            for key in self.instances.pop(cls, ()):
+                self.services.pop(key, None)
+        LOGGER.debug('Evicted service instances: %r', cls)
+
+    def add_listener(self, method):
+        """
+        Call the bound method when the registry's classes change
+        """
+        if hasattr(self.registry, 'add_listener'):
+            self.registry.add_listener(method)
+
+    def _replaced(self, old_cls, new_cls):
+        if old_cls is None:
+            return
+        loaded = old_cls in self._dispatchers
+        self._evict(old_cls)
+        if not loaded or new_cls is None:
+            return
+        # Instantiate the replacement now rather than on the next call
+        try:
+            dispatcher = self._instance(new_cls)
+            if isinstance(dispatcher, InstancePoolDispatcher):
+                dispatcher.warm_up()
+        except Exception:
+            LOGGER.exception('Failed to instantiate %r', new_cls)
+
+    def warm_up(self):
+        """
+        Instantiate every registered class ahead of the first request.
+        """
+        for cls in list(self.registry.classes):
+            dispatcher = self._instance(cls)
+            if isinstance(dispatcher, InstancePoolDispatcher):
+                dispatcher.warm_up()
+
+    def evict_idle(self, now=None):
+        """
+        Free the instances of classes not used within `idle_timeout`
+        """
+        if not self.idle_timeout:
+            return
+        if now is None:
+            now = time.monotonic()
+        cutoff = now - self.idle_timeout
+        for cls, last_used in list(self._last_used.items()):
+            if last_used < cutoff:
+                self._evict(cls)
+
+    def _touch(self, cls):
+        now = time.monotonic()
+        self._last_used[cls] = now
+        if self.max_classes:
+            try:
+                self._dispatchers.move_to_end(cls)
+            except KeyError:
+                pass
+        if self.idle_timeout:
+            if self._next_sweep is None:
+                self._next_sweep = now + self.idle_timeout
+            elif now >= self._next_sweep:
+                self._next_sweep = now + self.idle_timeout
+                self.evict_idle(now)
+
     def _lookup(self, request):
         target = request.context.target
         key = (target.service, target.version)
@@ -42,6 +286,8 @@ class RegistryBroker(Dispatcher):
             cls = self.registry.lookup(target.service, target.version)
             if cls:
                 instance = self._load(key, cls)
+        if instance is not None and (self.idle_timeout or self.max_classes):
+            self._touch(instance.cls)
         return instance
 
     def can_dispatch(self, request):
@@ -0,0 +1,412 @@
+"""
+Capture of live traffic and its replay for performance testing.
+
+A `CaptureDispatcher` or `CaptureTransport` records a sample of the
+requests and events passing through it to a capture file, each encoded
+with an internal protocol along with when it started and how long the
+original call took:
+
+    capture = Capture('/var/tmp/axonal.cap', sample_rate=0.05)
+    broker = CaptureDispatcher(RegistryBroker(GlobalRegistry()), capture)
+
+`replay` later re-drives the captured calls against any dispatcher, a
+`Router` or a `ProtocolTransportDispatcher` for a remote endpoint, at
+the captured timing or faster, and reports how the latency of each
+target compares with the original:
+
+    report = replay('/var/tmp/axonal.cap', dispatcher, speed=2.0)
+    print(report.format())
+
+The file starts with a header naming the protocol, then each record is
+its start time, latency, flags and length followed by the encoded
+frame. Capture stops once the file reaches `max_bytes`. For streamed
+responses the latency is the time until the response was returned,
+not until the stream was consumed.
+"""
+import logging
+import random
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ..interface import Dispatcher, Transport
+from ..plugin import Plugin
+from ..proto import get_protocol
+from ..proto.internal import Segments
+from ..struct import Fault, StreamResponse
+
+__all__ = ('Capture', 'CaptureReader', 'CaptureDispatcher',
+           'CaptureTransport', 'CapturedCall', 'ReplayReport', 'replay',
+           'ReplayPlugin')
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b'AXCAP'
+VERSION = 1
+_HEADER = struct.Struct('!5sBB')
+# Start time, latency in seconds, flags, frame length
+_RECORD = struct.Struct('!dfBI')
+
+FLAG_EVENT = 1
+FLAG_FAULT = 2
+
+
+class Capture(object):
+    """
+    Writer of a capture file, shared by any number of threads.
+
+    :param protocol: name of the internal protocol frames are encoded with
+    :param sample_rate: fraction of calls recorded
+    :param max_bytes: size at which the file is full and capture stops
+    """
+    def __init__(self, path, protocol='json', sample_rate=1.0,
+                 max_bytes=256 * 1024 * 1024):
+        name = protocol.encode('ascii')
+        self.path = path
+        self.protocol = protocol
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.records = 0
+        self.full = False
+        self._lock = threading.Lock()
+        self._handle = open(path, 'wb')
+        self._handle.write(_HEADER.pack(MAGIC, VERSION, len(name)) + name)
+        self._size = _HEADER.size + len(name)
+
+    def sample(self):
+        """
+        Whether the next call should be recorded
+        """
+        if self.full or self._handle is None:
+            return False
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def record(self, started, seconds, flags, data):
+        if isinstance(data, Segments):
+            data = data.pack()
+        elif isinstance(data, str):
+            data = data.encode('utf-8')
+        head = _RECORD.pack(started, seconds, flags, len(data))
+        with self._lock:
+            if self._handle is None or self.full:
+                return False
+            if self._size + len(head) + len(data) > self.max_bytes:
+                self.full = True
+                LOGGER.warning('Capture full: %s (%d records)',
+                               self.path, self.records)
+                return False
+            self._handle.write(head)
+            self._handle.write(data)
+            self._size += len(head) + len(data)
+            self.records += 1
+        return True
+
+    def flush(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.flush()
+
+    def close(self):
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+
+class CapturedCall(object):
+    __slots__ = ('started', 'seconds', 'flags', 'data')
+
+    def __init__(self, started, seconds, flags, data):
+        self.started = started
+        self.seconds = seconds
+        self.flags = flags
+        self.data = data
+
+    @property
+    def is_event(self):
+        return bool(self.flags & FLAG_EVENT)
+
+    @property
+    def is_fault(self):
+        return bool(self.flags & FLAG_FAULT)
+
+
+class CaptureReader(object):
+    """
+    Iterates the calls in a capture file, stopping at a torn record left
+    by a process which didn't close its capture.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._handle = open(path, 'rb')
+        magic, version, length = _HEADER.unpack(
+            self._handle.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            self._handle.close()
+            raise ValueError('Not a capture file: %s' % (path,))
+        self.protocol = self._handle.read(length).decode('ascii')
+
+    def __iter__(self):
+        handle = self._handle
+        while True:
+            head = handle.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                return
+            started, seconds, flags, length = _RECORD.unpack(head)
+            data = handle.read(length)
+            if len(data) < length:
+                return
+            yield CapturedCall(started, seconds, flags, data)
+
+    def close(self):
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureDispatcher(Dispatcher):
+    """
+    Records sampled requests and events before passing them on, only
+    sampled calls are encoded.
+    """
+    def __init__(self, dispatcher, capture, protocol=None):
+        self.dispatcher = dispatcher
+        self.capture = capture
+        self.protocol = protocol or get_protocol(capture.protocol)
+
+    def can_dispatch(self, request):
+        return self.dispatcher.can_dispatch(request)
+
+    def dispatch(self, request):
+        if not self.capture.sample():
+            return self.dispatcher.dispatch(request)
+        try:
+            data = self.protocol.encode(request)
+        except Exception:
+            LOGGER.debug('Cannot capture %r', request.context.target)
+            return self.dispatcher.dispatch(request)
+        flags = FLAG_EVENT if request.is_event else 0
+        started = time.time()
+        begun = time.perf_counter()
+        try:
+            return self.dispatcher.dispatch(request)
+        except Exception:
+            flags |= FLAG_FAULT
+            raise
+        finally:
+            self.capture.record(started, time.perf_counter() - begun,
+                                flags, data)
+
+
+class CaptureTransport(Transport):
+    """
+    Records the sampled frames sent through a transport, the capture's
+    protocol must be the one they are encoded with.
+    """
+    def __init__(self, transport, capture):
+        self.transport = transport
+        self.capture = capture
+
+    def can_transport(self, request):
+        return self.transport.can_transport(request)
+
+    def _send(self, send, context, data, flags):
+        if not self.capture.sample():
+            return send(context, data)
+        started = time.time()
+        begun = time.perf_counter()
+        try:
+            return send(context, data)
+        except Exception:
+            flags |= FLAG_FAULT
+            raise
+        finally:
+            self.capture.record(started, time.perf_counter() - begun,
+                                flags, data)
+
+    def send_request(self, context, data):
+        return self._send(self.transport.send_request, context, data, 0)
+
+    def send_event(self, context, data):
+        return self._send(self.transport.send_event, context, data,
+                          FLAG_EVENT)
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+class TargetStats(object):
+    __slots__ = ('target', 'calls', 'faults', 'captured_faults', 'captured',
+                 'replayed')
+
+    def __init__(self, target):
+        self.target = target
+        self.calls = 0
+        self.faults = 0
+        self.captured_faults = 0
+        self.captured = []
+        self.replayed = []
+
+    def difference(self, pct=50):
+        """
+        Replayed minus captured latency at a percentile, in seconds
+        """
+        captured = _percentile(self.captured, pct)
+        replayed = _percentile(self.replayed, pct)
+        if captured is None or replayed is None:
+            return None
+        return replayed - captured
+
+
+class ReplayReport(object):
+    """
+    Latencies of the captured and replayed calls, by target
+    """
+    def __init__(self):
+        self.targets = dict()
+        self.skipped = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, target, captured, replayed, captured_fault, fault):
+        name = '%s.%s.%s' % (target.service, target.version, target.method)
+        with self._lock:
+            stats = self.targets.get(name)
+            if stats is None:
+                stats = self.targets[name] = TargetStats(name)
+            stats.calls += 1
+            stats.captured.append(captured)
+            stats.replayed.append(replayed)
+            stats.captured_faults += 1 if captured_fault else 0
+            stats.faults += 1 if fault else 0
+
+    def format(self):
+        def _ms(value):
+            return '-' if value is None else '%.2f' % (value * 1000.0,)
+        lines = ['%-40s %7s %7s %9s %9s %9s %9s %9s' % (
+            'target', 'calls', 'faults', 'p50 cap', 'p50 rep', 'p50 diff',
+            'p99 cap', 'p99 rep')]
+        for name in sorted(self.targets):
+            stats = self.targets[name]
+            lines.append('%-40s %7d %7s %9s %9s %9s %9s %9s' % (
+                name, stats.calls,
+                '%d/%d' % (stats.faults, stats.captured_faults),
+                _ms(_percentile(stats.captured, 50)),
+                _ms(_percentile(stats.replayed, 50)),
+                _ms(stats.difference(50)),
+                _ms(_percentile(stats.captured, 99)),
+                _ms(_percentile(stats.replayed, 99))))
+        lines.append('%d calls skipped, %.2fs elapsed, latencies in ms' % (
+            self.skipped, self.seconds))
+        return '\n'.join(lines)
+
+
+def _replay_call(protocol, dispatcher, call, report):
+    try:
+        request = protocol.decode(call.data)
+    except Exception:
+        with report._lock:
+            report.skipped += 1
+        return
+    fault = False
+    begun = time.perf_counter()
+    try:
+        response = dispatcher.dispatch(request)
+    except Exception:
+        fault = True
+        response = None
+    seconds = time.perf_counter() - begun
+    if isinstance(response, StreamResponse):
+        try:
+            for _ in response:
+                pass
+        except Fault:
+            pass
+    report.add(request.context.target, call.seconds, seconds,
+               call.is_fault, fault)
+
+
+def replay(path, dispatcher, speed=1.0, protocol=None, workers=16):
+    """
+    Dispatch the calls of a capture file, returning a `ReplayReport`.
+
+    :param speed: 1.0 keeps the captured timing, 2.0 is twice as fast
+        and 0 sends calls as fast as `workers` threads allow
+    :param protocol: decodes the frames, by default the capture's own
+    """
+    report = ReplayReport()
+    with CaptureReader(path) as reader:
+        if protocol is None:
+            protocol = get_protocol(reader.protocol)
+        begun = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            first = None
+            for call in reader:
+                if first is None:
+                    first = call.started
+                if speed:
+                    delay = ((call.started - first) / speed -
+                             (time.perf_counter() - begun))
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(_replay_call, protocol, dispatcher, call,
+                                report)
+        report.seconds = time.perf_counter() - begun
+    return report
+
+
+class ReplayPlugin(Plugin):
+    """
+    Replays a capture file against an endpoint, or the services of the
+    `--preload` modules, and prints the latency report.
+    """
+    def __init__(self):
+        self._options = None
+
+    def options(self, parser, env):
+        parser.add_argument(
+            'capture', metavar='filename', help='Capture file to replay')
+        parser.add_argument(
+            '--endpoint', dest='endpoint', metavar='url',
+            help='Replay against a remote RpcHttpApp rather than the '
+                 'local registry')
+        parser.add_argument(
+            '--speed', dest='speed', metavar='factor', type=float,
+            default=1.0, help='Multiple of the captured rate, 0 for as '
+                              'fast as possible')
+        parser.add_argument(
+            '--workers', dest='workers', metavar='count', type=int,
+            default=16, help='Calls in flight at once')
+
+    def configure(self, options, conf):
+        self._options = options
+
+    def _dispatcher(self, name, protocol):
+        options = self._options
+        if options.endpoint:
+            from .dispatcher import ProtocolTransportDispatcher
+            from .httpclient import HttpTransport
+            return ProtocolTransportDispatcher(
+                protocol, HttpTransport(options.endpoint, name))
+        from ..registry import GlobalRegistry
+        from .broker import RegistryBroker
+        return RegistryBroker(GlobalRegistry())
+
+    def run(self):
+        options = self._options
+        with CaptureReader(options.capture) as reader:
+            name = reader.protocol
+        protocol = get_protocol(name)
+        report = replay(options.capture, self._dispatcher(name, protocol),
+                        options.speed, protocol, options.workers)
+        print(report.format())
+        return report
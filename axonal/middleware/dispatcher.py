@@ -1,5 +1,52 @@
-from ..struct import Request, Response, Fault, Event
+import inspect
+import queue
+import threading
+import weakref
+from types import GeneratorType, AsyncGeneratorType
+
+from ..struct import (Request, Response, Fault, Event, StreamResponse,
+                      TransportFault)
 from ..interface import Dispatcher, Protocol, Transport
+from ..utils import current_guid
+
+
+def _release_iter(items, done):
+    try:
+        yield from items
+    finally:
+        done[0]()
+
+
+async def _release_aiter(items, done):
+    try:
+        async for item in items:
+            yield item
+    finally:
+        done[0]()
+
+
+async def _release_await(awaitable, done):
+    try:
+        return await awaitable
+    finally:
+        done[0]()
+
+
+def _release_after(data, release, *args):
+    """
+    Wraps a stream or awaitable so `release(*args)` is called once it
+    finishes, is closed, or is garbage collected without being used.
+    """
+    if hasattr(data, '__aiter__'):
+        wrapper = _release_aiter
+    elif inspect.isawaitable(data):
+        wrapper = _release_await
+    else:
+        wrapper = _release_iter
+    done = []
+    wrapped = wrapper(data, done)
+    done.append(weakref.finalize(wrapped, release, *args))
+    return wrapped
 
 
 class BaseDispatcher(Dispatcher):
@@ -29,7 +76,8 @@ class BaseDispatcher(Dispatcher):
             default_code = Fault.INTERNAL_ERROR
         if isinstance(ex, Fault):
             # TODO: validate if the context is the same?
-            return Fault(request.context, ex.code, ex.message, ex.data)
+            return ex.__class__(request.context, ex.code, ex.message,
+                                ex.data)
         elif isinstance(ex, NotImplementedError):
             return Fault(request.context, Fault.METHOD_NOT_FOUND, inner=ex)
         elif isinstance(ex, (RuntimeError, ValueError, TypeError)):
@@ -51,6 +99,10 @@ class ClassInstanceDispatcher(BaseDispatcher):
         assert instance is not None
         self.instance = instance
 
+    @property
+    def cls(self):
+        return self.instance.__class__
+
     def can_dispatch(self, request):
         return True
 
@@ -76,15 +128,92 @@ class ClassInstanceDispatcher(BaseDispatcher):
         elif isinstance(request.args, (tuple, list)):
             args = list(request.args)
         # Then dispatch the call and handle exceptions
+        token = current_guid.set(request.context.guid)
         try:
             result = method(*args, **kwargs)
         except Exception as ex:
             raise self._handle_exception(request, ex)
+        finally:
+            current_guid.reset(token)
         # When all is good, return the result response
         if isinstance(request, Request):
+            if isinstance(result, (GeneratorType, AsyncGeneratorType)):
+                return StreamResponse(request.context, result)
             return Response(request.context, result)
 
 
+class InstancePoolDispatcher(BaseDispatcher):
+    """
+    Dispatches each call to an instance checked out from a bounded pool,
+    so instances are never used by more than one caller at a time.
+    Instances are created on demand until `size` exist, after which
+    callers wait up to `timeout` seconds for one to be returned, then
+    fail with Fault.INTERNAL_ERROR. None waits forever.
+    """
+    __slots__ = ('cls', 'size', 'timeout', '_pool', '_created', '_lock')
+
+    def __init__(self, cls, size, timeout=30.0):
+        assert cls is not None
+        assert size > 0
+        self.cls = cls
+        self.size = size
+        self.timeout = timeout
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """
+        Create all instances up-front
+        """
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    break
+                self._created += 1
+            self._pool.put(ClassInstanceDispatcher(self.cls()))
+
+    def _checkout(self, request):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return ClassInstanceDispatcher(self.cls())
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._pool.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Fault(request.context, Fault.INTERNAL_ERROR,
+                        'No %s instance free' % (self.cls.__name__,))
+
+    def can_dispatch(self, request):
+        return True
+
+    def dispatch(self, request):
+        instance = self._checkout(request)
+        try:
+            result = instance.dispatch(request)
+        except BaseException:
+            self._pool.put(instance)
+            raise
+        data = getattr(result, 'data', None)
+        if isinstance(result, StreamResponse) or inspect.isawaitable(data):
+            # Still running on the instance, it is returned once done
+            return result.__class__(result.context, _release_after(
+                data, self._pool.put, instance))
+        self._pool.put(instance)
+        return result
+
+
 class ProtocolDispatcherTransport(Transport):
     def __init__(self, protocol, dispatcher):
         self.protocol = protocol
@@ -96,6 +225,8 @@ class ProtocolDispatcherTransport(Transport):
     def send_request(self, context, data):
         obj = self.protocol.decode(data)
         resp = self.dispatcher.dispatch(obj)
+        if isinstance(resp, StreamResponse):
+            return self.protocol.encode_stream(resp)
         return self.protocol.encode(resp)
 
     def send_event(self, context, data):
@@ -118,13 +249,23 @@ class ProtocolTransportDispatcher(BaseDispatcher):
     def can_dispatch(self, request):
         return self.transport.can_transport(request)
 
+    def _transport_fault(self, request, ex):
+        """
+        Faults from the transport its self are passed on, any other
+        error means the request or its reply was lost on the way.
+        """
+        if isinstance(ex, Fault):
+            return self._handle_exception(request, ex)
+        return TransportFault(request.context, Fault.INTERNAL_ERROR,
+                              str(ex), inner=ex)
+
     def emit(self, request):
         assert isinstance(request, Event)
-        data = self.protocol.encode_event(request)
+        data = self.protocol.encode(request)
         try:
             self.transport.send_event(request.context, data)
         except Exception as ex:
-            raise self._handle_exception(request, ex, Fault.INTERNAL_ERROR)
+            raise self._transport_fault(request, ex)
 
     def call(self, request):
         assert isinstance(request, Request)
@@ -135,13 +276,17 @@ class ProtocolTransportDispatcher(BaseDispatcher):
         try:
             response_data = self.transport.send_request(request.context, data)
         except Exception as ex:
-            raise self._handle_exception(request, ex, Fault.INTERNAL_ERROR)
+            raise self._transport_fault(request, ex)
+        if hasattr(response_data, '__next__'):
+            # Frames of a streamed response, decoded as they're consumed
+            return StreamResponse(
+                request.context, self.protocol.decode_stream(response_data))
         try:
             result = self.protocol.decode(response_data)
         except Exception as ex:
             raise self._handle_exception(request, ex, Fault.PARSE_ERROR)
         if isinstance(result, Exception):
-            raise self._handle_exception(request.context, result)
+            raise self._handle_exception(request, result)
         elif isinstance(result, Response):
             return result
         return Response(request.context, result)
@@ -0,0 +1,264 @@
+"""
+In-process event bus delivering each event to many subscribers.
+
+Subscribers register for subjects in the registry's dotted form, the
+service name followed by a version which may end in wildcards:
+
+    bus = EventBus()
+    bus.subscribe('srv.events.1.X', on_any_v1)
+    bus.subscribe('srv.events.1.3.5', on_exact)
+
+An event for srv.events 1.3.5 is delivered to both. Subjects are kept
+in a dict index and an event is looked up under its few compatible
+versions, so matching does not depend on the number of subscribers.
+
+Each subscriber has its own queue and consumer task on the bus's event
+loop, a slow handler only delays its own events. Coroutine functions
+are awaited, other handlers run in an executor. When a subscriber's
+queue is full further events for it are dropped and counted.
+"""
+import asyncio
+import logging
+import threading
+
+from ..interface import Dispatcher
+from ..registry import parse_subject, event_subjects
+from ..struct import Fault
+
+__all__ = ('EventBus', 'Subscription', 'SubjectIndex', 'PublishingDispatcher')
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SubjectIndex(object):
+    """
+    Subscribers by subject, matched to an event by looking up its few
+    compatible subjects. Changes copy the index, lookups need no lock.
+    """
+    def __init__(self, max_cached=4096):
+        self.max_cached = max_cached
+        self._index = dict()
+        self._matches = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalise(subject):
+        """
+        The subject with its version padded, e.g. srv.events.1.X.X
+        """
+        name, version = parse_subject(subject)
+        return name + '.' + version
+
+    def add(self, subject, item):
+        with self._lock:
+            self._index[subject] = self._index.get(subject, ()) + (item,)
+            self._matches = dict()
+
+    def discard(self, subject, item):
+        with self._lock:
+            items = tuple(other for other in self._index.get(subject, ())
+                          if other is not item)
+            if items:
+                self._index[subject] = items
+            else:
+                self._index.pop(subject, None)
+            self._matches = dict()
+
+    def clear(self):
+        """
+        Remove and return every item
+        """
+        with self._lock:
+            items = self.items()
+            self._index = dict()
+            self._matches = dict()
+        return items
+
+    def items(self):
+        return [item for items in list(self._index.values())
+                for item in items]
+
+    def match(self, service, version):
+        """
+        Items subscribed to subjects an event for the service and
+        version is delivered to
+        """
+        key = (service, version)
+        matches = self._matches
+        items = matches.get(key)
+        if items is None:
+            index = self._index
+            items = ()
+            for subject in event_subjects(service, version):
+                items += index.get(subject, ())
+            if len(matches) < self.max_cached:
+                matches[key] = items
+        return items
+
+
+class PublishingDispatcher(Dispatcher):
+    """
+    Delivers events to subscribers and also passes them to the optional
+    inner `dispatcher`, requests only go to the inner dispatcher.
+    """
+    dispatcher = None
+
+    def has_subscribers(self, event):
+        raise NotImplementedError()
+
+    def publish(self, event):
+        raise NotImplementedError()
+
+    def _inner_can_dispatch(self, request):
+        inner = self.dispatcher
+        return inner is not None and inner.can_dispatch(request)
+
+    def can_dispatch(self, request):
+        if self._inner_can_dispatch(request):
+            return True
+        return request.is_event and self.has_subscribers(request)
+
+    def dispatch(self, request):
+        if request.is_event:
+            self.publish(request)
+            if not self._inner_can_dispatch(request):
+                return None
+        elif self.dispatcher is None:
+            raise Fault(request.context, Fault.SERVICE_UNKNOWN)
+        return self.dispatcher.dispatch(request)
+
+
+class Subscription(object):
+    __slots__ = ('subject', 'handler', 'queue_size', 'dropped', '_queue',
+                 '_task', '_is_async')
+
+    def __init__(self, subject, handler, queue_size):
+        self.subject = subject
+        self.handler = handler
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._queue = None
+        self._task = None
+        self._is_async = asyncio.iscoroutinefunction(handler)
+
+    def _push(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _consume(self, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await self._queue.get()
+            try:
+                if self._is_async:
+                    await self.handler(event)
+                else:
+                    await loop.run_in_executor(executor, self.handler, event)
+            except Exception:
+                LOGGER.exception('Event handler failed: %s', self.subject)
+            finally:
+                self._queue.task_done()
+
+
+class EventBus(PublishingDispatcher):
+    """
+    :param dispatcher: optional inner dispatcher, events are delivered
+        to subscribers and also passed on to it
+    :param loop: event loop running the consumers, by default a private
+        loop on a background thread
+    :param queue_size: events buffered per subscriber before dropping
+    :param executor: runs handlers which aren't coroutine functions
+    """
+    def __init__(self, dispatcher=None, loop=None, queue_size=1024,
+                 executor=None):
+        self.dispatcher = dispatcher
+        self.queue_size = queue_size
+        self.executor = executor
+        self._index = SubjectIndex()
+        self._thread = None
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=loop.run_forever,
+                                            name='axonal-eventbus')
+            self._thread.daemon = True
+            self._thread.start()
+        self.loop = loop
+
+    def subscribe(self, subject, handler, queue_size=None):
+        """
+        Deliver events matching the subject to `handler(event)`
+        """
+        subject = SubjectIndex.normalise(subject)
+        sub = Subscription(subject, handler, queue_size or self.queue_size)
+        self._index.add(subject, sub)
+        self.loop.call_soon_threadsafe(self._start, sub)
+        return sub
+
+    def _start(self, sub):
+        sub._queue = asyncio.Queue(sub.queue_size)
+        sub._task = self.loop.create_task(sub._consume(self.executor))
+
+    def unsubscribe(self, sub):
+        self._index.discard(sub.subject, sub)
+        self.loop.call_soon_threadsafe(self._stop, sub)
+
+    @staticmethod
+    def _stop(sub):
+        if sub._task is not None:
+            sub._task.cancel()
+
+    def subscribers(self, event):
+        """
+        Subscriptions an event is delivered to
+        """
+        target = event.context.target
+        return self._index.match(target.service, target.version)
+
+    def has_subscribers(self, event):
+        return len(self.subscribers(event)) > 0
+
+    def publish(self, event):
+        """
+        Queue an event for its subscribers, safe to call from any thread
+        """
+        subs = self.subscribers(event)
+        if subs:
+            self.loop.call_soon_threadsafe(self._push, subs, event)
+        return len(subs)
+
+    @staticmethod
+    def _push(subs, event):
+        for sub in subs:
+            sub._push(event)
+
+    async def _drain(self, subs):
+        for sub in subs:
+            if sub._queue is not None:
+                await sub._queue.join()
+
+    def join(self, timeout=None):
+        """
+        Wait until every queued event has been handled, from a thread
+        other than the bus loop's.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._drain(self._index.items()), self.loop)
+        future.result(timeout)
+
+    async def _shutdown(self, subs):
+        tasks = [sub._task for sub in subs if sub._task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        subs = self._index.clear()
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(subs),
+                                                  self.loop)
+        if self._thread is not None:
+            future.result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
@@ -0,0 +1,322 @@
+"""
+Durable append-only log of encoded events.
+
+Events sent through an `EventLogTransport` are appended to a log of
+segment files on local disk and survive the receiver being down or the
+process crashing. An `EventLogConsumer` later reads them back from its
+last committed offset and dispatches them, giving at-least-once
+delivery, or replays them from any earlier offset.
+
+    log = EventLog('/var/lib/axonal/events', sync='group')
+    dispatcher = ProtocolTransportDispatcher(JsonInternalProtocol(),
+                                             EventLogTransport(log))
+    consumer = EventLogConsumer(log, 'mailer', JsonInternalProtocol(),
+                                RegistryBroker(GlobalRegistry()))
+    consumer.poll()
+
+Each record is a 4 byte length and 4 byte CRC32 followed by the payload,
+offsets are byte positions in the log as a whole. Durability is chosen
+with `sync`:
+
+    none    leave flushing to the operating system
+    group   writers wait for an fsync shared with concurrent writers
+    always  fsync every append before returning
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from ..interface import Transport
+from ..struct import Fault
+
+__all__ = ('EventLog', 'EventLogTransport', 'EventLogConsumer')
+
+LOGGER = logging.getLogger(__name__)
+
+_RECORD = struct.Struct('!II')
+_SEGMENT_SUFFIX = '.log'
+
+
+def _segment_name(base):
+    return '%020d%s' % (base, _SEGMENT_SUFFIX)
+
+
+def _scan(buf, start, end):
+    """
+    Yields (position, payload start, payload end) of each intact record
+    in buf[start:end], stopping at the first torn or corrupt one.
+    """
+    pos = start
+    while pos + _RECORD.size <= end:
+        length, crc = _RECORD.unpack_from(buf, pos)
+        data_start = pos + _RECORD.size
+        data_end = data_start + length
+        if data_end > end:
+            return
+        if zlib.crc32(buf[data_start:data_end]) & 0xffffffff != crc:
+            return
+        yield pos, data_start, data_end
+        pos = data_end
+
+
+class EventLog(object):
+    SYNC_MODES = ('none', 'group', 'always')
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 sync='group', sync_delay=0.0):
+        if sync not in self.SYNC_MODES:
+            raise ValueError('Unknown sync mode: %s' % (sync,))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.sync_delay = sync_delay
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(threading.Lock())
+        self._fd = None
+        self._closed = False
+        os.makedirs(directory, exist_ok=True)
+        self._bases = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+            if name.endswith(_SEGMENT_SUFFIX))
+        if not self._bases:
+            self._bases.append(0)
+        self._open_tail()
+        self._synced_offset = self._end
+        self._flusher = None
+        if sync == 'group':
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name='axonal-eventlog-sync')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _path(self, base):
+        return os.path.join(self.directory, _segment_name(base))
+
+    def _open_tail(self):
+        """
+        Open the last segment for appending, truncating any torn
+        record left by a crash.
+        """
+        base = self._bases[-1]
+        path = self._path(base)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(fd).st_size
+        valid = 0
+        if size:
+            with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as buf:
+                for _, _, data_end in _scan(buf, 0, size):
+                    valid = data_end
+        if valid != size:
+            LOGGER.warning('Truncating torn event log tail: %s (%d > %d)',
+                           path, size, valid)
+            os.ftruncate(fd, valid)
+        self._fd = fd
+        self._end = base + valid
+
+    @property
+    def end_offset(self):
+        return self._end
+
+    def _roll(self):
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._bases.append(self._end)
+        self._fd = os.open(self._path(self._end),
+                           os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def append(self, data):
+        """
+        Append one record, returning its offset once it is as durable
+        as the sync mode requires.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        record = _RECORD.pack(len(data), zlib.crc32(data) & 0xffffffff)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Event log is closed')
+            size = self._end - self._bases[-1]
+            if size and size + len(record) + len(data) > self.segment_size:
+                self._roll()
+            offset = self._end
+            os.write(self._fd, record + data)
+            self._end = end = offset + len(record) + len(data)
+            if self.sync == 'always':
+                os.fsync(self._fd)
+                self._synced_offset = end
+        if self.sync == 'group':
+            with self._synced:
+                self._synced.notify_all()
+                while self._synced_offset < end and not self._closed:
+                    self._synced.wait()
+        return offset
+
+    def _flush_loop(self):
+        while True:
+            with self._synced:
+                while self._synced_offset >= self._end and not self._closed:
+                    self._synced.wait()
+                if self._closed:
+                    return
+            if self.sync_delay:
+                time.sleep(self.sync_delay)
+            with self._lock:
+                if self._closed:
+                    return
+                target = self._end
+                # Earlier segments are synced by _roll, the duplicate keeps
+                # the file open if it rolls while appends continue
+                fd = os.dup(self._fd)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            with self._synced:
+                self._synced_offset = target
+                self._synced.notify_all()
+
+    def read(self, offset=0):
+        """
+        Yields (offset, next offset, payload) for records from `offset`
+        to the current end of the log.
+        """
+        with self._lock:
+            end = self._end
+            bases = list(self._bases)
+        for idx, base in enumerate(bases):
+            next_base = bases[idx + 1] if idx + 1 < len(bases) else end
+            if next_base <= offset:
+                continue
+            if base >= end:
+                break
+            start = max(offset, base) - base
+            limit = min(end, next_base) - base
+            if limit <= start:
+                continue
+            with open(self._path(base), 'rb') as handle:
+                with mmap.mmap(handle.fileno(), limit,
+                               access=mmap.ACCESS_READ) as buf:
+                    for pos, data_start, data_end in _scan(buf, start, limit):
+                        payload = buf[data_start:data_end]
+                        yield base + pos, base + data_end, payload
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            os.fsync(self._fd)
+            self._synced_offset = self._end
+            self._closed = True
+            os.close(self._fd)
+        with self._synced:
+            self._synced.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+
+
+class EventLogTransport(Transport):
+    """
+    Transport which appends events to an EventLog, use it with
+    ProtocolTransportDispatcher to make emitted events durable.
+    """
+    def __init__(self, log):
+        self.log = log
+
+    def can_transport(self, request):
+        return request is not None and request.is_event
+
+    def send_request(self, context, data):
+        raise Fault(context, Fault.INVALID_REQUEST,
+                    'Event log only carries events')
+
+    def send_event(self, context, data):
+        self.log.append(data)
+
+
+class EventLogConsumer(object):
+    """
+    Reads events from the log and dispatches them, committing the
+    offset after each batch so a crash re-delivers at most one batch.
+
+    Delivery stops at the first event the dispatcher fails, the offset
+    is committed up to the event before it and polls return nothing
+    until `retry_delay` has passed, doubling on each further failure up
+    to `max_retry_delay`. Events which cannot be decoded are skipped.
+    """
+    def __init__(self, log, name, protocol, dispatcher, retry_delay=1.0,
+                 max_retry_delay=60.0):
+        self.log = log
+        self.name = name
+        self.protocol = protocol
+        self.dispatcher = dispatcher
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.failures = 0
+        self._retry_at = None
+        self._offset_path = os.path.join(log.directory, '%s.offset' % (name,))
+        self.offset = self._load_offset()
+
+    def _load_offset(self):
+        try:
+            with open(self._offset_path) as handle:
+                return int(handle.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def commit(self, offset):
+        tmp_path = self._offset_path + '.tmp'
+        with open(tmp_path, 'w') as handle:
+            handle.write('%d\n' % (offset,))
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_path, self._offset_path)
+        self.offset = offset
+
+    def replay(self, offset=0):
+        """
+        Rewind so the next poll re-delivers from `offset`
+        """
+        self.commit(offset)
+
+    def _failed(self, offset):
+        self.failures += 1
+        delay = min(self.retry_delay * 2 ** (self.failures - 1),
+                    self.max_retry_delay)
+        self._retry_at = time.monotonic() + delay
+        LOGGER.exception('Failed to deliver event at %d, retrying in %.1fs',
+                         offset, delay)
+
+    def poll(self, max_records=1000):
+        """
+        Dispatch up to `max_records` events, returning how many were
+        delivered.
+        """
+        if self._retry_at is not None and time.monotonic() < self._retry_at:
+            return 0
+        count = 0
+        committed = self.offset
+        for offset, next_offset, payload in self.log.read(self.offset):
+            try:
+                event = self.protocol.decode(payload)
+            except Exception:
+                LOGGER.exception('Skipping undecodable event at %d', offset)
+                committed = next_offset
+                continue
+            try:
+                self.dispatcher.dispatch(event)
+            except Exception:
+                self._failed(offset)
+                break
+            self.failures = 0
+            self._retry_at = None
+            committed = next_offset
+            count += 1
+            if count >= max_records:
+                break
+        if committed != self.offset:
+            self.commit(committed)
+        return count
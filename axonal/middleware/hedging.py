@@ -0,0 +1,250 @@
+"""
+Hedged requests and budgeted retries for idempotent methods.
+
+`HedgingDispatcher` spreads calls over several replicas. Calls to
+methods declared idempotent by the services (see
+`registry.register(idempotent=...)` and `registry.idempotent`) are sent
+to one replica, and if no reply
+arrives within a latency percentile of recent calls the same request
+is also sent to the next replica. The first reply wins and the others
+are cancelled. Failed attempts are retried with jittered exponential
+backoff. Every hedge and retry withdraws from a shared `RetryBudget`,
+so when a dependency is down retries stop instead of multiplying load.
+
+Other calls and events are sent once, to the first replica able to
+dispatch them.
+"""
+import itertools
+import logging
+import random
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from ..interface import Dispatcher
+from ..struct import Fault
+
+__all__ = ('HedgingDispatcher', 'RetryBudget', 'LatencyTracker')
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _registry_idempotent(request):
+    from ..registry import GlobalRegistry
+    target = request.context.target
+    return GlobalRegistry().is_idempotent(target.service, target.version,
+                                          target.method)
+
+
+class RetryBudget(object):
+    """
+    Each original request deposits `ratio` tokens, each retry or hedge
+    withdraws one. `min_per_second` tokens are added over time so that
+    low traffic can still retry.
+    """
+    __slots__ = ('ratio', 'min_per_second', 'max_tokens', '_tokens',
+                 '_updated', '_lock')
+
+    def __init__(self, ratio=0.1, min_per_second=10.0, max_tokens=100.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, extra):
+        now = time.monotonic()
+        refill = (now - self._updated) * self.min_per_second + extra
+        self._tokens = min(self.max_tokens, self._tokens + refill)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill(0.0)
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            return True
+
+
+class LatencyTracker(object):
+    """
+    Rolling window of call latencies, the percentile is recomputed
+    every `refresh` samples rather than on every call.
+    """
+    __slots__ = ('percentile', 'refresh', '_samples', '_count', '_value')
+
+    def __init__(self, percentile=95, window=1000, refresh=32):
+        self.percentile = percentile
+        self.refresh = refresh
+        self._samples = deque(maxlen=window)
+        self._count = 0
+        self._value = None
+
+    def record(self, seconds):
+        self._samples.append(seconds)
+        self._count += 1
+        if self._value is None or self._count % self.refresh == 0:
+            ordered = sorted(self._samples)
+            idx = int(len(ordered) * self.percentile / 100.0)
+            self._value = ordered[min(idx, len(ordered) - 1)]
+
+    @property
+    def value(self):
+        return self._value
+
+
+class HedgingDispatcher(Dispatcher):
+    """
+    :param replicas: dispatchers which can each serve the requests
+    :param idempotent: (service, method) pairs known to be idempotent,
+        a method of None covers every method of the service
+    :param is_idempotent: callable(request) -> bool replacing the
+        default, which checks `idempotent`, then replicas with their own
+        `is_idempotent(request)` such as a `ClusterBroker` relaying its
+        members' declarations, then the global registry for services
+        hosted in this process. Callers can't mark their own requests.
+    :param hedge_percentile: latency percentile after which to hedge
+    :param min_hedge_delay: never hedge sooner than this, in seconds
+    :param max_attempts: concurrent attempts in flight per call
+    :param max_retries: retries after every attempt in flight failed
+    """
+    RETRY_FAULTS = frozenset([Fault.INTERNAL_ERROR])
+
+    def __init__(self, replicas, is_idempotent=None, hedge_percentile=95,
+                 min_hedge_delay=0.005, max_attempts=2, max_retries=2,
+                 backoff=0.01, max_backoff=1.0, budget=None, executor=None,
+                 idempotent=()):
+        assert len(replicas)
+        self.replicas = list(replicas)
+        self.idempotent = frozenset(idempotent)
+        self.is_idempotent = is_idempotent or self._declared_idempotent
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_attempts = max_attempts
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget or RetryBudget()
+        self._closer = None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=8 * len(self.replicas))
+            self._closer = weakref.finalize(self, executor.shutdown, False)
+        self.executor = executor
+        self._latency = dict()
+        self._counter = itertools.count()
+
+    def close(self):
+        """
+        Shut down the executor, unless it was passed in
+        """
+        if self._closer is not None:
+            self._closer()
+
+    def _declared_idempotent(self, request):
+        target = request.context.target
+        if ((target.service, target.method) in self.idempotent or
+                (target.service, None) in self.idempotent):
+            return True
+        for replica in self.replicas:
+            check = getattr(replica, 'is_idempotent', None)
+            if check is not None and check(request):
+                return True
+        return _registry_idempotent(request)
+
+    def can_dispatch(self, request):
+        return any(replica.can_dispatch(request)
+                   for replica in self.replicas)
+
+    def _capable(self, request):
+        return [replica for replica in self.replicas
+                if replica.can_dispatch(request)]
+
+    def dispatch(self, request):
+        if request.is_event or not self.is_idempotent(request):
+            for replica in self.replicas:
+                if replica.can_dispatch(request):
+                    return replica.dispatch(request)
+            raise Fault(request.context, Fault.SERVICE_UNKNOWN)
+        replicas = self._capable(request)
+        if not replicas:
+            raise Fault(request.context, Fault.SERVICE_UNKNOWN)
+        self.budget.deposit()
+        offset = next(self._counter)
+        retries = 0
+        while True:
+            try:
+                return self._race(request, replicas, offset)
+            except Exception as ex:
+                if not self._retryable(ex) or retries >= self.max_retries:
+                    raise
+                if not self.budget.withdraw():
+                    LOGGER.debug('Retry budget exhausted')
+                    raise
+            retries += 1
+            offset += 1
+            ceiling = min(self.max_backoff, self.backoff * (2 ** retries))
+            time.sleep(random.uniform(0, ceiling))
+
+    def _retryable(self, ex):
+        if isinstance(ex, Fault):
+            return ex.code in self.RETRY_FAULTS
+        return isinstance(ex, Exception)
+
+    def _tracker(self, request):
+        target = request.context.target
+        key = (target.service, target.version, target.method)
+        tracker = self._latency.get(key)
+        if tracker is None:
+            tracker = self._latency[key] = LatencyTracker(
+                self.hedge_percentile)
+        return tracker
+
+    def _race(self, request, replicas, offset):
+        """
+        Run one attempt, adding hedged attempts on other replicas while
+        it is slow. Returns the first successful response.
+        """
+        tracker = self._tracker(request)
+        delay = tracker.value
+        if delay is not None:
+            delay = max(delay, self.min_hedge_delay)
+        limit = min(self.max_attempts, len(replicas))
+        started = dict()
+        pending = set()
+        error = None
+
+        def _launch():
+            replica = replicas[(offset + len(started)) % len(replicas)]
+            future = self.executor.submit(replica.dispatch, request)
+            started[future] = time.monotonic()
+            pending.add(future)
+        _launch()
+        while pending:
+            hedging = delay is not None and len(started) < limit
+            done, _ = wait(pending, delay if hedging else None,
+                           FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                try:
+                    result = future.result()
+                except Exception as ex:
+                    error = ex
+                    continue
+                tracker.record(time.monotonic() - started[future])
+                for loser in pending:
+                    loser.cancel()
+                return result
+            if not done and hedging:
+                if self.budget.withdraw():
+                    _launch()
+                else:
+                    delay = None
+        raise error
@@ -0,0 +1,129 @@
+"""
+Transport posting internal protocol messages to a remote RpcHttpApp.
+
+    dispatcher = ProtocolTransportDispatcher(
+        JsonInternalProtocol(), HttpTransport('http://10.0.0.2:8080'))
+
+Messages go to the app's /rpc endpoint. Each thread keeps its own
+keep-alive connection per transport. When a kept-alive connection turns
+out to be closed the message is sent again on a new one, but only if it
+failed before it was fully sent or its method is idempotent, so a call
+is never run twice.
+"""
+import http.client
+import struct
+import threading
+from urllib.parse import urlsplit
+
+from ..interface import Transport
+from ..proto import CONTENT_TYPES, FRAMES_TYPE, TARGET_HEADER
+from ..proto.internal import Segments
+from ..struct import Fault, TransportFault
+
+__all__ = ('HttpTransport',)
+
+_FRAME_LENGTH = struct.Struct('!I')
+
+
+def _read_frames(conn, resp):
+    try:
+        while True:
+            head = resp.read(_FRAME_LENGTH.size)
+            if len(head) < _FRAME_LENGTH.size:
+                return
+            (length,) = _FRAME_LENGTH.unpack(head)
+            yield resp.read(length)
+    finally:
+        resp.close()
+        conn.close()
+
+
+class HttpTransport(Transport):
+    """
+    :param endpoint: base URL of the remote app, e.g. http://host:8080
+    :param protocol: name of the internal protocol the dispatcher uses
+    :param idempotent: callable(service, method) saying whether a call
+        that may already have run can be sent again
+    """
+    def __init__(self, endpoint, protocol='json', timeout=30.0,
+                 idempotent=None):
+        parts = urlsplit(endpoint)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Not an HTTP endpoint: %s' % (endpoint,))
+        self.endpoint = endpoint
+        self.content_type = CONTENT_TYPES[protocol]
+        self.timeout = timeout
+        self.idempotent = idempotent
+        self._scheme = parts.scheme
+        self._netloc = parts.netloc
+        self._path = parts.path.rstrip('/') + '/rpc'
+        self._local = threading.local()
+
+    def __repr__(self):
+        return '<HttpTransport %s>' % (self.endpoint,)
+
+    def can_transport(self, request):
+        return request is not None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._scheme == 'https':
+                conn_cls = http.client.HTTPSConnection
+            else:
+                conn_cls = http.client.HTTPConnection
+            conn = self._local.conn = conn_cls(self._netloc,
+                                               timeout=self.timeout)
+        return conn
+
+    def _is_idempotent(self, target):
+        if self.idempotent is None:
+            return False
+        return self.idempotent(target.service, target.method)
+
+    def _post(self, context, data):
+        if isinstance(data, Segments):
+            data = data.pack()
+        elif isinstance(data, str):
+            data = data.encode('utf-8')
+        target = context.target
+        headers = {'Content-Type': self.content_type,
+                   TARGET_HEADER: '%s/%s' % (target.service, target.method)}
+        for attempt in (0, 1):
+            reused = getattr(self._local, 'conn', None) is not None
+            conn = self._connection()
+            sent = False
+            try:
+                conn.request('POST', self._path, body=data, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+                break
+            except (http.client.HTTPException, OSError) as ex:
+                conn.close()
+                self._local.conn = None
+                # A kept-alive connection closed by the server. Retry once
+                # if the server can't have run the call: it was never
+                # fully sent, or running it twice is harmless.
+                if attempt or not reused or (
+                        sent and not self._is_idempotent(target)):
+                    raise TransportFault(context, Fault.INTERNAL_ERROR,
+                                         str(ex), inner=ex)
+        if resp.status >= 300:
+            body = resp.read()
+            # Server errors are the member's, not the request's, fault
+            fault_cls = TransportFault if resp.status >= 500 else Fault
+            raise fault_cls(context, Fault.INTERNAL_ERROR, 'HTTP %d: %s' % (
+                resp.status, body[:200].decode('utf-8', 'replace')))
+        return conn, resp
+
+    def send_request(self, context, data):
+        conn, resp = self._post(context, data)
+        if resp.getheader('Content-Type', '').startswith(FRAMES_TYPE):
+            # The connection is busy until the stream has been read
+            self._local.conn = None
+            return _read_frames(conn, resp)
+        return resp.read()
+
+    def send_event(self, context, data):
+        _, resp = self._post(context, data)
+        resp.read()
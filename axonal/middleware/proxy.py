@@ -1,20 +1,71 @@
-from uuid import uuid4
-from ..struct import Request, Context, Target
+import copy
+from functools import partial
+
+from ..struct import Request, Context, Fault, StreamResponse, intern_target
+from ..utils import next_guid
+
+__all__ = ('ProxyMethod', 'ServiceProxy', 'AsyncProxyMethod',
+           'AsyncServiceProxy', 'gather', 'scatter')
+
+# Method names may come from clients, cached methods are capped
+_METHODS_MAX = 256
 
 
 class ProxyMethod(object):
+    __slots__ = ('broker', 'target', 'auth', 'meta')
+
     def __init__(self, broker, target, auth=None, meta=None):
         self.broker = broker
         self.target = target
         self.auth = auth
         self.meta = meta
 
+    def with_auth(self, auth):
+        """
+        A copy of the method whose calls carry `auth` in their context
+        """
+        method = copy.copy(self)
+        method.auth = auth
+        return method
+
+    def _request(self, arg, kwa):
+        ctx = Context(self.target, next_guid(), self.auth, self.meta)
+        return Request(ctx, arg or kwa)
+
     def __call__(self, *arg, **kwa):
-        guid = str(uuid4())
-        ctx = Context(self.target, guid, self.auth, self.meta)
-        args = arg if len(arg) else kwa
-        request = Request(ctx, args)
-        return self.broker.dispatch(request).data
+        return self.broker.dispatch(self._request(arg, kwa)).data
+
+    def stream(self, *arg, **kwa):
+        """
+        Call the method and iterate over the results, items of a streamed
+        response are fetched one at a time as the iterator is advanced.
+        """
+        response = self.broker.dispatch(self._request(arg, kwa))
+        if isinstance(response, StreamResponse):
+            return iter(response.data)
+        if isinstance(response.data, (list, tuple)):
+            return iter(response.data)
+        return iter([response.data])
+
+
+class AsyncProxyMethod(ProxyMethod):
+    """
+    Calling the method returns an awaitable, the blocking dispatch
+    is run in an executor so the event loop is never held up.
+    """
+    __slots__ = ('executor',)
+
+    def __init__(self, broker, target, auth=None, meta=None, executor=None):
+        super().__init__(broker, target, auth, meta)
+        self.executor = executor
+
+    async def __call__(self, *arg, **kwa):
+        import asyncio
+        request = self._request(arg, kwa)
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(
+            self.executor, self.broker.dispatch, request)
+        return response.data
 
 
 class ServiceProxy(object):
@@ -29,12 +80,77 @@ class ServiceProxy(object):
         self._meta = meta
         self._methods = dict()
 
+    def _make_method(self, target):
+        return ProxyMethod(self._broker, target, self._auth, self._meta)
+
     def __getattr__(self, key):
         if key[0] == '_':
             raise AttributeError()
-        if key in self._methods:
-            return self._methods[key]
-        target = Target(self._service, self._version, key)
-        method = ProxyMethod(self._broker, target, self._auth, self._meta)
-        self._methods[key] = method
+        method = self._methods.get(key)
+        if method is None:
+            if len(self._methods) >= _METHODS_MAX:
+                self._methods.clear()
+            target = intern_target(self._service, self._version, key)
+            method = self._methods[key] = self._make_method(target)
         return method
+
+
+class AsyncServiceProxy(ServiceProxy):
+    """
+    ServiceProxy whose methods return awaitables, for use with
+    `gather` and `scatter` to call many services concurrently.
+    """
+    __slots__ = ('_executor',)
+
+    def __init__(self, broker, service, version, auth=None, meta=None,
+                 executor=None):
+        super().__init__(broker, service, version, auth, meta)
+        self._executor = executor
+
+    def _make_method(self, target):
+        return AsyncProxyMethod(self._broker, target, self._auth, self._meta,
+                                self._executor)
+
+
+def _as_fault(ex):
+    if isinstance(ex, Fault):
+        return ex
+    return Fault(None, Fault.INTERNAL_ERROR, inner=ex)
+
+
+async def gather(calls, limit=None):
+    """
+    Run many calls concurrently, at most `limit` at once.
+
+    :param calls: callables returning awaitables, e.g.
+                  `partial(proxy.method, arg)`
+    :returns: list of results in call order, failed calls are
+              returned as a `Fault` rather than raised
+    """
+    import asyncio
+    calls = list(calls)
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def _run(call):
+        try:
+            if semaphore is None:
+                return await call()
+            async with semaphore:
+                return await call()
+        except Exception as ex:
+            return _as_fault(ex)
+    return await asyncio.gather(*[_run(call) for call in calls])
+
+
+async def scatter(method, arg_sets, limit=None):
+    """
+    Call one method once per argument set, a tuple or list is passed
+    positionally and a dict as keyword arguments.
+    """
+    calls = []
+    for args in arg_sets:
+        if isinstance(args, dict):
+            calls.append(partial(method, **args))
+        else:
+            calls.append(partial(method, *args))
+    return await gather(calls, limit)
@@ -0,0 +1,250 @@
+"""
+Priority and weighted fair scheduling of requests across tenants.
+
+`SchedulingDispatcher` sits in front of another dispatcher with a fixed
+pool of worker threads. Requests are queued by priority class, taken
+from `Context.meta['priority']`, and within a class served in weighted
+fair order across tenants, identified by `Context.auth`, so one busy
+tenant cannot crowd out the others. Requests waiting longer than
+`max_wait` are run next whatever their class, so batch traffic is
+delayed but never starved. Optional per-tenant token buckets reject
+excess requests with `Fault.RATE_LIMITED`.
+
+Each queued request sits in both the FIFO and its class's heap, the
+copy left behind when it's taken from one is skipped lazily and the
+queues are compacted once these stale entries outnumber live ones.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from ..interface import Dispatcher
+from ..struct import Fault
+
+__all__ = ('SchedulingDispatcher', 'TokenBucket')
+
+LOGGER = logging.getLogger(__name__)
+
+PRIORITY_CLASSES = ('interactive', 'default', 'batch')
+
+
+class TokenBucket(object):
+    __slots__ = ('rate', 'burst', '_tokens', '_updated', '_lock')
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, tokens=1.0):
+        with self._lock:
+            now = time.monotonic()
+            refill = (now - self._updated) * self.rate
+            self._tokens = min(self.burst, self._tokens + refill)
+            self._updated = now
+            if self._tokens < tokens:
+                return False
+            self._tokens -= tokens
+            return True
+
+
+class _Item(object):
+    __slots__ = ('request', 'future', 'enqueued', 'taken')
+
+    def __init__(self, request):
+        self.request = request
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.taken = False
+
+
+def _tenant(context):
+    auth = context.auth
+    try:
+        hash(auth)
+    except TypeError:
+        return repr(auth)
+    return auth
+
+
+class SchedulingDispatcher(Dispatcher):
+    """
+    :param dispatcher: where requests are run
+    :param workers: size of the worker pool
+    :param classes: priority class names, highest priority first
+    :param weights: tenant -> weight, share of the workers under load
+    :param rate_limits: tenant -> (requests per second, burst)
+    :param default_rate: (requests per second, burst) for other tenants
+    :param max_wait: seconds before a queued request jumps the classes
+    :param max_queue: queued requests before rejecting new ones
+    """
+    def __init__(self, dispatcher, workers=8, classes=PRIORITY_CLASSES,
+                 default_class='default', weights=None, default_weight=1.0,
+                 rate_limits=None, default_rate=None, max_wait=1.0,
+                 max_queue=10000):
+        assert default_class in classes
+        self.dispatcher = dispatcher
+        self.classes = tuple(classes)
+        self.default_class = default_class
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        self.rate_limits = dict(rate_limits or {})
+        self.default_rate = default_rate
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._class_index = {name: idx for idx, name in enumerate(classes)}
+        self._heaps = [[] for _ in classes]
+        self._vtime = [0.0 for _ in classes]
+        self._finish = [dict() for _ in classes]
+        self._fifo = deque()
+        self._buckets = dict()
+        self._queued = 0
+        self._stale = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._workers = []
+        for num in range(workers):
+            worker = threading.Thread(target=self._work,
+                                      name='axonal-scheduler-%d' % (num,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _priority(self, context):
+        meta = context.meta
+        name = meta.get('priority') if isinstance(meta, dict) else None
+        if name not in self._class_index:
+            name = self.default_class
+        return self._class_index[name]
+
+    def _bucket(self, tenant):
+        bucket = self._buckets.get(tenant)
+        if bucket is None:
+            limit = self.rate_limits.get(tenant, self.default_rate)
+            if limit is None:
+                return None
+            bucket = self._buckets.setdefault(tenant, TokenBucket(*limit))
+        return bucket
+
+    def can_dispatch(self, request):
+        return self.dispatcher.can_dispatch(request)
+
+    def submit(self, request):
+        """
+        Queue a request, returning a Future of its result
+        """
+        context = request.context
+        tenant = _tenant(context)
+        bucket = self._bucket(tenant)
+        if bucket is not None and not bucket.take():
+            raise Fault(context, Fault.RATE_LIMITED)
+        item = _Item(request)
+        cls = self._priority(context)
+        weight = self.weights.get(tenant, self.default_weight)
+        with self._cond:
+            if self._stopped:
+                raise Fault(context, Fault.INTERNAL_ERROR,
+                            'Scheduler closed')
+            if self._queued >= self.max_queue:
+                raise Fault(context, Fault.RATE_LIMITED, 'Queue full')
+            finish = self._finish[cls]
+            start = max(self._vtime[cls], finish.get(tenant, 0.0))
+            tag = start + 1.0 / weight
+            finish[tenant] = tag
+            heapq.heappush(self._heaps[cls], (tag, next(self._seq), item))
+            self._fifo.append(item)
+            self._queued += 1
+            self._cond.notify()
+        return item.future
+
+    def dispatch(self, request):
+        return self.submit(request).result()
+
+    def _take(self):
+        """
+        Next item to run, the caller holds the condition
+        """
+        if self._stale > max(64, self._queued):
+            self._compact()
+        fifo = self._fifo
+        while fifo and fifo[0].taken:
+            fifo.popleft()
+            self._stale -= 1
+        if fifo and fifo[0].enqueued + self.max_wait <= time.monotonic():
+            item = fifo.popleft()
+            return self._taken(item)
+        for cls, heap in enumerate(self._heaps):
+            while heap:
+                tag, _, item = heapq.heappop(heap)
+                if item.taken:
+                    self._stale -= 1
+                    continue
+                self._vtime[cls] = tag
+                if not heap:
+                    # Idle class, forget finish tags so they don't grow
+                    self._finish[cls].clear()
+                return self._taken(item)
+        return None
+
+    def _taken(self, item):
+        # Its entry in the other queue is now stale
+        item.taken = True
+        self._stale += 1
+        return item
+
+    def _compact(self):
+        """
+        Drop the entries of taken items, the caller holds the condition
+        """
+        self._fifo = deque(item for item in self._fifo if not item.taken)
+        for cls, heap in enumerate(self._heaps):
+            heap = [entry for entry in heap if not entry[2].taken]
+            heapq.heapify(heap)
+            self._heaps[cls] = heap
+        self._stale = 0
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queued and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                item = self._take()
+                self._queued -= 1
+            if not item.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self.dispatcher.dispatch(item.request)
+                item.future.set_result(result)
+            except BaseException as ex:
+                item.future.set_exception(ex)
+
+    def close(self):
+        """
+        Stop the workers once their current requests finish, requests
+        still queued fail with `Fault.INTERNAL_ERROR`.
+        """
+        with self._cond:
+            self._stopped = True
+            pending = [item for item in self._fifo if not item.taken]
+            for item in pending:
+                item.taken = True
+            self._fifo.clear()
+            self._heaps = [[] for _ in self.classes]
+            self._queued = self._stale = 0
+            self._cond.notify_all()
+        for item in pending:
+            if item.future.set_running_or_notify_cancel():
+                item.future.set_exception(Fault(
+                    item.request.context, Fault.INTERNAL_ERROR,
+                    'Scheduler closed'))
+        for worker in self._workers:
+            worker.join()
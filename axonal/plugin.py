@@ -1,6 +1,5 @@
 import argparse
 import logging
-import logging.config
 import os
 import sys
 from fcntl import flock, LOCK_EX, LOCK_UN, LOCK_NB
@@ -64,6 +63,13 @@ class Plugin(object):
         """
         pass
 
+    def warm_up(self):
+        """
+        Import and instantiate anything expensive after configuration,
+        before the plugin starts serving or forks workers.
+        """
+        pass
+
     def run(self):
         """
         Invoke whichever action the plugin needs to perform.
@@ -89,6 +95,15 @@ def str_to_class(module_name, class_name):
     return class_ or None
 
 
+def preload(module_names):
+    """
+    Import modules ahead of time so forked children inherit them
+    """
+    import importlib
+    for name in module_names:
+        importlib.import_module(name)
+
+
 def _modname(cls, full=False):
     """
     Full module name, avoids using '__main__' unless necessary
@@ -118,10 +133,13 @@ class Host(Plugin):
     hosting services as system process.
 
       * Command line parsing
-      * Logging configuration
+      * Logging configuration, written from a background thread
       * Pid file management
+      * On-demand profiling via signals
+      * Hot reload of changed service modules on SIGHUP
     """
-    __slots__ = ('_plugin', '_options', '_pidfile', '_log')
+    __slots__ = ('_plugin', '_options', '_pidfile', '_log', '_profiler',
+                 '_log_listener', '_reloader')
 
     def __init__(self, plugin_obj):
         assert plugin_obj is not None
@@ -130,6 +148,9 @@ class Host(Plugin):
         self._pidfile = None
         self._plugin = plugin_obj
         self._options = None
+        self._profiler = None
+        self._log_listener = None
+        self._reloader = None
 
     def options(self, parser, env):
         """
@@ -145,24 +166,63 @@ class Host(Plugin):
             '-L', '--log-config', metavar="filename", dest='logconfig',
             default=env.get('LOGGING_CONF'),
             type=argparse.FileType('r'), help='Logging configuration file')
+        parser.add_argument(
+            '--log-queue', dest='log_queue', metavar="size", type=int,
+            default=int(env.get('AXONAL_LOG_QUEUE', 10000)),
+            help='Records queued for the logging thread, 0 logs inline')
+        parser.add_argument(
+            '--log-drop', dest='log_drop', choices=('new', 'old'),
+            default='new', help='Records dropped when the log queue is full')
+        parser.add_argument(
+            '--log-burst', dest='log_burst', metavar="count", type=int,
+            default=20, help='Records per second from one call site, '
+                             '0 for no limit')
         parser.add_argument(
             '-P', '--pid', dest='pidfile', metavar="filename", nargs='?')
+        parser.add_argument(
+            '--profile', dest='profile', action='store_true',
+            default=bool(env.get('AXONAL_PROFILE')),
+            help='Toggle profiling with SIGUSR1, dump stats with SIGUSR2')
+        parser.add_argument(
+            '--profile-dir', dest='profile_dir', metavar="directory",
+            default=env.get('AXONAL_PROFILE_DIR'),
+            help='Directory for profile dumps')
+        parser.add_argument(
+            '--hot-reload', dest='hot_reload', action='store_true',
+            help='Reload changed service modules on SIGHUP')
+        parser.add_argument(
+            '--reload-lock', dest='reload_lock', metavar="filename",
+            default=env.get('AXONAL_RELOAD_LOCK'),
+            help='Lock file so workers sharing it reload one at a time')
+        parser.add_argument(
+            '--preload', dest='preload', metavar="module", action='append',
+            default=[], help='Import module before running, repeatable')
         self._plugin.options(parser, env)
 
     def configure(self, options, conf):
         assert options is not None
         self._options = options
+        from .logqueue import install_record_factory
+        install_record_factory()
         if options.logconfig:
+            import logging.config
             logging.config.fileConfig(options.logconfig)
             self._log = logging.getLogger(_fullname(self._plugin))
+        self._setup_log_queue(options)
         try:
             from setproctitle import setproctitle
             setproctitle(options.name)
         except ImportError:
             self._log.warning("Process name unchanged")
         self._setup_pidfile(options)
+        self._setup_profiler(options)
+        self._setup_reload(options)
+        preload(getattr(options, 'preload', None) or ())
         if self._plugin:
             self._plugin.configure(options, conf)
+            warm_up = getattr(self._plugin, 'warm_up', None)
+            if warm_up is not None:
+                warm_up()
 
     def _delpid(self):
         """
@@ -195,6 +255,61 @@ class Host(Plugin):
             pidfile.flush()
             self._pidfile = pidfile
 
+    def _setup_log_queue(self, options):
+        """
+        Move the configured log handlers to a background thread so
+        logging never blocks the event loop or dispatch threads. On by
+        default, records over the queue size or a call site's burst are
+        dropped rather than waited for; `--log-queue 0` logs inline.
+        """
+        size = getattr(options, 'log_queue', 0)
+        if size > 0:
+            from .logqueue import install
+            self._log_listener = install(size, options.log_drop,
+                                         options.log_burst)
+
+    def _stop_log_queue(self):
+        listener = self._log_listener
+        if listener is not None:
+            self._log_listener = None
+            listener.stop()
+
+    def _setup_profiler(self, options):
+        """
+        Install the profiling signal handlers, the profiler its self
+        isn't created until the first signal arrives.
+        """
+        if getattr(options, 'profile', False):
+            from .profiler import SignalProfiler
+            self._profiler = SignalProfiler(options.profile_dir)
+            self._profiler.install()
+            self._log.info('Profiling signals installed (%d)', os.getpid())
+
+    def _setup_reload(self, options):
+        """
+        Reload from a thread, SIGHUP may arrive in the middle of an
+        import on the main thread.
+        """
+        if getattr(options, 'hot_reload', False):
+            import signal
+            import threading
+            from .reload import Reloader
+            self._reloader = Reloader(lock_path=options.reload_lock)
+
+            def _on_sighup(signum, frame):
+                thread = threading.Thread(target=self._reload,
+                                          name='axonal-reload')
+                thread.daemon = True
+                thread.start()
+            signal.signal(signal.SIGHUP, _on_sighup)
+            self._log.info('Reload on SIGHUP installed (%d)', os.getpid())
+
+    def _reload(self):
+        try:
+            self._reloader.reload()
+        except Exception:
+            self._log.exception('Reload failed')
+
     def run(self):
         return self._plugin.run()
 
@@ -219,6 +334,7 @@ class Host(Plugin):
         except SystemExit:
             pass
         self._delpid()
+        self._stop_log_queue()
         return retval
 
 
@@ -244,7 +360,7 @@ class Loader(Plugin):
 
     def options(self, parser, env):
         parser.add_argument('mod_name', metavar='name',
-                            nargs=1, help="Full module path")
+                            nargs=1, help="Full module path or server name")
         parser.add_argument('args', nargs=argparse.REMAINDER,
                             help="Command-line arguments")
 
@@ -253,7 +369,12 @@ class Loader(Plugin):
             raise RuntimeError('No mod name specified!')
         assert len(options.mod_name)
         import inspect
+        from .server import SERVERS
         name = options.mod_name[0]
+        if name in SERVERS:
+            self._plugin = SERVERS.get(name)()
+            self._args = options.args
+            return
         parts = name.split('.')
         if len(parts) < 2:
             raise RuntimeError('Must specify class name')
@@ -0,0 +1,170 @@
+"""
+On-demand profiling of a running process.
+
+The profiler is toggled and dumped by signals so a live worker can be
+inspected without restarting it, nothing is imported or hooked until
+profiling is first switched on:
+
+    kill -USR1 <pid>    # start profiling
+    kill -USR1 <pid>    # stop profiling
+    kill -USR2 <pid>    # write axonal-<pid>.prof and axonal-<pid>.txt
+"""
+import logging
+import os
+import signal
+import sys
+
+__all__ = ('SignalProfiler',)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _code_key(func):
+    """
+    Key used by `pstats` to identify a function
+    """
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return None
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def _service_methods(registry):
+    """
+    Maps pstats function keys to their (service, method) name for every
+    method of every class in the registry.
+    """
+    mapping = dict()
+    for cls in list(registry.classes):
+        service = getattr(cls, '_service_name', cls.__name__)
+        for name in dir(cls):
+            if name[0] == '_':
+                continue
+            key = _code_key(getattr(cls, name, None))
+            if key is not None:
+                mapping[key] = (service, name)
+    return mapping
+
+
+class SignalProfiler(object):
+    """
+    Wraps `cProfile` so it can be started, stopped and dumped from signal
+    handlers. From Python 3.12 cProfile records every thread, including
+    the executor threads dispatching for `offload`, /ws and /rpc. Before
+    3.12 it only records the thread receiving the signal, the main
+    thread running the event loop.
+    """
+    __slots__ = ('_profile', '_active', '_directory', '_registry', '_top')
+
+    def __init__(self, directory=None, registry=None, top=20):
+        self._profile = None
+        self._active = False
+        self._directory = directory or os.getcwd()
+        self._registry = registry
+        self._top = top
+
+    @property
+    def active(self):
+        return self._active
+
+    def install(self, toggle_signal=signal.SIGUSR1,
+                dump_signal=signal.SIGUSR2):
+        signal.signal(toggle_signal, self._on_toggle)
+        signal.signal(dump_signal, self._on_dump)
+
+    def _on_toggle(self, signum, frame):
+        self.toggle()
+
+    def _on_dump(self, signum, frame):
+        try:
+            self.dump()
+        except Exception:
+            LOGGER.exception('Failed to dump profile')
+
+    def toggle(self):
+        if self._active:
+            self.stop()
+        else:
+            self.start()
+        return self._active
+
+    def start(self):
+        if self._active:
+            return
+        if self._profile is None:
+            import cProfile
+            self._profile = cProfile.Profile()
+        self._profile.enable()
+        self._active = True
+        LOGGER.info('Profiling started (%d)', os.getpid())
+        if sys.version_info < (3, 12):
+            LOGGER.warning('Only the main thread is profiled before '
+                           'Python 3.12')
+
+    def stop(self):
+        if not self._active:
+            return
+        self._profile.disable()
+        self._active = False
+        LOGGER.info('Profiling stopped (%d)', os.getpid())
+
+    def _path(self, ext):
+        return os.path.join(self._directory,
+                            'axonal-%d.%s' % (os.getpid(), ext))
+
+    def hot_methods(self, stats):
+        """
+        Summarise time spent in registered service methods, grouped
+        by service and sorted by cumulative time.
+
+        :returns: dict of service name -> [(method, calls, tottime, cumtime)]
+        """
+        registry = self._registry
+        if registry is None:
+            from .registry import GlobalRegistry
+            registry = GlobalRegistry()
+        methods = _service_methods(registry)
+        summary = dict()
+        for key, (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            found = methods.get(key)
+            if found is None:
+                continue
+            service, method = found
+            summary.setdefault(service, []).append(
+                (method, ncalls, tottime, cumtime))
+        for entries in summary.values():
+            entries.sort(key=lambda entry: entry[3], reverse=True)
+        return summary
+
+    def dump(self):
+        """
+        Write the raw stats and a per-service summary named after the pid.
+
+        :returns: (stats path, summary path) or None if nothing collected
+        """
+        if self._profile is None:
+            LOGGER.warning('Nothing to dump, profiling was never started')
+            return None
+        import pstats
+        was_active = self._active
+        if was_active:
+            self._profile.disable()
+        try:
+            stats_path = self._path('prof')
+            summary_path = self._path('txt')
+            self._profile.dump_stats(stats_path)
+            with open(summary_path, 'w') as handle:
+                stats = pstats.Stats(self._profile, stream=handle)
+                hot = self.hot_methods(stats)
+                for service, entries in sorted(hot.items()):
+                    handle.write('%s\n' % (service,))
+                    for method, ncalls, tottime, cumtime in entries:
+                        handle.write('  %-30s %8d %10.6f %10.6f\n' % (
+                            method, ncalls, tottime, cumtime))
+                handle.write('\n')
+                stats.sort_stats('cumulative').print_stats(self._top)
+        finally:
+            if was_active:
+                self._profile.enable()
+        LOGGER.info('Profile written: %s', stats_path)
+        return stats_path, summary_path
@@ -0,0 +1,27 @@
+from ..utils import LazyRegistry
+
+__all__ = ('PROTOCOLS', 'CONTENT_TYPES', 'FRAMES_TYPE', 'TARGET_HEADER',
+           'get_protocol')
+
+PROTOCOLS = LazyRegistry('protocol', {
+    'json': 'axonal.proto.internal.JsonInternalProtocol',
+    'pickle': 'axonal.proto.internal.PickleInternalProtocol',
+    'msgpack': 'axonal.proto.internal.MsgpackInternalProtocol',
+})
+
+# Internal protocol messages carried over HTTP, pickle never is
+CONTENT_TYPES = {
+    'json': 'application/x-axonal-json',
+    'msgpack': 'application/x-axonal-msgpack',
+}
+# Streamed responses over HTTP, each frame prefixed by its 4 byte length
+FRAMES_TYPE = 'application/x-axonal-frames'
+# 'service/method' of a posted message, so limits apply before reading it
+TARGET_HEADER = 'X-Axonal-Target'
+
+
+def get_protocol(name, *args, **kwa):
+    """
+    Construct a protocol by its registered name, e.g. 'json'
+    """
+    return PROTOCOLS.get(name)(*args, **kwa)
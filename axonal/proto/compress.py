@@ -0,0 +1,205 @@
+"""
+Transparent compression of encoded messages.
+
+`CompressedProtocol` wraps another protocol, any encoded message of at
+least `threshold` bytes is compressed and prefixed with a small header
+naming the codec. Receivers detect the header and decompress, messages
+without it are passed to the inner protocol untouched, so compressing
+and plain peers can be mixed.
+
+    proto = CompressedProtocol(JsonInternalProtocol(), 'zlib', 16384)
+"""
+import time
+
+from ..interface import Protocol
+from ..struct import Fault
+from .internal import Segments
+
+__all__ = ('CompressedProtocol', 'CompressionStats', 'CODECS')
+
+MAGIC = b'\xa7Z'
+
+
+class ZlibCodec(object):
+    ident = 1
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        import zlib
+        self._zlib = zlib
+        self.level = level
+
+    def compress(self, data):
+        return self._zlib.compress(data, self.level)
+
+    def decompress(self, data, max_size):
+        decomp = self._zlib.decompressobj()
+        out = decomp.decompress(data, max_size + 1)
+        if len(out) > max_size or decomp.unconsumed_tail:
+            raise ValueError('Decompressed size exceeds limit')
+        if not decomp.eof:
+            raise ValueError('Truncated zlib stream')
+        return out
+
+
+class Lz4Codec(object):
+    ident = 2
+    name = 'lz4'
+
+    def __init__(self, level=0):
+        import lz4.frame
+        self._lz4 = lz4.frame
+        self.level = level
+
+    def compress(self, data):
+        return self._lz4.compress(data, compression_level=self.level)
+
+    def decompress(self, data, max_size):
+        # Stop at the limit rather than inflating the whole frame first
+        decomp = self._lz4.LZ4FrameDecompressor()
+        out = decomp.decompress(data, max_length=max_size + 1)
+        if len(out) > max_size:
+            raise ValueError('Decompressed size exceeds limit')
+        if not decomp.eof:
+            raise ValueError('Truncated lz4 frame')
+        return out
+
+
+class ZstdCodec(object):
+    ident = 3
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        import zstandard
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self.level = level
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data, max_size):
+        # max_output_size is ignored when the frame declares its size
+        with self._decompressor.stream_reader(data) as reader:
+            out = reader.read(max_size + 1)
+        if len(out) > max_size:
+            raise ValueError('Decompressed size exceeds limit')
+        return out
+
+
+CODECS = {codec.name: codec for codec in (ZlibCodec, Lz4Codec, ZstdCodec)}
+_CODEC_IDS = {codec.ident: codec for codec in CODECS.values()}
+
+
+class CompressionStats(object):
+    """
+    Running totals of messages compressed by a protocol, used to
+    tune the threshold from real traffic. `messages` and `seconds`
+    include the `skipped` messages which didn't shrink and were sent
+    as-is, `compressed_bytes` counts those at their raw size.
+    """
+    __slots__ = ('messages', 'skipped', 'raw_bytes', 'compressed_bytes',
+                 'seconds')
+
+    def __init__(self):
+        self.messages = 0
+        self.skipped = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def ratio(self):
+        if not self.compressed_bytes:
+            return None
+        return self.raw_bytes / self.compressed_bytes
+
+    def record(self, raw_size, compressed_size, seconds, skipped=False):
+        self.messages += 1
+        self.raw_bytes += raw_size
+        self.seconds += seconds
+        if skipped:
+            self.skipped += 1
+            self.compressed_bytes += raw_size
+        else:
+            self.compressed_bytes += compressed_size
+
+    def to_dict(self):
+        return {'messages': self.messages, 'skipped': self.skipped,
+                'raw_bytes': self.raw_bytes,
+                'compressed_bytes': self.compressed_bytes,
+                'seconds': self.seconds, 'ratio': self.ratio}
+
+
+class CompressedProtocol(Protocol):
+    """
+    :param protocol: inner protocol producing the encoded messages
+    :param codec: name from CODECS, e.g. 'zlib', 'lz4' or 'zstd'
+    :param threshold: messages smaller than this are sent as-is
+    :param on_message: called with (codec name, raw size, compressed
+                       size, seconds) for each message compressed, also
+                       when it didn't shrink and was sent as-is
+    :param max_size: largest decompressed message accepted
+    """
+    def __init__(self, protocol, codec='zlib', threshold=16384, level=None,
+                 on_message=None, max_size=64 * 1024 * 1024):
+        assert isinstance(protocol, Protocol)
+        codec_cls = CODECS[codec]
+        self.protocol = protocol
+        self.codec = codec_cls() if level is None else codec_cls(level)
+        self.threshold = threshold
+        self.on_message = on_message
+        self.max_size = max_size
+        self.stats = CompressionStats()
+        self._header = MAGIC + bytes([codec_cls.ident])
+        self._codecs = {codec_cls.ident: self.codec}
+
+    def _compress(self, data):
+        if isinstance(data, Segments):
+            # Out-of-band buffers are binary, usually incompressible
+            return data
+        raw = data.encode('utf-8') if isinstance(data, str) else data
+        if len(raw) < self.threshold:
+            return data
+        started = time.perf_counter()
+        compressed = self.codec.compress(raw)
+        seconds = time.perf_counter() - started
+        skipped = len(compressed) + len(self._header) >= len(raw)
+        self.stats.record(len(raw), len(compressed), seconds, skipped)
+        if self.on_message is not None:
+            self.on_message(self.codec.name, len(raw), len(compressed),
+                            seconds)
+        if skipped:
+            return data
+        return self._header + compressed
+
+    def _decompress(self, data):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            return data
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            return data
+        ident = data[len(MAGIC)]
+        codec = self._codecs.get(ident)
+        if codec is None:
+            codec_cls = _CODEC_IDS.get(ident)
+            if codec_cls is None:
+                raise Fault(None, Fault.PARSE_ERROR, 'Unknown codec')
+            codec = self._codecs[ident] = codec_cls()
+        try:
+            return codec.decompress(data[len(self._header):], self.max_size)
+        except Exception as ex:
+            raise Fault(None, Fault.PARSE_ERROR, 'Decompress', inner=ex)
+
+    def encode(self, obj):
+        return self._compress(self.protocol.encode(obj))
+
+    def decode(self, data):
+        return self.protocol.decode(self._decompress(data))
+
+    def encode_stream(self, response):
+        for frame in self.protocol.encode_stream(response):
+            yield self._compress(frame)
+
+    def decode_stream(self, frames):
+        return self.protocol.decode_stream(
+            self._decompress(frame) for frame in frames)
@@ -1,14 +1,86 @@
-import json
-import pickle
-import msgpack
+import struct
 from typing import Union
 
-from ..struct import Event, Request, Response, Fault, Context, Target
+from ..struct import (Event, Request, Response, Fault, Context, Partial,
+                      StreamEnd, intern_target)
 from ..interface import Protocol
-from ..utils import json_dumps
+from ..utils import json_dumpb, json_loads
 
 __all__ = ('BaseInternalProtocol', 'JsonInternalProtocol',
-           'PickleInternalProtocol')
+           'PickleInternalProtocol', 'MsgpackInternalProtocol', 'Segments')
+
+BINARY_TYPES = (bytes, bytearray, memoryview)
+
+# Msgpack extension type referencing an out-of-band segment by index
+MSGPACK_OOB_EXT = 42
+
+
+class Segments(list):
+    """
+    An encoded message split into segments, the first is the message its
+    self and the rest are out-of-band binary buffers which were never
+    copied into it. Transports which support vectored I/O can write the
+    segments directly (e.g. `socket.sendmsg(segments)`), others use
+    `pack` and `unpack` to frame them as a single buffer.
+    """
+    MAGIC = b'AXOB'
+    _HEADER = struct.Struct('!4sI')
+    _LENGTH = struct.Struct('!Q')
+
+    @property
+    def nbytes(self):
+        return sum(memoryview(segment).nbytes for segment in self)
+
+    def pack(self):
+        header = [self._HEADER.pack(self.MAGIC, len(self))]
+        header.extend(self._LENGTH.pack(memoryview(segment).nbytes)
+                      for segment in self)
+        return b''.join(header + list(self))
+
+    @classmethod
+    def is_packed(cls, data):
+        return (isinstance(data, BINARY_TYPES) and
+                bytes(data[:len(cls.MAGIC)]) == cls.MAGIC)
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Split a packed buffer into segments, each a memoryview of `data`
+        """
+        view = memoryview(data)
+        magic, count = cls._HEADER.unpack_from(view)
+        if magic != cls.MAGIC:
+            raise ValueError('Not a segmented message')
+        offset = cls._HEADER.size
+        lengths = []
+        for _ in range(count):
+            lengths.append(cls._LENGTH.unpack_from(view, offset)[0])
+            offset += cls._LENGTH.size
+        segments = cls()
+        for length in lengths:
+            segments.append(view[offset:offset + length])
+            offset += length
+        if offset != len(view):
+            raise ValueError('Segment lengths do not match data')
+        return segments
+
+
+def _replace_buffers(value, threshold, replace):
+    """
+    Walks lists, tuples and dicts replacing binary values of at least
+    `threshold` bytes with `replace(value)`.
+    """
+    if isinstance(value, BINARY_TYPES):
+        if memoryview(value).nbytes >= threshold:
+            return replace(value)
+        return value
+    elif isinstance(value, dict):
+        return {key: _replace_buffers(item, threshold, replace)
+                for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        items = [_replace_buffers(item, threshold, replace) for item in value]
+        return tuple(items) if isinstance(value, tuple) else items
+    return value
 
 
 class BaseInternalProtocol(Protocol):
@@ -21,6 +93,11 @@ class BaseInternalProtocol(Protocol):
         elif isinstance(obj, Event):
             code = 'E'
             msg['A'] = obj.args
+        elif isinstance(obj, Partial):
+            code = 'P'
+            msg['D'] = obj.data
+        elif isinstance(obj, StreamEnd):
+            code = 'Z'
         elif isinstance(obj, Response):
             code = 'R'
             msg['D'] = obj.data
@@ -36,87 +113,218 @@ class BaseInternalProtocol(Protocol):
         msg['C'] = [ctx.guid, ctx.auth, ctx.meta]
         return msg
 
+    def _to_msg_oob(self, obj, threshold, replace):
+        """
+        Like `_to_msg` but with large binary args or data replaced
+        so they can be carried out-of-band.
+        """
+        msg = self._to_msg(obj)
+        for key in ('A', 'D'):
+            if key in msg:
+                msg[key] = _replace_buffers(msg[key], threshold, replace)
+        return msg
+
+    @staticmethod
+    def _segments(data):
+        if isinstance(data, Segments):
+            return data
+        if isinstance(data, list):
+            return Segments(data)
+        if Segments.is_packed(data):
+            return Segments.unpack(data)
+        return None
+
+    def encode_stream(self, response):
+        """
+        Encodes a streamed response as a sequence of frames which share
+        the request's context: one Partial per item then a StreamEnd, or
+        a Fault if the stream fails part way. Frames are produced as the
+        consumer asks for them, so the producer is never run ahead.
+        """
+        context = response.context
+        try:
+            for item in response.data:
+                yield self.encode(Partial(context, item))
+        except Fault as ex:
+            yield self.encode(Fault(context, ex.code, ex.message, ex.data))
+            return
+        except Exception as ex:
+            yield self.encode(Fault(context, Fault.APPLICATION_ERROR, str(ex)))
+            return
+        yield self.encode(StreamEnd(context))
+
+    def decode_stream(self, frames):
+        """
+        Decodes frames from `encode_stream`, yielding the items
+        """
+        for frame in frames:
+            obj = self.decode(frame)
+            if isinstance(obj, Partial):
+                yield obj.data
+            elif isinstance(obj, StreamEnd):
+                return
+            elif isinstance(obj, Fault):
+                raise obj
+            else:
+                raise Fault(obj.context, Fault.INVALID_RESPONSE,
+                            'Unexpected frame in stream')
+        raise Fault(None, Fault.INVALID_RESPONSE, 'Truncated stream')
+
     def _from_msg(self, msg: dict) -> Union[Fault, Request, Event, Response]:
         """
         Converts a message dictionary from its internal representation into
         a native object of the appropriate type.
         """
-        if msg.get('V') != '1':
-            raise Fault(Fault.PARSE_ERROR, 'Unknown proto version')
+        if not isinstance(msg, dict) or msg.get('V') != '1':
+            raise Fault(None, Fault.PARSE_ERROR, 'Unknown proto version')
         obj_type = msg.get('_')
-        if obj_type not in ('Q', 'R', 'F', 'E'):
-            raise Fault(Fault.PARSE_ERROR, 'Invalid proto obj type')
+        if obj_type not in ('Q', 'R', 'F', 'E', 'P', 'Z'):
+            raise Fault(None, Fault.PARSE_ERROR, 'Invalid proto obj type')
         obj_tgt = msg.get('T')
         obj_ctx = msg.get('C')
         if not all([obj_type, obj_tgt, obj_ctx]):
-            raise Fault(Fault.PARSE_ERROR, 'Missing proto fields')
+            raise Fault(None, Fault.PARSE_ERROR, 'Missing proto fields')
         for field in (obj_tgt, obj_ctx):
             if not isinstance(field, (tuple, list)):
-                raise Fault(Fault.PARSE_ERROR, 'Invalid ctx or tgt types')
+                raise Fault(None, Fault.PARSE_ERROR,
+                            'Invalid ctx or tgt types')
             if len(field) != 3:
-                raise Fault(Fault.PARSE_ERROR, 'Invalid ctx or tgt lengths')
-        target = Target(obj_tgt[0], obj_tgt[1], obj_tgt[2])
+                raise Fault(None, Fault.PARSE_ERROR,
+                            'Invalid ctx or tgt lengths')
+        try:
+            target = intern_target(obj_tgt[0], obj_tgt[1], obj_tgt[2])
+        except TypeError:
+            raise Fault(None, Fault.PARSE_ERROR, 'Invalid tgt field types')
         context = Context(target, obj_ctx[0], obj_ctx[1], obj_ctx[2])
         if obj_type in ('Q', 'E'):
             obj_args = msg.get('A')
             if not isinstance(obj_args, (tuple, list, dict)):
-                raise Fault(Fault.PARSE_ERROR, 'Invalid request args')
+                raise Fault(None, Fault.PARSE_ERROR, 'Invalid request args')
             if obj_type == 'Q':
                 return Request(context, obj_args)
             else:
                 return Event(context, obj_args)
         elif obj_type == 'R':
             return Response(context, msg.get('D'))
+        elif obj_type == 'P':
+            return Partial(context, msg.get('D'))
+        elif obj_type == 'Z':
+            return StreamEnd(context)
         elif obj_type == 'F':
             obj_exc = msg.get('X')
             if not isinstance(obj_exc, (tuple, list)) or len(obj_exc) != 3:
-                raise Fault(Fault.PARSE_ERROR, 'Invalid fault data')
+                raise Fault(None, Fault.PARSE_ERROR, 'Invalid fault data')
             return Fault(context, obj_exc[0], obj_exc[1], obj_exc[2])
 
 
 class JsonInternalProtocol(BaseInternalProtocol):
     def encode(self, obj):
         try:
-            return json_dumps(self._to_msg(obj))
+            return json_dumpb(self._to_msg(obj))
         except Exception as ex:
-            raise Fault(Fault.SERIALIZE_ERROR, 'JSON serialize', inner=ex)
+            raise Fault(None, Fault.SERIALIZE_ERROR,
+                        'JSON serialize', inner=ex)
 
     def decode(self, data):
         try:
-            msg = json.loads(data)
+            msg = json_loads(data)
         except Exception as ex:
-            raise Fault(Fault.PARSE_ERROR, 'JSON parse', inner=ex)
+            raise Fault(None, Fault.PARSE_ERROR, 'JSON parse', inner=ex)
         return self._from_msg(msg)
 
 
 class PickleInternalProtocol(BaseInternalProtocol):
-    def __init__(self, pickle_protocol=-1):
+    """
+    With `out_of_band` binary values of at least `oob_threshold` bytes
+    are passed as pickle protocol 5 out-of-band buffers, the encoded
+    message is then `Segments` and the receiver gets memoryviews of the
+    original buffers rather than copies.
+    """
+    def __init__(self, pickle_protocol=-1, out_of_band=False,
+                 oob_threshold=65536):
+        import pickle
+        self._pickle = pickle
         self.pickle_protocol = pickle_protocol
+        self.out_of_band = out_of_band
+        self.oob_threshold = oob_threshold
 
     def encode(self, obj):
+        pickle = self._pickle
         try:
-            return pickle.dumps(self._to_msg(obj), self.pickle_protocol)
+            if not self.out_of_band:
+                return pickle.dumps(self._to_msg(obj), self.pickle_protocol)
+            msg = self._to_msg_oob(obj, self.oob_threshold,
+                                   pickle.PickleBuffer)
+            buffers = []
+            data = pickle.dumps(msg, self.pickle_protocol,
+                                buffer_callback=buffers.append)
         except Exception as ex:
-            raise Fault(Fault.SERIALIZE_ERROR, 'Pickle serialize', inner=ex)
+            raise Fault(None, Fault.SERIALIZE_ERROR,
+                        'Pickle serialize', inner=ex)
+        if not buffers:
+            return data
+        return Segments([data] + [buf.raw() for buf in buffers])
 
     def decode(self, data):
+        pickle = self._pickle
         try:
-            msg = pickle.loads(data)
+            segments = self._segments(data)
+            if segments is None:
+                msg = pickle.loads(data)
+            else:
+                msg = pickle.loads(segments[0], buffers=segments[1:])
         except Exception as ex:
-            raise Fault(Fault.PARSE_ERROR, 'Pickle parse', inner=ex)
+            raise Fault(None, Fault.PARSE_ERROR, 'Pickle parse', inner=ex)
         return self._from_msg(msg)
 
+
 class MsgpackInternalProtocol(BaseInternalProtocol):
+    """
+    With `out_of_band` binary values of at least `oob_threshold` bytes
+    are replaced by an extension type referencing a separate segment,
+    see `PickleInternalProtocol`.
+    """
+    def __init__(self, out_of_band=False, oob_threshold=65536):
+        import msgpack
+        self._msgpack = msgpack
+        self.out_of_band = out_of_band
+        self.oob_threshold = oob_threshold
+
     def encode(self, obj):
+        msgpack = self._msgpack
         try:
-            return msgpack.unpackb(self._to_msg(obj))
+            if not self.out_of_band:
+                return msgpack.packb(self._to_msg(obj))
+            segments = Segments([None])
+
+            def _replace(value):
+                segments.append(memoryview(value))
+                return msgpack.ExtType(MSGPACK_OOB_EXT,
+                                       struct.pack('!I', len(segments) - 1))
+            msg = self._to_msg_oob(obj, self.oob_threshold, _replace)
+            segments[0] = msgpack.packb(msg)
         except Exception as ex:
-            raise Fault(Fault.SERIALIZE_ERROR, 'Msgpack serialize', inner=ex)
+            raise Fault(None, Fault.SERIALIZE_ERROR,
+                        'Msgpack serialize', inner=ex)
+        if len(segments) == 1:
+            return segments[0]
+        return segments
 
     def decode(self, data):
+        msgpack = self._msgpack
         try:
-            msg = msgpack.packb(data)
+            segments = self._segments(data)
+            if segments is None:
+                msg = msgpack.unpackb(data)
+            else:
+                def _ext_hook(code, ext_data):
+                    if code != MSGPACK_OOB_EXT:
+                        return msgpack.ExtType(code, ext_data)
+                    index = struct.unpack('!I', ext_data)[0]
+                    if not 0 < index < len(segments):
+                        raise ValueError('Invalid segment index')
+                    return segments[index]
+                msg = msgpack.unpackb(segments[0], ext_hook=_ext_hook)
         except Exception as ex:
-            raise Fault(Fault.PARSE_ERROR, 'Msgpack parse', inner=ex)
+            raise Fault(None, Fault.PARSE_ERROR, 'Msgpack parse', inner=ex)
         return self._from_msg(msg)
-
@@ -53,10 +53,20 @@ dispatcher.
 """
 
 from collections import defaultdict
+import contextlib
+import importlib
+import os
 import re
+import sys
+import threading
+import weakref
 from .utils import Singleton
 
-__all__ = ('register', 'Registry', 'GlobalRegistry')
+__all__ = ('register', 'idempotent', 'accepts_stream', 'Registry',
+           'GlobalRegistry', 'parse_subject', 'event_subjects')
+
+# The registry reloading modules in this thread, `register` adds to it
+_reloading = threading.local()
 
 
 def _validate_name(name):
@@ -105,6 +115,43 @@ def _expand_versions(versions):
     return sorted(list(set(output)))
 
 
+def _pad_version(ver):
+    split = ver.split('.')
+    while len(split) < 3:
+        split.append('X')
+    return '.'.join(split)
+
+
+# Versions as `_validate_versions` intends them, single digit major and
+# minor, so numeric name segments like 'srv.123' aren't taken for one
+_SUBJECT_VERSION = re.compile(r'^[0-9](\.[0-9X](\.([a-f0-9]+|X))?)?$')
+_SUBJECT_VERSION_LOOSE = re.compile(
+    r'^[0-9]+(\.([0-9]+|X)(\.([a-f0-9]+|X))?)?$')
+
+
+def parse_subject(subject):
+    """
+    Splits a dotted subject such as 'srv.events.1.X' into the service
+    name and the version padded to three parts, ('srv.events', '1.X.X')
+    """
+    parts = subject.split('.')
+    for pattern in (_SUBJECT_VERSION, _SUBJECT_VERSION_LOOSE):
+        for idx in range(1, len(parts)):
+            version = '.'.join(parts[idx:])
+            if pattern.match(version):
+                name = _validate_name('.'.join(parts[:idx]))
+                return name, _pad_version(version)
+    raise ValueError('Subject has no version: %s' % (subject,))
+
+
+def event_subjects(name, version):
+    """
+    Subjects which an event sent to the service name and version
+    is delivered to, e.g. for 1.3.5: srv.1.3.5, srv.1.3.X, srv.1.X.X
+    """
+    return [name + '.' + ver for ver in _expand_versions([version])]
+
+
 def _service_name_versions(service_cls):
     name = _validate_name(getattr(service_cls, '_service_name'))
     versions = _validate_versions(getattr(service_cls, '_service_versions'))
@@ -113,35 +160,188 @@ def _service_name_versions(service_cls):
     return name, versions
 
 
-def register(name, versions):
+def register(name, versions, idempotent=None):
     """
     Registers a service providing class
+
+    :param idempotent: names of methods which are safe to retry or hedge
     """
     name = _validate_name(name)
     versions = _validate_versions(versions)
+    if isinstance(idempotent, str):
+        idempotent = [idempotent]
 
     def class_registrator(cls):
         cls._service_versions = versions
         cls._service_name = name
-        GlobalRegistry().add(cls)
+        cls._service_idempotent = frozenset(idempotent or ())
+        registry = getattr(_reloading, 'registry', None)
+        (registry or GlobalRegistry()).add(cls)
         return cls
     return class_registrator
 
 
+def idempotent(method):
+    """
+    Marks a service method as safe to retry or hedge
+    """
+    method._idempotent = True
+    return method
+
+
+def accepts_stream(method):
+    """
+    Marks a coroutine service method as taking the HTTP request body as
+    an async byte stream, passed as its `body` argument
+    """
+    method._accepts_stream = True
+    return method
+
+
+def is_idempotent_method(service_cls, method_name):
+    if method_name in getattr(service_cls, '_service_idempotent', ()):
+        return True
+    method = getattr(service_cls, method_name, None)
+    return bool(getattr(method, '_idempotent', False))
+
+
+def idempotent_methods(service_cls):
+    """
+    Names of the methods of a service class declared idempotent
+    """
+    names = set(getattr(service_cls, '_service_idempotent', ()))
+    for name in dir(service_cls):
+        if getattr(getattr(service_cls, name, None), '_idempotent', False):
+            names.add(name)
+    return sorted(names)
+
+
+def _module_mtime(module_name):
+    path = getattr(sys.modules.get(module_name), '__file__', None)
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
+
 class Registry(object):
     services = defaultdict(dict)
     classes = list()
 
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._listeners = []
+        self._mtimes = dict()
+
+    def add_listener(self, method):
+        """
+        Call the bound method with (old class, new class) whenever a
+        class is replaced, old is None for a class added and new is None
+        for one removed. Only a weak reference to it is kept.
+        """
+        self._listeners.append(weakref.WeakMethod(method))
+
+    def _notify(self, old_cls, new_cls):
+        for ref in list(self._listeners):
+            method = ref()
+            if method is None:
+                self._listeners.remove(ref)
+            else:
+                method(old_cls, new_cls)
+
+    def _same_class(self, service_cls):
+        if getattr(_reloading, 'registry', None) is not self:
+            return None
+        for cls in self.classes:
+            if (cls.__module__ == service_cls.__module__ and
+                    cls.__qualname__ == service_cls.__qualname__):
+                return cls
+
     def add(self, service_cls):
-        if service_cls in self.classes:
-            raise RuntimeError('Class registered twice: %r' % (service_cls,))
-        name, versions = _service_name_versions(service_cls)
-        for ver in _expand_versions(versions):
-            if ver in self.services[name]:
-                raise RuntimeError('Service version conflict: %s - %s' % (
-                    name, ver))
-            self.services[name][ver] = service_cls
-        self.classes.append(service_cls)
+        with self._lock:
+            old_cls = self._same_class(service_cls)
+            if old_cls is not None:
+                return self.replace(old_cls, service_cls)
+            if service_cls in self.classes:
+                raise RuntimeError('Class registered twice: %r' % (
+                    service_cls,))
+            name, versions = _service_name_versions(service_cls)
+            for ver in _expand_versions(versions):
+                if ver in self.services[name]:
+                    raise RuntimeError('Service version conflict: %s - %s' % (
+                        name, ver))
+                self.services[name][ver] = service_cls
+            self.classes.append(service_cls)
+            self._mtimes.setdefault(service_cls.__module__,
+                                    _module_mtime(service_cls.__module__))
+        self._notify(None, service_cls)
+
+    def replace(self, old_cls, new_cls):
+        """
+        Swap a registered class for a new one, e.g. from a reloaded
+        module. Lookups see either the old or the new versions index,
+        never a mix.
+        """
+        with self._lock:
+            if old_cls not in self.classes:
+                raise RuntimeError('Service not found: %r' % (old_cls,))
+            old_name, old_versions = _service_name_versions(old_cls)
+            name, versions = _service_name_versions(new_cls)
+            old_index = {old_name: dict(self.services.get(old_name, {}))}
+            for ver in _expand_versions(old_versions):
+                del old_index[old_name][ver]
+            index = old_index if name == old_name else {
+                name: dict(self.services.get(name, {}))}
+            for ver in _expand_versions(versions):
+                if ver in index[name]:
+                    raise RuntimeError('Service version conflict: %s - %s' % (
+                        name, ver))
+                index[name][ver] = new_cls
+            self.services[old_name] = old_index[old_name]
+            self.services[name] = index[name]
+            self.classes[self.classes.index(old_cls)] = new_cls
+            self._mtimes[new_cls.__module__] = _module_mtime(
+                new_cls.__module__)
+        self._notify(old_cls, new_cls)
+
+    @contextlib.contextmanager
+    def reloading(self):
+        """
+        While active, adding a class with the same module and name as a
+        registered one replaces it instead of conflicting, and classes
+        decorated with `register` in this thread are added here rather
+        than to the GlobalRegistry.
+        """
+        with self._lock:
+            previous = getattr(_reloading, 'registry', None)
+            _reloading.registry = self
+            try:
+                yield self
+            finally:
+                _reloading.registry = previous
+
+    def changed_modules(self):
+        """
+        Modules of registered classes whose source changed on disk
+        """
+        return sorted(name for name, mtime in self._mtimes.items()
+                      if _module_mtime(name) != mtime)
+
+    def reload(self, module_names=None):
+        """
+        Re-import the modules, by default those changed on disk, and
+        swap in the classes they register. Returns the module names.
+        """
+        if module_names is None:
+            module_names = self.changed_modules()
+        with self.reloading():
+            for name in module_names:
+                module = sys.modules.get(name)
+                if module is None:
+                    importlib.import_module(name)
+                else:
+                    importlib.reload(module)
+        return list(module_names)
 
     def lookup(self, name, versions=None):
         assert isinstance(name, str)
@@ -161,13 +361,42 @@ class Registry(object):
             if len(all_versions):
                 return all_versions[0]
 
+    def is_idempotent(self, name, version, method):
+        """
+        Whether the method of the service class providing name and
+        version was declared idempotent, False if there is no such class.
+        """
+        try:
+            service_cls = self.lookup(name, version)
+        except (RuntimeError, ValueError):
+            return False
+        if not isinstance(service_cls, type):
+            return False
+        return is_idempotent_method(service_cls, method)
+
+    def accepts_stream(self, name, version, method):
+        """
+        Whether the method was marked with `accepts_stream`
+        """
+        try:
+            service_cls = self.lookup(name, version)
+        except (RuntimeError, ValueError):
+            return False
+        method = getattr(service_cls, method, None)
+        return bool(getattr(method, '_accepts_stream', False))
+
     def remove(self, service_cls):
         if service_cls not in self.classes:
             raise RuntimeError('Service not found: %r' % (service_cls,))
         name, versions = _service_name_versions(service_cls)
-        self.classes.remove(service_cls)
-        for ver in _expand_versions(versions):
-            del self.services[name][ver]
+        with self._lock:
+            self.classes.remove(service_cls)
+            for ver in _expand_versions(versions):
+                del self.services[name][ver]
+            module = service_cls.__module__
+            if not any(cls.__module__ == module for cls in self.classes):
+                self._mtimes.pop(module, None)
+        self._notify(service_cls, None)
 
 
 class GlobalRegistry(Singleton, Registry):
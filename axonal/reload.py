@@ -0,0 +1,45 @@
+"""
+Hot reload of registered service classes.
+
+`Reloader.reload` re-imports modules, by default those whose source
+changed, and the registry swaps in the classes they register. Brokers
+drop instances of the old classes, calls in flight finish on them while
+new calls go to instances of the new classes.
+
+Worker processes given the same `lock_path` take turns, so while one
+worker is importing the others keep serving.
+"""
+import logging
+from fcntl import flock, LOCK_EX, LOCK_UN
+
+__all__ = ('Reloader',)
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Reloader(object):
+    def __init__(self, registry=None, lock_path=None):
+        self.registry = registry
+        self.lock_path = lock_path
+
+    def _reload(self, module_names):
+        registry = self.registry
+        if registry is None:
+            from .registry import GlobalRegistry
+            registry = GlobalRegistry()
+        reloaded = registry.reload(module_names)
+        LOGGER.info('Reloaded modules: %s', ', '.join(reloaded) or 'none')
+        return reloaded
+
+    def reload(self, module_names=None):
+        """
+        Returns the names of the modules reloaded
+        """
+        if self.lock_path is None:
+            return self._reload(module_names)
+        with open(self.lock_path, 'a') as handle:
+            flock(handle, LOCK_EX)
+            try:
+                return self._reload(module_names)
+            finally:
+                flock(handle, LOCK_UN)
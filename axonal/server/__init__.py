@@ -0,0 +1,8 @@
+from ..utils import LazyRegistry
+
+__all__ = ('SERVERS',)
+
+SERVERS = LazyRegistry('server', {
+    'http': 'axonal.server.httpd.RpcHttpPlugin',
+    'replay': 'axonal.middleware.capture.ReplayPlugin',
+})
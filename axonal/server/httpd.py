@@ -1,18 +1,60 @@
-import json
 import sys
 import aiohttp
 import asyncio
+import hmac
+import inspect
+import ipaddress
 import logging
+import socket
+import struct
+from types import GeneratorType, AsyncGeneratorType
+from urllib.parse import parse_qsl
 from aiohttp import web
 
 from .. import __version__
-from ..plugin import Host, Plugin
-from ..middleware.proxy import ServiceProxy
-from ..struct import Fault
-from ..utils import json_dumpb
+from ..plugin import Host, Plugin, preload
+from ..middleware.proxy import ServiceProxy, AsyncServiceProxy
+from ..proto import get_protocol, CONTENT_TYPES, FRAMES_TYPE, TARGET_HEADER
+from ..proto.internal import Segments
+from ..struct import Event, Fault, Request, StreamResponse
+from ..utils import import_name, json_dumpb, json_loads
 
 LOGGER = logging.getLogger(__name__)
 
+NDJSON_TYPE = 'application/x-ndjson'
+MSGPACK_TYPE = 'application/x-msgpack'
+JSON_TYPE = 'application/json'
+FORM_TYPE = 'application/x-www-form-urlencoded'
+MULTIPART_TYPE = 'multipart/form-data'
+
+PROTOCOL_TYPES = {ctype: name for name, ctype in CONTENT_TYPES.items()}
+FRAME_LENGTH = struct.Struct('!I')
+
+READ_CHUNK = 64 * 1024
+
+ADMIN_TOKEN_HEADER = 'X-Axonal-Admin-Token'
+
+
+_END = object()
+
+
+async def _in_executor(iterable):
+    """
+    Items of a blocking iterable, each fetched in the default executor
+    so a slow item never holds up the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    items = iter(iterable)
+    while True:
+        item = await loop.run_in_executor(None, next, items, _END)
+        if item is _END:
+            return
+        yield item
+
+
+def _ndjson_line(item):
+    return json_dumpb(item) + b'\n'
+
 
 def _fault_code_to_http_status(code):
     mapping = {
@@ -26,7 +68,10 @@ def _fault_code_to_http_status(code):
         Fault.APPLICATION_ERROR: 500,
         Fault.SERVICE_UNKNOWN: 404,
         Fault.VERSION_UNKNOWN: 404,
-        Fault.NOT_AUTHORISED: 401
+        Fault.NOT_AUTHORISED: 401,
+        Fault.RATE_LIMITED: 429,
+        Fault.CIRCUIT_OPEN: 503,
+        Fault.PAYLOAD_TOO_LARGE: 413
     }
     return mapping.get(code, 500)
 
@@ -47,76 +92,614 @@ class FaultResponse(web.Response):
         )
 
 
+def _frame_bytes(frame):
+    if isinstance(frame, Segments):
+        return frame.pack()
+    return bytes(frame)
+
+
+def _check_length(request, limit):
+    """
+    Reject a declared Content-Length over the limit before reading
+    """
+    length = request.content_length
+    if length is not None and length > limit:
+        raise Fault(None, Fault.PAYLOAD_TOO_LARGE)
+
+
+class BodyStream(object):
+    """
+    The request body as an async byte stream, for service methods
+    marked `accepts_stream`. Reading past `limit` bytes raises
+    Fault.PAYLOAD_TOO_LARGE.
+    """
+    __slots__ = ('_content', 'limit', 'received')
+
+    def __init__(self, content, limit):
+        self._content = content
+        self.limit = limit
+        self.received = 0
+
+    async def read(self, size=READ_CHUNK):
+        """
+        Up to `size` bytes, b'' at the end of the body
+        """
+        data = await self._content.read(size)
+        self.received += len(data)
+        if self.received > self.limit:
+            raise Fault(None, Fault.PAYLOAD_TOO_LARGE)
+        return data
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        data = await self.read()
+        if not data:
+            raise StopAsyncIteration
+        return data
+
+
+async def _read_body(request, limit):
+    """
+    Read the whole body in chunks, never holding more than `limit`
+    """
+    _check_length(request, limit)
+    body = bytearray()
+    stream = BodyStream(request.content, limit)
+    async for chunk in stream:
+        body.extend(chunk)
+    return bytes(body)
+
+
+async def _read_multipart(request, limit):
+    params = dict()
+    received = 0
+    reader = await request.multipart()
+    while True:
+        part = await reader.next()
+        if part is None:
+            return params
+        data = bytearray()
+        while True:
+            chunk = await part.read_chunk(READ_CHUNK)
+            if not chunk:
+                break
+            received += len(chunk)
+            if received > limit:
+                raise Fault(None, Fault.PAYLOAD_TOO_LARGE)
+            data.extend(chunk)
+        if part.filename is None:
+            data = data.decode(part.get_charset('utf-8'))
+        params[part.name] = data
+
+
 class RpcHttpApp(web.Application):
-    def __init__(self, broker):
+    """
+    :param compress_threshold: response bodies of at least this many
+        bytes are compressed using the Content-Encoding negotiated from
+        the client's Accept-Encoding, None disables compression.
+        Streamed responses, whose size isn't known when the headers are
+        sent, are only compressed with a threshold of 0.
+    :param websocket: options for the `WebSocketHub` serving /ws,
+        None disables the endpoint.
+    :param offload: dispatch calls from an executor rather than the
+        event loop, needed when the broker blocks, e.g. a
+        `SchedulingDispatcher` queueing requests.
+    :param reloader: a `Reloader` run by POST /admin/reload, optionally
+        with `module` query parameters, None disables the endpoint.
+    :param admin_token: secret the /admin endpoints require in the
+        X-Axonal-Admin-Token header, without one they only answer
+        loopback and Unix socket clients.
+    :param max_body_size: largest request body accepted, in bytes
+    :param body_limits: per route overrides of `max_body_size`, keyed by
+        (service, method) or (service, None) for the whole service.
+
+    POST bodies are read incrementally and rejected with HTTP 413 once
+    over the limit. JSON, form and multipart bodies become the call's
+    parameters. Calls carry the Authorization header, or without one
+    the client's address, as `Context.auth`, so a `SchedulingDispatcher`
+    schedules each client as its own tenant. Methods marked
+    `registry.accepts_stream` get the body as a `BodyStream` in their
+    `body` argument instead. Internal protocol messages can be posted
+    to /rpc.
+
+    Events are pushed to WebSocket subscribers when they are dispatched
+    through `ws_dispatcher`, which wraps the broker.
+    """
+    def __init__(self, broker, compress_threshold=None, websocket=None,
+                 offload=False, reloader=None, max_body_size=1024 * 1024,
+                 body_limits=None, admin_token=None):
         super().__init__()
         self.broker = broker
+        self.compress_threshold = compress_threshold
+        self.offload = offload
+        self.reloader = reloader
+        self.admin_token = admin_token
+        self.max_body_size = max_body_size
+        self.body_limits = dict(body_limits or {})
+        self._protocols = dict()
+        if reloader is not None:
+            self.router.add_route('POST', '/admin/reload', self.handle_reload)
+        self.ws_hub = self.ws_dispatcher = None
+        if websocket is not None:
+            from .websocket import WebSocketHub, WebSocketEventDispatcher
+            self.ws_hub = WebSocketHub(None, **websocket)
+            self.ws_dispatcher = WebSocketEventDispatcher(self.ws_hub, broker)
+            self.ws_hub.broker = self.ws_dispatcher
+            self.router.add_route('GET', '/ws', self.ws_hub.handle)
+        self._proxies = dict()
         self.router.add_route('GET', '/svc/{service}/{version}/{method}', self.handle_call_GET)
         self.router.add_route('POST', '/svc/{service}/{version}/{method}', self.handle_call_POST)
+        self.router.add_route('POST', '/rpc', self.handle_rpc)
         self.on_response_prepare.append(self._on_prepare)
 
-    def _on_prepare(self, request, response):
+    async def _on_prepare(self, request, response):
         response.headers[aiohttp.hdrs.SERVER] = 'Axonal/%s' % (__version__)
 
-    def _dispatch(self, request, raw_params):
-        service = request.match_info.get('service')
-        version = request.match_info.get('version')
-        method = request.match_info.get('method')
-        params = {key: raw_params.get(key)
-                  for key in frozenset(raw_params.keys())}
-        proxy = ServiceProxy(self.broker, service, version)
-        target = getattr(proxy, method)
+    def _proxy(self, service, version):
+        """
+        Proxies are cached per route, their method targets are reused
+        by every request to the same service and version.
+        """
+        key = (service, version)
+        proxy = self._proxies.get(key)
+        if proxy is None:
+            if len(self._proxies) >= 1024:
+                self._proxies.clear()
+            proxy_cls = AsyncServiceProxy if self.offload else ServiceProxy
+            proxy = self._proxies[key] = proxy_cls(
+                self.broker, service, version)
+        return proxy
+
+    def _body_limit(self, service, method):
+        limits = self.body_limits
+        if limits:
+            limit = limits.get((service, method), limits.get((service, None)))
+            if limit is not None:
+                return limit
+        return self.max_body_size
+
+    def _accepts_stream(self, service, version, method):
+        registry = getattr(self.broker, 'registry', None)
+        if registry is None:
+            from ..registry import GlobalRegistry
+            registry = GlobalRegistry()
+        return registry.accepts_stream(service, version, method)
+
+    async def _stream(self, request, result):
+        """
+        Streams the items of a generator result as they are produced,
+        newline delimited JSON by default or msgpack frames if accepted.
+        Each write waits for the transport to drain.
+        """
+        accept = request.headers.get(aiohttp.hdrs.ACCEPT, '')
+        if MSGPACK_TYPE in accept:
+            import msgpack
+            content_type = MSGPACK_TYPE
+            encode = msgpack.packb
+        else:
+            content_type = NDJSON_TYPE
+            encode = _ndjson_line
+        response = web.StreamResponse()
+        response.content_type = content_type
+        response.enable_chunked_encoding()
+        if self.compress_threshold == 0:
+            response.enable_compression()
+        await response.prepare(request)
+        try:
+            if not hasattr(result, '__aiter__'):
+                result = _in_executor(result)
+            async for item in result:
+                await response.write(encode(item))
+        except Exception as ex:
+            LOGGER.exception('Stream failed')
+            fault = ex if isinstance(ex, Fault) else Fault(
+                None, Fault.APPLICATION_ERROR)
+            status = _fault_code_to_http_status(fault.code)
+            await response.write(encode({'error': [status, fault.message]}))
+        await response.write_eof()
+        return response
+
+    async def _dispatch(self, request, raw_params):
+        match_info = request.match_info
+        proxy = self._proxy(match_info.get('service'),
+                            match_info.get('version'))
+        target = getattr(proxy, match_info.get('method')).with_auth(
+            request.headers.get(aiohttp.hdrs.AUTHORIZATION) or request.remote)
+        if isinstance(raw_params, (dict, tuple, list)):
+            params = raw_params
+        else:
+            params = dict(raw_params)
         try:
             # XXX: What happens if result is None?
             if isinstance(params, (tuple, list)):
                 result = target(*params)
             else:
                 result = target(**params)
-            return web.Response(
-                body=json_dumpb(result),
-                content_type='application/json',
-            )
+            if self.offload:
+                result = await result
+            if inspect.isawaitable(result):
+                result = await result
         except Fault as fault:
             return FaultResponse(fault)
-        except Exception:
-            raise
+        if isinstance(result, (GeneratorType, AsyncGeneratorType)):
+            return await self._stream(request, result)
+        body = json_dumpb(result)
+        response = web.Response(
+            body=body,
+            content_type='application/json',
+        )
+        threshold = self.compress_threshold
+        if threshold is not None and len(body) >= threshold:
+            response.enable_compression()
+        return response
+
+    def _admin_allowed(self, request):
+        if self.admin_token is not None:
+            token = request.headers.get(ADMIN_TOKEN_HEADER, '')
+            return hmac.compare_digest(token.encode('utf-8'),
+                                       self.admin_token.encode('utf-8'))
+        remote = request.remote
+        if not remote:
+            # Unix socket
+            return True
+        try:
+            return ipaddress.ip_address(remote).is_loopback
+        except ValueError:
+            return False
+
+    async def handle_reload(self, request):
+        if not self._admin_allowed(request):
+            return FaultResponse(Fault(None, Fault.NOT_AUTHORISED))
+        modules = request.query.getall('module', None)
+        loop = asyncio.get_running_loop()
+        try:
+            reloaded = await loop.run_in_executor(
+                None, self.reloader.reload, modules)
+        except Exception as ex:
+            LOGGER.exception('Reload failed')
+            return FaultResponse(Fault(None, Fault.INTERNAL_ERROR, str(ex)))
+        return web.Response(body=json_dumpb({'reloaded': reloaded}),
+                            content_type='application/json')
 
     async def handle_call_GET(self, request):
         try:
-            return self._dispatch(request, request.GET)
+            return await self._dispatch(request, request.query)
         except Exception:
             logging.exception('Derp GET')
 
+    async def _post_params(self, request):
+        match_info = request.match_info
+        service = match_info.get('service')
+        method = match_info.get('method')
+        limit = self._body_limit(service, method)
+        _check_length(request, limit)
+        if self._accepts_stream(service, match_info.get('version'), method):
+            params = dict(request.query)
+            params['body'] = BodyStream(request.content, limit)
+            return params
+        content_type = request.content_type
+        if content_type == MULTIPART_TYPE:
+            return await _read_multipart(request, limit)
+        body = await _read_body(request, limit)
+        if content_type == JSON_TYPE:
+            try:
+                params = json_loads(body)
+            except ValueError:
+                raise Fault(None, Fault.PARSE_ERROR)
+            if not isinstance(params, (dict, list)):
+                raise Fault(None, Fault.INVALID_PARAMS)
+            return params
+        elif content_type == FORM_TYPE:
+            try:
+                return dict(parse_qsl(body.decode('utf-8'),
+                                      keep_blank_values=True))
+            except UnicodeDecodeError:
+                raise Fault(None, Fault.PARSE_ERROR)
+        elif not body:
+            return dict()
+        raise Fault(None, Fault.INVALID_REQUEST, 'Unsupported content type')
+
     async def handle_call_POST(self, request):
         try:
-            post_data = await request.post()
-            return self._dispatch(request, post_data)
+            try:
+                params = await self._post_params(request)
+            except Fault as fault:
+                return FaultResponse(fault)
+            return await self._dispatch(request, params)
         except Exception:
             logging.exception('Derp POST')
 
+    def _protocol(self, content_type):
+        protocol = self._protocols.get(content_type)
+        if protocol is None:
+            name = PROTOCOL_TYPES.get(content_type)
+            if name is None:
+                return None
+            protocol = self._protocols[content_type] = get_protocol(name)
+        return protocol
+
+    async def _rpc_frames(self, request, protocol, resp):
+        response = web.StreamResponse()
+        response.content_type = FRAMES_TYPE
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        async for frame in _in_executor(protocol.encode_stream(resp)):
+            frame = _frame_bytes(frame)
+            await response.write(FRAME_LENGTH.pack(len(frame)) + frame)
+        await response.write_eof()
+        return response
+
+    def _rpc_limit(self, request):
+        """
+        Body limit for a message posted to /rpc, from its target header
+        if given, otherwise the largest limit of any route.
+        """
+        claimed = request.headers.get(TARGET_HEADER)
+        if claimed is not None:
+            service, _, method = claimed.partition('/')
+            return (service, method), self._body_limit(service, method)
+        return None, max([self.max_body_size] + list(
+            self.body_limits.values()))
+
+    async def handle_rpc(self, request):
+        """
+        Dispatches one internal protocol message, responding with the
+        encoded Response or Fault, or 202 for events.
+        """
+        protocol = self._protocol(request.content_type)
+        if protocol is None:
+            raise web.HTTPUnsupportedMediaType()
+        claimed, limit = self._rpc_limit(request)
+        try:
+            data = await _read_body(request, limit)
+            try:
+                obj = protocol.decode(data)
+            except Fault:
+                raise
+            except Exception as ex:
+                # Bad input from the client, never a 5xx
+                raise Fault(None, Fault.PARSE_ERROR, str(ex), inner=ex)
+            if not isinstance(obj, Event):
+                raise Fault(None, Fault.INVALID_REQUEST,
+                            'Not a request or event')
+            target = obj.context.target
+            if claimed not in (None, (target.service, target.method)):
+                raise Fault(obj.context, Fault.INVALID_REQUEST,
+                            'Target does not match %s' % (TARGET_HEADER,))
+            if len(data) > self._body_limit(target.service, target.method):
+                raise Fault(obj.context, Fault.PAYLOAD_TOO_LARGE)
+        except Fault as fault:
+            return FaultResponse(fault)
+        try:
+            if self.offload:
+                loop = asyncio.get_running_loop()
+                resp = await loop.run_in_executor(
+                    None, self.broker.dispatch, obj)
+            else:
+                resp = self.broker.dispatch(obj)
+        except Exception as ex:
+            if not isinstance(obj, Request):
+                LOGGER.exception('Event failed')
+                return web.Response(status=202)
+            if not isinstance(ex, Fault):
+                ex = Fault(obj.context, Fault.APPLICATION_ERROR, inner=ex)
+            resp = Fault(obj.context, ex.code, ex.message, ex.data)
+        if not isinstance(obj, Request):
+            return web.Response(status=202)
+        if isinstance(resp, StreamResponse):
+            return await self._rpc_frames(request, protocol, resp)
+        return web.Response(body=_frame_bytes(protocol.encode(resp)),
+                            content_type=request.content_type)
+
+
+def _host_port(value):
+    host, _, port = value.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+EVENT_LOOPS = {
+    'asyncio': 'asyncio.new_event_loop',
+    'uvloop': 'uvloop.new_event_loop',
+}
+
+
+class _NoDelayOff(object):
+    """
+    Wraps the request handler protocol, clearing the TCP_NODELAY flag
+    asyncio and aiohttp set on every accepted connection. aiohttp sets it
+    in `connection_made`, so it's cleared afterwards.
+    """
+    __slots__ = ('_protocol',)
+
+    def __init__(self, protocol):
+        self._protocol = protocol
+
+    def connection_made(self, transport):
+        self._protocol.connection_made(transport)
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET,
+                                                socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 0)
+
+    def __getattr__(self, name):
+        return getattr(self._protocol, name)
+
 
 class RpcHttpPlugin(Plugin):
-    async def _setup(self, loop):
-        from ..registry import register, GlobalRegistry
-        from ..middleware.broker import RegistryBroker
+    """
+    Serves the services registered by the `--service` modules over HTTP
+    """
+    def __init__(self):
+        self._options = None
+        self._loop = None
+        self._cluster = None
+        self._capture = None
+
+    def options(self, parser, env):
+        parser.add_argument(
+            '--bind', dest='bind', metavar="address",
+            default=env.get('AXONAL_BIND', '127.0.0.1'),
+            help='Address to listen on')
+        parser.add_argument(
+            '--port', dest='port', metavar="port", type=int,
+            default=int(env.get('AXONAL_PORT', 8080)), help='TCP port')
+        parser.add_argument(
+            '--unix', dest='unix', metavar="path",
+            help='Listen on a Unix socket instead of TCP')
+        parser.add_argument(
+            '--backlog', dest='backlog', metavar="count", type=int,
+            default=128, help='Listen backlog')
+        parser.add_argument(
+            '--no-nodelay', dest='nodelay', action='store_false',
+            default=True, help='Leave Nagle\'s algorithm enabled')
+        parser.add_argument(
+            '--keepalive-timeout', dest='keepalive_timeout',
+            metavar="seconds", type=float, default=75.0,
+            help='Close idle keep-alive connections after this long')
+        parser.add_argument(
+            '--loop', dest='loop', choices=sorted(EVENT_LOOPS),
+            default=env.get('AXONAL_LOOP', 'asyncio'),
+            help='Event loop implementation')
+        parser.add_argument(
+            '--max-body-size', dest='max_body_size', metavar="bytes",
+            type=int, default=1024 * 1024,
+            help='Reject request bodies larger than this')
+        parser.add_argument(
+            '--capture', dest='capture', metavar="filename",
+            help='Record a sample of calls for replay')
+        parser.add_argument(
+            '--capture-rate', dest='capture_rate', metavar="fraction",
+            type=float, default=0.01, help='Fraction of calls captured')
+        parser.add_argument(
+            '--capture-max-bytes', dest='capture_max_bytes', metavar="bytes",
+            type=int, default=256 * 1024 * 1024,
+            help='Stop capturing once the file reaches this size')
+        parser.add_argument(
+            '--cluster-bind', dest='cluster_bind', metavar="host:port",
+            default=env.get('AXONAL_CLUSTER_BIND'),
+            help='Join a cluster, receiving UDP heartbeats here')
+        parser.add_argument(
+            '--cluster-seed', dest='cluster_seeds', metavar="host:port",
+            action='append', default=[],
+            help='Cluster member to contact at start, repeatable')
+        parser.add_argument(
+            '--cluster-endpoint', dest='cluster_endpoint', metavar="url",
+            help='URL peers call this node on, by default from --bind '
+                 'and --port, required with --unix')
+        parser.add_argument(
+            '--cluster-secret', dest='cluster_secret', metavar="secret",
+            default=env.get('AXONAL_CLUSTER_SECRET'),
+            help='Key shared by the cluster to sign heartbeats, required '
+                 'with --cluster-bind')
+        parser.add_argument(
+            '--admin', dest='admin', action='store_true',
+            help='Serve POST /admin/reload')
+        parser.add_argument(
+            '--admin-token', dest='admin_token', metavar="secret",
+            default=env.get('AXONAL_ADMIN_TOKEN'),
+            help='Required in the %s header of /admin requests, without '
+                 'it only local clients are served' % (ADMIN_TOKEN_HEADER,))
+        parser.add_argument(
+            '--service', dest='services', metavar="module", action='append',
+            default=[], help='Import module registering services, '
+                             'repeatable')
 
-        @register('test.derp', '1.3.5')
-        class DerpService(object):
-            def echo(self, val):
-                return val
+    def configure(self, options, conf):
+        self._options = options
+        preload(options.services)
+        try:
+            new_loop = import_name(EVENT_LOOPS[options.loop])
+        except ImportError:
+            raise RuntimeError('Event loop not installed: %s' % (
+                options.loop,))
+        if (options.cluster_bind and not options.cluster_endpoint and
+                (options.unix or options.bind in ('0.0.0.0', '::'))):
+            # Peers can't reach a unix socket or a wildcard address
+            raise RuntimeError('--cluster-endpoint is required with '
+                               '--unix or a wildcard --bind')
+        if options.cluster_bind and not options.cluster_secret:
+            raise RuntimeError('--cluster-secret or AXONAL_CLUSTER_SECRET '
+                               'is required with --cluster-bind')
+        self._loop = new_loop()
+        asyncio.set_event_loop(self._loop)
+
+    def _join_cluster(self, broker):
+        """
+        Route calls for services not registered here to cluster members
+        """
+        from ..cluster import ClusterBroker, ClusterNode
+        from ..middleware.broker import Router
+        options = self._options
+        endpoint = options.cluster_endpoint or 'http://%s:%d' % (
+            options.bind, options.port)
+        self._cluster = ClusterNode(
+            endpoint, bind=_host_port(options.cluster_bind),
+            seeds=[_host_port(seed) for seed in options.cluster_seeds],
+            secret=options.cluster_secret)
+        self._cluster.start()
+        return Router([broker, ClusterBroker(self._cluster)])
 
-        app = RpcHttpApp(RegistryBroker(GlobalRegistry()))
-        handler = app.make_handler()
-        srv = await loop.create_server(handler, '127.0.0.1', 8080)
-        return srv, handler
+    def make_app(self):
+        from ..registry import GlobalRegistry
+        from ..middleware.broker import RegistryBroker
+        options = self._options
+        reloader = None
+        if options.admin:
+            from ..reload import Reloader
+            reloader = Reloader(lock_path=options.reload_lock)
+        broker = RegistryBroker(GlobalRegistry())
+        if options.cluster_bind:
+            broker = self._join_cluster(broker)
+        if options.capture:
+            from ..middleware.capture import Capture, CaptureDispatcher
+            self._capture = Capture(options.capture,
+                                    sample_rate=options.capture_rate,
+                                    max_bytes=options.capture_max_bytes)
+            broker = CaptureDispatcher(broker, self._capture)
+        return RpcHttpApp(broker, reloader=reloader,
+                          admin_token=options.admin_token,
+                          max_body_size=options.max_body_size,
+                          offload=self._cluster is not None)
+
+    async def _setup(self, loop):
+        options = self._options
+        runner = web.AppRunner(self.make_app(), handle_signals=True,
+                               keepalive_timeout=options.keepalive_timeout)
+        await runner.setup()
+        factory = runner.server
+        if options.unix:
+            srv = await loop.create_unix_server(
+                factory, options.unix, backlog=options.backlog)
+        else:
+            if not options.nodelay:
+                def nodelay_off():
+                    return _NoDelayOff(runner.server())
+                factory = nodelay_off
+            srv = await loop.create_server(
+                factory, options.bind, options.port,
+                backlog=options.backlog, reuse_address=True)
+        LOGGER.info('Listening on %s', options.unix or '%s:%d' % (
+            options.bind, options.port))
+        return srv, runner
 
     def run(self):
-        loop = asyncio.get_event_loop()
-        srv, handler = loop.run_until_complete(self._setup(loop))
+        loop = self._loop
+        srv, runner = loop.run_until_complete(self._setup(loop))
         try:
             loop.run_forever()
-        except KeyboardInterrupt:
-            loop.run_until_complete(handler.finish_connections())
+        except (KeyboardInterrupt, web.GracefulExit):
+            pass
+        finally:
+            if self._cluster is not None:
+                self._cluster.stop()
+            if self._capture is not None:
+                self._capture.close()
+            srv.close()
+            loop.run_until_complete(srv.wait_closed())
+            loop.run_until_complete(runner.cleanup())
+            loop.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+"""
+Multiplexed RPC and event delivery over a WebSocket.
+
+Each frame carries one internal protocol message, text frames for the
+JSON protocol and binary frames for msgpack (chosen with `?proto=`).
+Only the protocols in `CONTENT_TYPES` are accepted, never pickle.
+Requests are dispatched concurrently and their responses sent as they
+complete, the client matches them up by the context guid.
+
+Clients subscribe to event subjects by sending requests to the
+reserved '_ws' service, which cannot collide with registered names:
+
+    target ['_ws', '1', 'subscribe'], args ['srv.events.1.X']
+    target ['_ws', '1', 'unsubscribe'], args ['srv.events.1.X']
+"""
+import asyncio
+import logging
+
+from aiohttp import web, WSMsgType
+
+from ..middleware.eventbus import PublishingDispatcher, SubjectIndex
+from ..proto import CONTENT_TYPES, get_protocol
+from ..proto.internal import Segments
+from ..struct import Event, Fault, Request, Response, StreamResponse
+
+__all__ = ('WebSocketHub', 'WebSocketEventDispatcher')
+
+LOGGER = logging.getLogger(__name__)
+
+CONTROL_SERVICE = '_ws'
+
+
+class WebSocketConnection(object):
+    def __init__(self, hub, ws, protocol, loop, text=False):
+        self.hub = hub
+        self.ws = ws
+        self.protocol = protocol
+        self.text = text
+        self.loop = loop
+        self.subjects = set()
+        self.dropped = 0
+        self._inflight = asyncio.Semaphore(hub.max_inflight)
+        self._events = asyncio.Queue(hub.queue_size)
+        self._tasks = set()
+        self._writer = loop.create_task(self._write_events())
+
+    async def send(self, frame):
+        if isinstance(frame, str):
+            await self.ws.send_str(frame)
+        elif self.text:
+            await self.ws.send_str(bytes(frame).decode('utf-8'))
+        else:
+            if isinstance(frame, Segments):
+                frame = frame.pack()
+            await self.ws.send_bytes(bytes(frame))
+
+    def push(self, event):
+        """
+        Queue an event for delivery, dropped when the client is too slow
+        """
+        try:
+            self._events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _write_events(self):
+        while True:
+            event = await self._events.get()
+            try:
+                await self.send(self.protocol.encode(event))
+            except Exception:
+                LOGGER.exception('Failed to push event')
+
+    async def receive(self, data):
+        # Stop reading more frames until a request slot is free
+        await self._inflight.acquire()
+        try:
+            obj = self.protocol.decode(data)
+        except Exception:
+            self._inflight.release()
+            raise
+        task = self.loop.create_task(self._handle(obj))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, obj):
+        try:
+            if obj.context.target.service == CONTROL_SERVICE:
+                resp = self._control(obj)
+            elif isinstance(obj, Request):
+                resp = await self.loop.run_in_executor(
+                    None, self.hub.broker.dispatch, obj)
+            elif isinstance(obj, Event):
+                await self.loop.run_in_executor(
+                    None, self.hub.broker.dispatch, obj)
+                return
+            else:
+                raise Fault(obj.context, Fault.INVALID_REQUEST)
+            if isinstance(resp, StreamResponse):
+                await self._send_stream(resp)
+            elif resp is not None:
+                await self.send(self.protocol.encode(resp))
+        except Exception as ex:
+            if not isinstance(obj, Request):
+                LOGGER.exception('WebSocket event failed')
+                return
+            if not isinstance(ex, Fault):
+                ex = Fault(obj.context, Fault.APPLICATION_ERROR, inner=ex)
+            fault = Fault(obj.context, ex.code, ex.message, ex.data)
+            await self.send(self.protocol.encode(fault))
+        finally:
+            self._inflight.release()
+
+    async def _send_stream(self, resp):
+        frames = self.protocol.encode_stream(resp)
+        while True:
+            frame = await self.loop.run_in_executor(None, next, frames, None)
+            if frame is None:
+                break
+            await self.send(frame)
+
+    def _control(self, obj):
+        method = obj.context.target.method
+        args = obj.args
+        if not isinstance(args, (list, tuple)) or len(args) != 1:
+            raise Fault(obj.context, Fault.INVALID_PARAMS)
+        try:
+            subject = SubjectIndex.normalise(str(args[0]))
+        except ValueError as ex:
+            raise Fault(obj.context, Fault.INVALID_PARAMS, str(ex))
+        if method == 'subscribe':
+            if (subject not in self.subjects and
+                    len(self.subjects) >= self.hub.max_subscriptions):
+                raise Fault(obj.context, Fault.INVALID_REQUEST,
+                            'Too many subscriptions')
+            self.hub.subscribe(self, subject)
+        elif method == 'unsubscribe':
+            self.hub.unsubscribe(self, subject)
+        else:
+            raise Fault(obj.context, Fault.METHOD_NOT_FOUND)
+        if isinstance(obj, Request):
+            return Response(obj.context, subject)
+
+    def close(self):
+        self._writer.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+        for subject in list(self.subjects):
+            self.hub.unsubscribe(self, subject)
+
+
+class WebSocketHub(object):
+    """
+    Tracks connections and their subscriptions for one application.
+
+    :param max_inflight: concurrent requests per connection
+    :param max_subscriptions: subjects per connection
+    :param queue_size: events buffered per connection before dropping
+    :param max_msg_size: largest frame accepted from a client
+    """
+    def __init__(self, broker, max_inflight=64, max_subscriptions=64,
+                 queue_size=256, max_msg_size=4 * 1024 * 1024):
+        self.broker = broker
+        self.max_inflight = max_inflight
+        self.max_subscriptions = max_subscriptions
+        self.queue_size = queue_size
+        self.max_msg_size = max_msg_size
+        self.loop = None
+        self._subscribers = SubjectIndex()
+
+    def subscribe(self, conn, subject):
+        if subject not in conn.subjects:
+            conn.subjects.add(subject)
+            self._subscribers.add(subject, conn)
+
+    def unsubscribe(self, conn, subject):
+        if subject in conn.subjects:
+            conn.subjects.discard(subject)
+            self._subscribers.discard(subject, conn)
+
+    def _connections(self, event):
+        target = event.context.target
+        return self._subscribers.match(target.service, target.version)
+
+    def has_subscribers(self, event):
+        return len(self._connections(event)) > 0
+
+    def _publish(self, event):
+        # A connection subscribed to several matching subjects gets it once
+        for conn in set(self._connections(event)):
+            conn.push(event)
+
+    def publish(self, event):
+        """
+        Push an event to subscribed clients, safe to call from any thread
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._publish, event)
+
+    async def handle(self, request):
+        name = request.query.get('proto', 'json')
+        # Clients are untrusted, pickle would run code from their frames
+        if name not in CONTENT_TYPES:
+            raise web.HTTPBadRequest(reason='Unknown protocol')
+        protocol = get_protocol(name)
+        ws = web.WebSocketResponse(max_msg_size=self.max_msg_size)
+        await ws.prepare(request)
+        self.loop = asyncio.get_running_loop()
+        conn = WebSocketConnection(self, ws, protocol, self.loop,
+                                   text=(name == 'json'))
+        try:
+            async for msg in ws:
+                if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                    try:
+                        await conn.receive(msg.data)
+                    except Exception:
+                        LOGGER.warning('Closing WebSocket, bad frame')
+                        break
+                elif msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            conn.close()
+            await ws.close()
+        return ws
+
+
+class WebSocketEventDispatcher(PublishingDispatcher):
+    """
+    Wraps a dispatcher, every event passing through is also pushed to
+    subscribed WebSocket clients. Without an inner dispatcher events are
+    only delivered to subscribers.
+    """
+    def __init__(self, hub, dispatcher=None):
+        self.hub = hub
+        self.dispatcher = dispatcher
+
+    def has_subscribers(self, event):
+        return self.hub.has_subscribers(event)
+
+    def publish(self, event):
+        self.hub.publish(event)
@@ -7,6 +7,24 @@ class Target:
         self.method = method
 
 
+_TARGETS = dict()
+_TARGETS_MAX = 4096
+
+
+def intern_target(service: str, version: str, method: str) -> Target:
+    """
+    Returns a shared Target for the (service, version, method) tuple,
+    targets must be treated as immutable once interned.
+    """
+    key = (service, version, method)
+    target = _TARGETS.get(key)
+    if target is None:
+        if len(_TARGETS) >= _TARGETS_MAX:
+            _TARGETS.clear()
+        target = _TARGETS[key] = Target(service, version, method)
+    return target
+
+
 class Context:
     __slots__ = ('target', 'guid', 'auth', 'meta')
 
@@ -47,6 +65,9 @@ class Fault(Exception):
     SERVICE_UNKNOWN = -32001
     VERSION_UNKNOWN = -32002
     NOT_AUTHORISED = -32002
+    RATE_LIMITED = -32003
+    CIRCUIT_OPEN = -32004
+    PAYLOAD_TOO_LARGE = -32005
     __slots__ = ('context', 'code', 'message', 'data', 'inner')
 
     @classmethod
@@ -64,6 +85,14 @@ class Fault(Exception):
         self.inner = inner
 
 
+class TransportFault(Fault):
+    """
+    Fault raised when a request couldn't be delivered or its reply
+    received, rather than by the service handling it.
+    """
+    __slots__ = ()
+
+
 FAULT_MESSAGES = {
     Fault.PARSE_ERROR: 'Parse error',
     Fault.INVALID_REQUEST: 'Invalid request',
@@ -75,7 +104,10 @@ FAULT_MESSAGES = {
     Fault.APPLICATION_ERROR: 'Application error',
     Fault.SERVICE_UNKNOWN: 'Service name not found',
     Fault.VERSION_UNKNOWN: 'Service version not found',
-    Fault.NOT_AUTHORISED: 'Not authorised'
+    Fault.NOT_AUTHORISED: 'Not authorised',
+    Fault.RATE_LIMITED: 'Rate limited',
+    Fault.CIRCUIT_OPEN: 'Service unavailable, circuit open',
+    Fault.PAYLOAD_TOO_LARGE: 'Request body too large'
 }
 
 
@@ -85,3 +117,31 @@ class Response:
     def __init__(self, context, data):
         self.context = context
         self.data = data
+
+
+class StreamResponse(Response):
+    """
+    Response whose data is an iterator (or async iterator) of items
+    produced incrementally, e.g. by a generator service method.
+    """
+    __slots__ = ()
+
+    def __iter__(self):
+        return iter(self.data)
+
+
+class Partial(Response):
+    """
+    One item of a streamed response, sent as its own protocol frame
+    """
+    __slots__ = ()
+
+
+class StreamEnd(Response):
+    """
+    Marks the end of a streamed response
+    """
+    __slots__ = ()
+
+    def __init__(self, context, data=None):
+        super().__init__(context, data)
@@ -1,4 +1,10 @@
+import binascii
+import contextvars
+import datetime
+import importlib
+import itertools
 import json
+import os
 
 class _Singleton(type):
     """
@@ -17,18 +23,177 @@ class Singleton(_Singleton('SingletonMeta', (object,), {})):
     pass
 
 
+def import_name(dotted):
+    """
+    Import "package.module.Name" and return Name
+    """
+    module_name, _, name = dotted.rpartition('.')
+    if not module_name:
+        raise ImportError('Not a dotted name: %s' % (dotted,))
+    return getattr(importlib.import_module(module_name), name)
+
+
+class LazyRegistry(object):
+    """
+    Maps short names to dotted paths, nothing is imported
+    until a name is first resolved.
+    """
+    __slots__ = ('_kind', '_paths', '_loaded')
+
+    def __init__(self, kind, paths=None):
+        self._kind = kind
+        self._paths = dict(paths or {})
+        self._loaded = dict()
+
+    def __contains__(self, name):
+        return name in self._paths
+
+    def names(self):
+        return sorted(self._paths.keys())
+
+    def register(self, name, dotted):
+        self._paths[name] = dotted
+        self._loaded.pop(name, None)
+
+    def get(self, name):
+        obj = self._loaded.get(name)
+        if obj is None:
+            if name not in self._paths:
+                raise KeyError('Unknown %s: %s' % (self._kind, name))
+            obj = self._loaded[name] = import_name(self._paths[name])
+        return obj
+
+
+class GuidGenerator(object):
+    """
+    Cheap per-process correlation IDs, a random prefix and a counter.
+    The prefix is regenerated in forked children so IDs stay unique.
+    """
+    __slots__ = ('_prefix', '_counter')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._prefix = binascii.hexlify(os.urandom(8)).decode('ascii') + '-'
+        self._counter = itertools.count(1)
+
+    def __call__(self):
+        return self._prefix + '%x' % (next(self._counter),)
+
+
+next_guid = GuidGenerator()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=next_guid.reset)
+
+# Guid of the request being dispatched, for correlating log records
+current_guid = contextvars.ContextVar('axonal_guid', default=None)
+
+
+def _isoformat(o):
+    if isinstance(o, datetime.datetime):
+        o = o.replace(microsecond=0)
+        # Yes, naive datetimes are assumed to be UTC
+        if not o.utcoffset():
+            return o.replace(tzinfo=None).isoformat() + 'Z'
+        return o.isoformat()
+    elif isinstance(o, datetime.time):
+        return o.replace(microsecond=0).isoformat()
+    return o.isoformat()
+
+
 def json_default(o):
     if hasattr(o, 'to_dict'):
         return o.to_dict()
-    elif hasattr(o, 'isoformat'):
-        # Yes, UTC support only for now.
-        return o.replace(microsecond=0).isoformat() + 'Z'
+    elif isinstance(o, (datetime.date, datetime.time)):
+        return _isoformat(o)
     else:
         raise TypeError(repr(o) + " is not JSON serializable")
 
 
-def json_dumps(obj):
-    return json.dumps(obj, default=json_default, ensure_ascii=True)
+class JsonEngine(object):
+    """
+    Compact UTF-8 JSON encoding, every engine gives the same output
+    for the same input. Datetimes are ISO 8601 without microseconds,
+    naive ones with a 'Z' suffix, other objects with a `to_dict` method
+    are encoded as its result. Floats are the exception, engines may
+    format exponents differently and encode NaN as NaN or null.
+    """
+    __slots__ = ('name', 'dumps', 'dumpb', 'loads')
+
+    def __init__(self, name, dumps, dumpb, loads):
+        self.name = name
+        self.dumps = dumps
+        self.dumpb = dumpb
+        self.loads = loads
+
+
+def _stdlib_engine():
+    encode = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False,
+                              default=json_default).encode
+    decode = json.loads
+
+    def loads(data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return decode(data)
+
+    def dumpb(obj):
+        return encode(obj).encode('utf-8')
+    return JsonEngine('stdlib', encode, dumpb, loads)
+
+
+def _orjson_engine():
+    import orjson
+    stdlib = _stdlib_engine()
+    encode = orjson.dumps
+    decode = orjson.loads
+    options = (orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z |
+               orjson.OPT_OMIT_MICROSECONDS | orjson.OPT_NON_STR_KEYS)
+
+    def dumpb(obj):
+        # orjson has no hook for `to_dict`, those objects still go through
+        # the `default` callback once each
+        try:
+            return encode(obj, default=json_default, option=options)
+        except TypeError:
+            # Integers beyond 64 bits and the like
+            return stdlib.dumpb(obj)
+
+    def dumps(obj):
+        return dumpb(obj).decode('utf-8')
+
+    def loads(data):
+        try:
+            return decode(data)
+        except orjson.JSONDecodeError:
+            # NaN and Infinity, or the stdlib error for invalid input
+            return stdlib.loads(data)
+    return JsonEngine('orjson', dumps, dumpb, loads)
+
+
+JSON_ENGINES = {
+    'stdlib': _stdlib_engine,
+    'orjson': _orjson_engine,
+}
+
+
+def get_json_engine(name=None):
+    """
+    The named engine, by default $AXONAL_JSON or the fastest installed
+    """
+    if name is None:
+        name = os.environ.get('AXONAL_JSON')
+    if name is not None:
+        return JSON_ENGINES[name]()
+    try:
+        return _orjson_engine()
+    except ImportError:
+        return _stdlib_engine()
+
 
-def json_dumpb(obj):
-    return json_dumps(obj).encode('utf-8')
\ No newline at end of file
+json_engine = get_json_engine()
+json_dumps = json_engine.dumps
+json_dumpb = json_engine.dumpb
+json_loads = json_engine.loads
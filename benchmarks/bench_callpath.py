@@ -0,0 +1,49 @@
+"""
+Measures CPU time and allocations per call through ServiceProxy.
+
+    python benchmarks/bench_callpath.py
+"""
+import gc
+import timeit
+import tracemalloc
+
+from axonal.middleware.broker import Router, RegistryBroker
+from axonal.middleware.proxy import ServiceProxy
+from axonal.registry import Registry
+
+CALLS = 100000
+
+
+class EchoService(object):
+    _service_name = 'bench.echo'
+    _service_versions = ['1']
+
+    def echo(self, val):
+        return val
+
+
+def _proxy():
+    registry = Registry()
+    registry.services = {'bench.echo': {'1.X.X': EchoService}}
+    registry.classes = [EchoService]
+    return ServiceProxy(Router([RegistryBroker(registry)]), 'bench.echo', '1')
+
+
+def main():
+    proxy = _proxy()
+    method = proxy.echo
+    method(1)
+    seconds = timeit.timeit(lambda: method(1), number=CALLS)
+    print('cpu/call:    %.2f us' % (seconds / CALLS * 1e6,))
+
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    method(1)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('bytes/call:  %d (peak traced)' % (peak - current,))
+
+
+if __name__ == '__main__':
+    main()
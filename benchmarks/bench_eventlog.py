@@ -0,0 +1,56 @@
+"""
+Events per second appended to an EventLog at each durability setting.
+
+    python benchmarks/bench_eventlog.py [directory]
+"""
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from axonal.middleware.dispatcher import ProtocolTransportDispatcher
+from axonal.middleware.eventlog import EventLog, EventLogTransport
+from axonal.proto.internal import JsonInternalProtocol
+from axonal.struct import Context, Event, Target
+
+EVENTS = 2000
+WRITERS = (1, 8, 32)
+
+
+def _run(directory, sync, writers):
+    log = EventLog(directory, sync=sync)
+    dispatcher = ProtocolTransportDispatcher(JsonInternalProtocol(),
+                                             EventLogTransport(log))
+    target = Target('bench.events', '1', 'happened')
+    per_writer = EVENTS // writers
+
+    def _writer(num):
+        for idx in range(per_writer):
+            ctx = Context(target, '%d-%d' % (num, idx), None, None)
+            dispatcher.dispatch(Event(ctx, {'n': idx, 'pad': 'x' * 200}))
+    threads = [threading.Thread(target=_writer, args=(num,))
+               for num in range(writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    log.close()
+    return per_writer * writers / elapsed
+
+
+def main(base_dir=None):
+    for sync in EventLog.SYNC_MODES:
+        for writers in WRITERS:
+            directory = tempfile.mkdtemp(dir=base_dir)
+            try:
+                rate = _run(directory, sync, writers)
+            finally:
+                shutil.rmtree(directory)
+            print('%-7s writers=%-3d %10.0f events/s' % (sync, writers, rate))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,89 @@
+"""
+Requests per second through RpcHttpPlugin for each listener setting.
+Each setting starts a server process which loads this module as its
+service, then concurrent clients call it over keep-alive connections.
+
+    python benchmarks/bench_httpd.py [requests] [concurrency]
+"""
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from axonal.registry import register
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+PORT = 18080
+
+
+@register('bench.echo', '1')
+class EchoService(object):
+    def echo(self, val):
+        return val
+
+
+def _settings(unix_path):
+    yield 'tcp', ['--port', str(PORT)]
+    yield 'tcp no-nodelay', ['--port', str(PORT), '--no-nodelay']
+    yield 'tcp backlog=2048', ['--port', str(PORT), '--backlog', '2048']
+    yield 'tcp keepalive=1s', ['--port', str(PORT),
+                               '--keepalive-timeout', '1']
+    yield 'unix', ['--unix', unix_path]
+    try:
+        import uvloop  # noqa
+        yield 'tcp uvloop', ['--port', str(PORT), '--loop', 'uvloop']
+        yield 'unix uvloop', ['--unix', unix_path, '--loop', 'uvloop']
+    except ImportError:
+        pass
+
+
+async def _client(session, url, count):
+    for num in range(count):
+        async with session.get(url, params={'val': str(num)}) as resp:
+            await resp.read()
+
+
+async def _load(args, total, concurrency):
+    import aiohttp
+    if '--unix' in args:
+        connector = aiohttp.UnixConnector(args[args.index('--unix') + 1])
+        base = 'http://localhost'
+    else:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        base = 'http://127.0.0.1:%d' % (PORT,)
+    url = base + '/svc/bench.echo/1/echo'
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for _ in range(50):
+            try:
+                await _client(session, url, 1)
+                break
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.1)
+        started = time.perf_counter()
+        await asyncio.gather(*[_client(session, url, total // concurrency)
+                               for _ in range(concurrency)])
+        return time.perf_counter() - started
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, HERE]))
+    unix_path = os.path.join(tempfile.mkdtemp(), 'axonal.sock')
+    for name, args in _settings(unix_path):
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'axonal.server.httpd', '--log-queue', '0',
+             '--service', 'bench_httpd'] + args, env=env, cwd=ROOT)
+        try:
+            seconds = asyncio.run(_load(args, total, concurrency))
+        finally:
+            proc.terminate()
+            proc.wait()
+        print('%-20s %8.0f req/s' % (name, total / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Encode and decode time per message for each installed JSON engine.
+
+    python benchmarks/bench_json.py
+"""
+import datetime
+import timeit
+
+from axonal.utils import get_json_engine, JSON_ENGINES
+
+CALLS = 20000
+
+
+class Row(object):
+    def __init__(self, num):
+        self.num = num
+
+    def to_dict(self):
+        return {'id': self.num, 'name': 'row %d' % (self.num,),
+                'tags': ['a', 'b']}
+
+
+MESSAGES = {
+    'request': {'V': 1, '_': 'Q', 'T': ['bench.echo', '1', 'echo'],
+                'C': '0123456789abcdef-1', 'A': [1, 'two', 3.0]},
+    'records': {'V': 1, '_': 'R', 'C': '0123456789abcdef-2',
+                'D': [{'id': num, 'when': datetime.datetime(2016, 3, 4),
+                       'text': 'caf\xe9 %d' % (num,)} for num in range(50)]},
+    'to_dict': {'V': 1, '_': 'R', 'C': '0123456789abcdef-3',
+                'D': [Row(num) for num in range(50)]},
+}
+
+
+def main():
+    for name in sorted(JSON_ENGINES):
+        try:
+            engine = get_json_engine(name)
+        except ImportError:
+            print('%-8s not installed' % (name,))
+            continue
+        for kind, msg in sorted(MESSAGES.items()):
+            data = engine.dumpb(msg)
+            encode = timeit.timeit(lambda: engine.dumpb(msg), number=CALLS)
+            decode = timeit.timeit(lambda: engine.loads(data), number=CALLS)
+            print('%-8s %-8s encode %7.2f us  decode %7.2f us  %5d bytes' % (
+                name, kind, encode / CALLS * 1e6, decode / CALLS * 1e6,
+                len(data)))
+
+
+if __name__ == '__main__':
+    main()
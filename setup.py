@@ -20,6 +20,10 @@ requirements = [
 if sys.version_info[:2] < (3, 4):
     requirements.append('asyncio')
 
+extra_requirements = {
+    'orjson': ['orjson'],
+}
+
 test_requirements = [
     'pytest'
 ]
@@ -40,6 +44,7 @@ setup(
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="BSD",
     zip_safe=False,
     keywords='axonal',
@@ -0,0 +1,33 @@
+import asyncio
+from functools import partial
+
+from axonal.middleware.broker import Router, RegistryBroker
+from axonal.middleware.proxy import AsyncServiceProxy, gather, scatter
+from axonal.registry import GlobalRegistry, register
+from axonal.struct import Fault
+
+
+@register('test.fanout', '2')
+class FanoutService(object):
+    def square(self, val):
+        return val * val
+
+    def fail(self):
+        raise RuntimeError('Oops')
+
+
+def test_async_fanout():
+    router = Router([RegistryBroker(GlobalRegistry())])
+    proxy = AsyncServiceProxy(router, 'test.fanout', '2')
+
+    async def _main():
+        assert await proxy.square(3) == 9
+        squares = await scatter(proxy.square, [(n,) for n in range(10)], 3)
+        assert squares == [n * n for n in range(10)]
+        return await gather([partial(proxy.square, val=4), proxy.fail,
+                             proxy.missing])
+    result, failed, missing = asyncio.run(_main())
+    assert result == 16
+    assert isinstance(failed, Fault)
+    assert failed.code == Fault.APPLICATION_ERROR
+    assert missing.code == Fault.METHOD_NOT_FOUND
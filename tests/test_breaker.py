@@ -0,0 +1,59 @@
+import pytest
+
+from axonal.interface import Dispatcher
+from axonal.middleware.breaker import (CircuitBreakerDispatcher, CLOSED,
+                                       HALF_OPEN, OPEN)
+from axonal.struct import Context, Fault, Request, Response, Target
+
+
+class FlakyDispatcher(Dispatcher):
+    def __init__(self):
+        self.failing = True
+        self.calls = 0
+
+    def can_dispatch(self, request):
+        return True
+
+    def dispatch(self, request):
+        self.calls += 1
+        if self.failing:
+            raise Fault(request.context, Fault.INTERNAL_ERROR)
+        return Response(request.context, 'ok')
+
+
+def _request():
+    return Request(Context(Target('test.flaky', '1', 'get'), 'x', None,
+                           None), [])
+
+
+def test_breaker_trips_and_recovers():
+    changes = []
+
+    def listener(name, old, new):
+        # Listeners run once the breaker's lock is released
+        lock = breaker.breaker('test.flaky', '1')._lock
+        assert lock.acquire(blocking=False)
+        lock.release()
+        changes.append((old, new))
+    inner = FlakyDispatcher()
+    breaker = CircuitBreakerDispatcher(
+        inner, 'local', min_calls=4, open_seconds=0, probes=2,
+        listener=listener)
+    for _ in range(4):
+        with pytest.raises(Fault) as excinfo:
+            breaker.dispatch(_request())
+        assert excinfo.value.code == Fault.INTERNAL_ERROR
+    state = breaker.breaker('test.flaky', '1')
+    assert state.state == OPEN
+    state.open_seconds = 60
+    with pytest.raises(Fault) as excinfo:
+        breaker.dispatch(_request())
+    assert excinfo.value.code == Fault.CIRCUIT_OPEN
+    assert inner.calls == 4
+
+    state.open_seconds = 0
+    inner.failing = False
+    assert breaker.dispatch(_request()).data == 'ok'
+    assert breaker.dispatch(_request()).data == 'ok'
+    assert state.state == CLOSED
+    assert changes == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
@@ -0,0 +1,81 @@
+import time
+
+from axonal.interface import Dispatcher
+from axonal.middleware.capture import (Capture, CaptureDispatcher,
+                                       CaptureReader, replay)
+from axonal.struct import Context, Event, Fault, Request, Response, Target
+
+
+class Sleeper(Dispatcher):
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = []
+
+    def can_dispatch(self, request):
+        return True
+
+    def dispatch(self, request):
+        self.calls.append(request.args[0])
+        time.sleep(self.delay)
+        if request.args[0] < 0:
+            raise Fault(request.context, Fault.APPLICATION_ERROR)
+        if not request.is_event:
+            return Response(request.context, request.args[0])
+
+
+def _call(method, num, cls=Request):
+    return cls(Context(Target('test.capture', '1', method), str(num), None,
+                       None), [num])
+
+
+def test_capture_and_replay(tmp_path):
+    path = str(tmp_path / 'calls.cap')
+    capture = Capture(path)
+    dispatcher = CaptureDispatcher(Sleeper(0.01), capture)
+    for num in range(5):
+        dispatcher.dispatch(_call('slow', num))
+    dispatcher.dispatch(_call('notify', 9, Event))
+    try:
+        dispatcher.dispatch(_call('slow', -1))
+    except Fault:
+        pass
+    capture.close()
+
+    with CaptureReader(path) as reader:
+        assert reader.protocol == 'json'
+        calls = list(reader)
+    assert len(calls) == 7
+    assert all(call.seconds >= 0.01 for call in calls)
+    assert [call.is_event for call in calls].count(True) == 1
+    assert calls[-1].is_fault
+
+    # A torn record at the end is ignored
+    with open(path, 'ab') as handle:
+        handle.write(b'\x00' * 7)
+    target = Sleeper(0.0)
+    report = replay(path, target, speed=0)
+    assert sorted(target.calls) == [-1, 0, 1, 2, 3, 4, 9]
+    slow = report.targets['test.capture.1.slow']
+    assert slow.calls == 6
+    assert slow.faults == slow.captured_faults == 1
+    assert slow.difference() < 0
+    assert 'test.capture.1.notify' in report.format()
+
+
+def test_capture_sampling_and_limit(tmp_path):
+    path = str(tmp_path / 'calls.cap')
+    capture = Capture(path, sample_rate=0.0)
+    dispatcher = CaptureDispatcher(Sleeper(0.0), capture)
+    dispatcher.dispatch(_call('fast', 1))
+    assert capture.records == 0
+    capture.close()
+
+    capture = Capture(path, max_bytes=200)
+    dispatcher = CaptureDispatcher(Sleeper(0.0), capture)
+    for num in range(10):
+        assert dispatcher.dispatch(_call('fast', num)).data == num
+    assert capture.full
+    assert 0 < capture.records < 10
+    capture.close()
+    with CaptureReader(path) as reader:
+        assert len(list(reader)) == capture.records
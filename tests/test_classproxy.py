@@ -21,6 +21,10 @@ def test_derp():
     with pytest.raises(Fault) as excinfo:
         proxy.merp()
     assert excinfo.value.code == Fault.METHOD_NOT_FOUND
+    # Unknown names from clients don't grow the proxy without bound
+    for num in range(1000):
+        getattr(proxy, 'missing%d' % (num,))
+    assert len(proxy._methods) <= 256
 
 
 def test_protoproxy():
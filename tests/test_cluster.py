@@ -0,0 +1,205 @@
+import asyncio
+import http.client
+import socket
+import threading
+import time
+
+import pytest
+from aiohttp import web
+
+from axonal.cluster import ClusterBroker, ClusterNode, _sign
+from axonal.middleware.broker import RegistryBroker, Router
+from axonal.middleware.dispatcher import (ProtocolDispatcherTransport,
+                                          ProtocolTransportDispatcher)
+from axonal.middleware.httpclient import HttpTransport
+from axonal.proto.internal import JsonInternalProtocol
+from axonal.registry import Registry
+from axonal.server.httpd import RpcHttpApp
+from axonal.struct import Context, Fault, Request, Target, TransportFault
+
+
+class RemoteService(object):
+    _service_name = 'test.remote'
+    _service_versions = ['1.2']
+    _service_idempotent = frozenset(['where'])
+
+    def where(self):
+        return 'remote'
+
+    def fail(self):
+        raise Fault(None, Fault.INTERNAL_ERROR)
+
+    def count(self, num):
+        for idx in range(num):
+            yield idx
+
+
+def _registry(classes):
+    registry = Registry()
+    registry.services = dict()
+    for cls in classes:
+        registry.services[cls._service_name] = {
+            '1.2.X': cls, '1.X.X': cls}
+    registry.classes = list(classes)
+    return registry
+
+
+def _wait(check, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+SECRET = 'test-secret'
+
+
+def _request(method, args=()):
+    ctx = Context(Target('test.remote', '1', method), 'g', None, None)
+    return Request(ctx, list(args))
+
+
+def test_discovery_and_failure():
+    remote = _registry([RemoteService])
+    local = RegistryBroker(remote)
+    nodes = [ClusterNode('mem://a', registry=remote, interval=0.05,
+                         secret=SECRET).start()]
+    seed = nodes[0].address
+    nodes.append(ClusterNode('mem://b', registry=_registry([]), seeds=[seed],
+                             interval=0.05, secret=SECRET).start())
+    # Only knows b, learns of a through b's heartbeats
+    nodes.append(ClusterNode('mem://c', registry=_registry([]),
+                             seeds=[nodes[1].address], interval=0.05,
+                             secret=SECRET, max_learned=2).start())
+    proto = JsonInternalProtocol()
+    try:
+        client = nodes[2]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for junk in (b'{"v": 1, "id": "x", "seq": 1, "svc": [1]}',
+                     b'{"v": 1, "id": "x", "seq": 1, "peers": [[]]}',
+                     b'{"v": 1, "id": "x", "seq": 1, "load": "high"}',
+                     b'\xff'):
+            sock.sendto(_sign(SECRET.encode(), junk), client.address)
+        peers = ', '.join('["10.9.9.%d", 7946]' % (num,) for num in range(9))
+        forged = ('{"v": 1, "id": "y", "seq": 1, "ep": "http://evil", '
+                  '"svc": [["test.remote", "1.X.X"]], "peers": [%s]}' % (
+                      peers,)).encode()
+        sock.sendto(forged, client.address)
+        sock.sendto(_sign(b'wrong', forged), client.address)
+        # Signed, but its peers are only learned up to max_learned
+        flood = ('{"v": 1, "id": "z", "seq": 1, "ep": "mem://z", '
+                 '"peers": [%s]}' % (peers,)).encode()
+        sock.sendto(_sign(SECRET.encode(), flood), client.address)
+        sock.close()
+        _wait(lambda: client.endpoints('test.remote', '1') == ('mem://a',))
+        _wait(lambda: 'z' in client.members)
+        assert 'x' not in client.members
+        assert 'y' not in client.members
+        assert len(client._learned) <= 2
+        assert client.endpoints('test.remote', '1.2.7') == ('mem://a',)
+        assert client.endpoints('test.remote', '2') == ()
+        assert client.is_idempotent('test.remote', 'where')
+        assert not client.is_idempotent('test.remote', 'fail')
+        cluster = ClusterBroker(
+            client, lambda ep: ProtocolDispatcherTransport(proto, local))
+        broker = Router([cluster])
+        assert broker.dispatch(_request('where')).data == 'remote'
+        # The service's own faults don't count against the member
+        for _ in range(5):
+            with pytest.raises(Fault):
+                broker.dispatch(_request('fail'))
+        assert cluster._backends['mem://a'].failures == 0
+        nodes[0].stop()
+        _wait(lambda: client.endpoints('test.remote', '1') == ())
+        with pytest.raises(Fault) as excinfo:
+            broker.dispatch(_request('where'))
+        assert excinfo.value.code == Fault.SERVICE_UNKNOWN
+        assert client._thread.is_alive()
+    finally:
+        for node in nodes[1:]:
+            node.stop()
+
+
+def test_secret_required():
+    with pytest.raises(ValueError):
+        ClusterNode('mem://a', registry=_registry([]))
+
+
+def test_http_transport():
+    app = RpcHttpApp(RegistryBroker(_registry([RemoteService])))
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        dispatcher = ProtocolTransportDispatcher(
+            JsonInternalProtocol(),
+            HttpTransport('http://127.0.0.1:%d' % (port,)))
+        assert dispatcher.dispatch(_request('where')).data == 'remote'
+        assert dispatcher.dispatch(_request('where')).data == 'remote'
+        stream = dispatcher.dispatch(_request('count', [3]))
+        assert list(stream) == [0, 1, 2]
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+class FakeResponse(object):
+    status = 200
+
+    def read(self):
+        return b'ok'
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class FakeConnection(object):
+    requests = []
+
+    def __init__(self, netloc, timeout=None, fail=None):
+        self.fail = fail
+
+    def request(self, method, path, body=None, headers=None):
+        FakeConnection.requests.append(body)
+        if self.fail == 'send':
+            raise BrokenPipeError()
+
+    def getresponse(self):
+        if self.fail == 'response':
+            raise http.client.RemoteDisconnected()
+        return FakeResponse()
+
+    def close(self):
+        pass
+
+
+def test_http_transport_resends_safely(monkeypatch):
+    monkeypatch.setattr(http.client, 'HTTPConnection', FakeConnection)
+    ctx = _request('where').context
+
+    def send(fail, idempotent=None):
+        del FakeConnection.requests[:]
+        transport = HttpTransport('http://127.0.0.1:1',
+                                  idempotent=idempotent)
+        # A kept-alive connection the server has since closed
+        transport._local.conn = FakeConnection(None, fail=fail)
+        return transport.send_request(ctx, b'{}')
+
+    # Failed while sending a kept-alive connection, never ran
+    assert send('send') == b'ok'
+    assert len(FakeConnection.requests) == 2
+    # Sent, may have run, only resent when idempotent
+    with pytest.raises(TransportFault):
+        send('response')
+    assert len(FakeConnection.requests) == 1
+    assert send('response', lambda service, method: True) == b'ok'
+    assert len(FakeConnection.requests) == 2
+    with pytest.raises(TransportFault):
+        send('response', lambda service, method: False)
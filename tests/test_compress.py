@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from axonal.interface import Protocol
+from axonal.proto.compress import CompressedProtocol, MAGIC
+from axonal.proto.internal import JsonInternalProtocol
+from axonal.struct import Context, Fault, Response, Target
+
+
+class NoiseProtocol(Protocol):
+    def encode(self, obj):
+        return os.urandom(4096)
+
+
+def _response(data):
+    return Response(Context(Target('test.big', '1', 'get'), 'x', None, None),
+                    data)
+
+
+def test_threshold_compression():
+    seen = []
+    plain = JsonInternalProtocol()
+    proto = CompressedProtocol(plain, 'zlib', threshold=1024,
+                               on_message=lambda *args: seen.append(args))
+    small = proto.encode(_response('tiny'))
+    assert small == plain.encode(_response('tiny'))
+    big = proto.encode(_response(['repeated value'] * 1000))
+    assert big.startswith(MAGIC)
+    assert proto.decode(big).data == ['repeated value'] * 1000
+    assert proto.decode(small).data == 'tiny'
+    assert len(seen) == 1
+    codec, raw_size, compressed_size, seconds = seen[0]
+    assert codec == 'zlib' and raw_size > 10 * compressed_size
+    assert proto.stats.messages == 1
+    assert proto.stats.ratio > 10
+
+
+def test_incompressible_counted():
+    seen = []
+    proto = CompressedProtocol(NoiseProtocol(), 'zlib', threshold=1024,
+                               on_message=lambda *args: seen.append(args))
+    assert not proto.encode(None).startswith(MAGIC)
+    # Tried but sent as-is, its cost still counts
+    assert len(seen) == 1 and seen[0][2] >= seen[0][1]
+    assert proto.stats.messages == proto.stats.skipped == 1
+    assert proto.stats.raw_bytes == proto.stats.compressed_bytes == 4096
+    assert proto.stats.seconds == seen[0][3] > 0
+
+
+def test_truncated_zlib():
+    proto = CompressedProtocol(JsonInternalProtocol(), 'zlib', threshold=0)
+    data = proto.encode(_response(['repeated value'] * 1000))
+    with pytest.raises(Fault) as excinfo:
+        proto.decode(data[:-8])
+    assert excinfo.value.code == Fault.PARSE_ERROR
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lz4', 'zstd'])
+def test_decompression_limit(codec):
+    if codec != 'zlib':
+        pytest.importorskip({'lz4': 'lz4.frame', 'zstd': 'zstandard'}[codec])
+    sender = CompressedProtocol(JsonInternalProtocol(), codec, threshold=0)
+    receiver = CompressedProtocol(JsonInternalProtocol(), codec,
+                                  max_size=4096)
+    bomb = sender.encode(_response('x' * 1000000))
+    with pytest.raises(Fault) as excinfo:
+        receiver.decode(bomb)
+    assert excinfo.value.code == Fault.PARSE_ERROR
+    assert receiver.decode(sender.encode(_response('ok'))).data == 'ok'
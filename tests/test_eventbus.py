@@ -0,0 +1,75 @@
+import threading
+import time
+
+from axonal.middleware.eventbus import EventBus, SubjectIndex
+from axonal.registry import parse_subject
+from axonal.struct import Context, Event, Target
+
+
+def _event(version, args):
+    ctx = Context(Target('srv.events', version, 'happened'), 'x', None,
+                  None)
+    return Event(ctx, args)
+
+
+def test_subject_matching_and_fanout():
+    bus = EventBus()
+    received = []
+    on_async = []
+
+    async def _async_handler(event):
+        on_async.append(event.args)
+
+    try:
+        bus.subscribe('srv.events.1.X', lambda e: received.append(
+            ('any', e.args)))
+        bus.subscribe('srv.events.1.3.5', lambda e: received.append(
+            ('exact', e.args)))
+        bus.subscribe('srv.events.2', lambda e: received.append(
+            ('two', e.args)))
+        sub = bus.subscribe('srv.events.1', _async_handler)
+        assert bus.can_dispatch(_event('1.3.5', 1))
+        assert not bus.can_dispatch(_event('3', 1))
+        assert bus.dispatch(_event('1.3.5', 1)) is None
+        bus.dispatch(_event('1.4', 2))
+        bus.join(5)
+        assert sorted(received) == [('any', 1), ('any', 2), ('exact', 1)]
+        assert on_async == [1, 2]
+        bus.unsubscribe(sub)
+        bus.dispatch(_event('1', 3))
+        bus.join(5)
+        assert on_async == [1, 2]
+    finally:
+        bus.close()
+
+
+def test_slow_subscriber_does_not_stall_others():
+    bus = EventBus(queue_size=2)
+    release = threading.Event()
+    fast = []
+    try:
+        slow = bus.subscribe('srv.events.1', lambda e: release.wait(5))
+        bus.subscribe('srv.events.1', lambda e: fast.append(e.args),
+                      queue_size=10)
+        for num in range(5):
+            bus.dispatch(_event('1', num))
+        for _ in range(500):
+            if len(fast) == 5:
+                break
+            time.sleep(0.01)
+        assert fast == [0, 1, 2, 3, 4]
+        assert slow.dropped >= 2
+        release.set()
+        bus.join(5)
+    finally:
+        release.set()
+        bus.close()
+
+
+def test_numeric_name_segments():
+    assert parse_subject('srv.123.1') == ('srv.123', '1.X.X')
+    assert parse_subject('srv.events.1.3.5') == ('srv.events', '1.3.5')
+    index = SubjectIndex()
+    index.add(SubjectIndex.normalise('srv.123.1.X'), 'a')
+    assert index.match('srv.123', '1.4.2') == ('a',)
+    assert index.match('srv', '123.1') == ()
@@ -0,0 +1,83 @@
+import os
+import time
+
+from axonal.interface import Dispatcher
+from axonal.middleware.dispatcher import ProtocolTransportDispatcher
+from axonal.middleware.eventlog import (EventLog, EventLogConsumer,
+                                        EventLogTransport)
+from axonal.proto.internal import JsonInternalProtocol
+from axonal.struct import Context, Event, Fault, Target
+
+
+class Collector(Dispatcher):
+    def __init__(self):
+        self.events = []
+        self.fail = False
+
+    def can_dispatch(self, request):
+        return True
+
+    def dispatch(self, request):
+        if self.fail:
+            raise Fault(request.context, Fault.INTERNAL_ERROR)
+        self.events.append(request.args[0])
+
+
+def _event(num):
+    return Event(Context(Target('test.log', '1', 'seen'), str(num), None,
+                         None), [num])
+
+
+def test_event_log_delivery_and_replay(tmp_path):
+    proto = JsonInternalProtocol()
+    log = EventLog(str(tmp_path), segment_size=256, sync='group')
+    emitter = ProtocolTransportDispatcher(proto, EventLogTransport(log))
+    for num in range(20):
+        emitter.dispatch(_event(num))
+    assert len([name for name in os.listdir(str(tmp_path))
+                if name.endswith('.log')]) > 1
+
+    collector = Collector()
+    consumer = EventLogConsumer(log, 'test', proto, collector)
+    assert consumer.poll(max_records=5) == 5
+    assert consumer.poll() == 15
+    assert consumer.poll() == 0
+    assert collector.events == list(range(20))
+    log.close()
+
+    # Torn tail from a crash is dropped, the offset survives a restart
+    tail = sorted(os.listdir(str(tmp_path)))[-2]
+    with open(os.path.join(str(tmp_path), tail), 'ab') as handle:
+        handle.write(b'\x00\x00\x01\x00partial')
+    log = EventLog(str(tmp_path), segment_size=256, sync='always')
+    consumer = EventLogConsumer(log, 'test', proto, collector)
+    emitter = ProtocolTransportDispatcher(proto, EventLogTransport(log))
+    emitter.dispatch(_event(20))
+    assert consumer.poll() == 1
+    assert collector.events[-1] == 20
+    consumer.replay(0)
+    assert consumer.poll() == 21
+    log.close()
+
+
+def test_event_log_redelivers_failed_events(tmp_path):
+    proto = JsonInternalProtocol()
+    log = EventLog(str(tmp_path), sync='none')
+    emitter = ProtocolTransportDispatcher(proto, EventLogTransport(log))
+    for num in range(3):
+        emitter.dispatch(_event(num))
+    collector = Collector()
+    consumer = EventLogConsumer(log, 'test', proto, collector,
+                                retry_delay=0.05)
+    assert consumer.poll(max_records=1) == 1
+    collector.fail = True
+    assert consumer.poll() == 0
+    assert consumer.failures == 1
+    # The receiver is back, nothing is polled until the retry delay
+    collector.fail = False
+    assert consumer.poll() == 0
+    time.sleep(0.06)
+    assert consumer.poll() == 2
+    assert collector.events == [0, 1, 2]
+    assert consumer.failures == 0
+    log.close()
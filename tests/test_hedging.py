@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+
+from axonal.interface import Dispatcher
+from axonal.middleware.hedging import HedgingDispatcher, RetryBudget
+from axonal.registry import Registry, idempotent
+from axonal.struct import Context, Fault, Request, Response, Target
+
+
+class Replica(Dispatcher):
+    def __init__(self, name, delay=0.0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def can_dispatch(self, request):
+        return True
+
+    def dispatch(self, request):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise Fault(request.context, Fault.INTERNAL_ERROR)
+        return Response(request.context, self.name)
+
+
+class LookupService(object):
+    _service_name = 'test.lookup'
+    _service_versions = ['1']
+
+    @idempotent
+    def get(self):
+        pass
+
+    def put(self):
+        pass
+
+
+def _request(method):
+    return Request(Context(Target('test.lookup', '1', method), 'x', None,
+                           None), [])
+
+
+def test_idempotent_declaration():
+    registry = Registry()
+    registry.services = {'test.lookup': {'1.X.X': LookupService}}
+    assert registry.is_idempotent('test.lookup', '1', 'get')
+    assert not registry.is_idempotent('test.lookup', '1', 'put')
+    assert not registry.is_idempotent('test.missing', '1', 'get')
+
+
+def test_hedge_beats_slow_replica():
+    slow = Replica('slow', delay=0.5)
+    fast = Replica('fast', delay=0.001)
+    hedger = HedgingDispatcher([fast, slow], is_idempotent=lambda req: True,
+                               min_hedge_delay=0.01)
+    for _ in range(4):
+        hedger.dispatch(_request('get'))
+    started = time.monotonic()
+    assert hedger.dispatch(_request('get')).data == 'fast'
+    assert time.monotonic() - started < 0.4
+    assert slow.calls >= 1
+
+
+def test_retry_within_budget():
+    bad = Replica('bad', fail=True)
+    good = Replica('good')
+    hedger = HedgingDispatcher([bad, good], is_idempotent=lambda req: True,
+                               backoff=0.001)
+    assert hedger.dispatch(_request('get')).data == 'good'
+
+    broke = HedgingDispatcher([bad], is_idempotent=lambda req: True,
+                              budget=RetryBudget(0, 0, 0), backoff=0.001)
+    calls = bad.calls
+    with pytest.raises(Fault):
+        broke.dispatch(_request('get'))
+    assert bad.calls == calls + 1
+
+    once = HedgingDispatcher([bad, good], is_idempotent=lambda req: False)
+    with pytest.raises(Fault):
+        once.dispatch(_request('put'))
+
+
+def test_idempotency_comes_from_services():
+    hedger = HedgingDispatcher([Replica('local')], idempotent=[
+        ('test.other', None), ('test.lookup', 'get')])
+    request = Request(Context(Target('test.lookup', '1', 'put'), 'x', None,
+                              {'idempotent': True}), [])
+    # Callers can't mark their own requests as safe to hedge
+    assert not hedger.is_idempotent(request)
+    assert hedger.is_idempotent(_request('get'))
+    assert hedger.is_idempotent(Request(Context(
+        Target('test.other', '1', 'any'), 'x', None, None), []))
+
+    class Advertised(Replica):
+        def is_idempotent(self, request):
+            return request.context.target.method == 'put'
+    hedger.close()
+    hedger = HedgingDispatcher([Advertised('remote')])
+    assert hedger.is_idempotent(request)
+    hedger.close()
+    assert hedger.executor._shutdown
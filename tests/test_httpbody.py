@@ -0,0 +1,186 @@
+import asyncio
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from axonal.middleware.broker import RegistryBroker
+from axonal.proto.internal import JsonInternalProtocol
+from axonal.registry import Registry, accepts_stream
+from axonal.server.httpd import RpcHttpApp
+from axonal.proto import TARGET_HEADER
+from axonal.struct import Context, Fault, Request, Response, Target
+
+
+class UploadService(object):
+    _service_name = 'test.upload'
+    _service_versions = ['1']
+
+    def echo(self, val):
+        return val
+
+    def ticks(self, count):
+        for num in range(int(count)):
+            time.sleep(0.1)
+            yield num
+
+    @accepts_stream
+    async def count(self, body, name=None):
+        total = 0
+        async for chunk in body:
+            total += len(chunk)
+        return [name, total]
+
+
+def _app(**kwargs):
+    registry = Registry()
+    registry.services = {'test.upload': {'1.X.X': UploadService}}
+    registry.classes = [UploadService]
+    return RpcHttpApp(RegistryBroker(registry), **kwargs)
+
+
+def _run(app, check):
+    async def _main():
+        async with TestClient(TestServer(app)) as client:
+            await check(client)
+    asyncio.run(_main())
+
+
+def test_body_limits():
+    app = _app(max_body_size=1024,
+               body_limits={('test.upload', 'count'): 4096})
+
+    async def check(client):
+        resp = await client.post('/svc/test.upload/1/echo',
+                                 data={'val': 'hi'})
+        assert await resp.json() == 'hi'
+        resp = await client.post('/svc/test.upload/1/echo',
+                                 json={'val': [1, 2]})
+        assert await resp.json() == [1, 2]
+        resp = await client.post('/svc/test.upload/1/echo',
+                                 data={'val': 'x' * 2000})
+        assert resp.status == 413
+
+        async def chunks(count):
+            for _ in range(count):
+                yield b'x' * 1000
+        # Without a Content-Length the limit applies while streaming
+        resp = await client.post('/svc/test.upload/1/echo',
+                                 data=chunks(2),
+                                 headers={'Content-Type': 'application/json'})
+        assert resp.status == 413
+        resp = await client.post('/svc/test.upload/1/count?name=a',
+                                 data=chunks(3))
+        assert await resp.json() == ['a', 3000]
+        resp = await client.post('/svc/test.upload/1/count', data=chunks(5))
+        assert resp.status == 413
+    _run(app, check)
+
+
+def test_slow_stream_leaves_loop_free():
+    app = _app()
+
+    async def check(client):
+        done = []
+
+        async def fetch(url):
+            resp = await client.get(url)
+            await resp.read()
+            done.append(url)
+        await asyncio.gather(
+            fetch('/svc/test.upload/1/ticks?count=5'),
+            fetch('/svc/test.upload/1/echo?val=hi'))
+        assert done[0].endswith('echo?val=hi')
+
+        # Nor do frames streamed from /rpc
+        proto = JsonInternalProtocol()
+        ticks = proto.encode(Request(Context(
+            Target('test.upload', '1', 'ticks'), 'g1', None, None), [5]))
+        done = []
+
+        async def post():
+            resp = await client.post('/rpc', data=ticks, headers={
+                'Content-Type': 'application/x-axonal-json'})
+            await resp.read()
+            done.append('rpc')
+
+        async def echo():
+            await asyncio.sleep(0.1)
+            await fetch('/svc/test.upload/1/echo?val=hi')
+        await asyncio.gather(post(), echo())
+        assert done == ['/svc/test.upload/1/echo?val=hi', 'rpc']
+    _run(app, check)
+
+
+def test_auth_from_request():
+    seen = []
+
+    class Recorder(RegistryBroker):
+        def dispatch(self, request):
+            seen.append(request.context.auth)
+            return super().dispatch(request)
+    registry = Registry()
+    registry.services = {'test.upload': {'1.X.X': UploadService}}
+    registry.classes = [UploadService]
+    app = RpcHttpApp(Recorder(registry))
+
+    async def check(client):
+        await client.get('/svc/test.upload/1/echo?val=1')
+        await client.get('/svc/test.upload/1/echo?val=1',
+                         headers={'Authorization': 'Bearer tenant-a'})
+    _run(app, check)
+    assert seen == ['127.0.0.1', 'Bearer tenant-a']
+
+
+def test_rpc_endpoint():
+    proto = JsonInternalProtocol()
+    app = _app(max_body_size=1024,
+               body_limits={('test.upload', 'echo'): 4096})
+
+    def _request(method, args):
+        ctx = Context(Target('test.upload', '1', method), 'g1', None, None)
+        return proto.encode(Request(ctx, args))
+
+    async def check(client):
+        headers = {'Content-Type': 'application/x-axonal-json'}
+        resp = await client.post('/rpc', data=_request('echo', ['hi']),
+                                 headers=headers)
+        assert proto.decode(await resp.read()).data == 'hi'
+        resp = await client.post('/rpc', data=_request('missing', []),
+                                 headers=headers)
+        fault = proto.decode(await resp.read())
+        assert isinstance(fault, Fault)
+        assert fault.code == Fault.METHOD_NOT_FOUND
+        resp = await client.post('/rpc', data=b'{}', headers={
+            'Content-Type': 'application/x-axonal-pickle'})
+        assert resp.status == 415
+        # Only requests and events are dispatched
+        reply = proto.encode(Response(Context(
+            Target('test.upload', '1', 'echo'), 'g1', None, None), 'hi'))
+        resp = await client.post('/rpc', data=reply, headers=headers)
+        assert resp.status == 400
+
+        # The target header's limit applies before the body is read
+        big = _request('echo', ['x' * 2000])
+        resp = await client.post('/rpc', data=big, headers=dict(
+            headers, **{TARGET_HEADER: 'test.upload/other'}))
+        assert resp.status == 413
+        resp = await client.post('/rpc', data=big, headers=dict(
+            headers, **{TARGET_HEADER: 'test.upload/echo'}))
+        assert proto.decode(await resp.read()).data == 'x' * 2000
+        resp = await client.post('/rpc', data=_request('other', []),
+                                 headers=dict(headers, **{
+                                     TARGET_HEADER: 'test.upload/echo'}))
+        assert resp.status == 400
+    _run(app, check)
+
+
+def test_rpc_malformed_body():
+    app = _app()
+
+    async def check(client):
+        headers = {'Content-Type': 'application/x-axonal-json'}
+        for body in (b'[1]', b'{}', b'{"V": "1", "_": "Q"}', b'\xff'):
+            resp = await client.post('/rpc', data=body, headers=headers)
+            assert resp.status == 400
+            assert (await resp.json())['error'][0] == 400
+    _run(app, check)
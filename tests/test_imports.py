@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time, in microseconds, allowed for the core modules
+IMPORT_BUDGET_US = 150000
+
+CORE_MODULES = ('axonal.plugin', 'axonal.proto', 'axonal.proto.internal',
+                'axonal.middleware.broker', 'axonal.middleware.proxy',
+                'axonal.server')
+
+LAZY_MODULES = ('pickle', 'msgpack', 'aiohttp', 'asyncio', 'logging.config',
+                'cProfile')
+
+
+def _run(code):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          env=env, cwd=ROOT, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    return proc.stdout, proc.stderr
+
+
+def test_import_budget():
+    code = 'import sys, %s; print(",".join(sorted(sys.modules)))' % (
+        ', '.join(CORE_MODULES),)
+    stdout, stderr = _run(code)
+    loaded = set(stdout.strip().split(','))
+    assert not loaded.intersection(LAZY_MODULES)
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            total += int(cumulative)
+    assert 0 < total < IMPORT_BUDGET_US
@@ -0,0 +1,62 @@
+import datetime
+
+import pytest
+
+from axonal.utils import get_json_engine, JSON_ENGINES
+
+UTC = datetime.timezone.utc
+PLUS_FIVE = datetime.timezone(datetime.timedelta(hours=5))
+
+
+class Point(object):
+    def to_dict(self):
+        return {'x': 1, 'y': [2, 3]}
+
+
+SAMPLES = [
+    None, True, 0, -1, 2 ** 63 - 1, 2 ** 70, 0.5, 'plain', 'caf\xe9  ',
+    [1, 'two', [3]], (4, 5), {'a': {'b': None}}, {1: 'int key'},
+    datetime.datetime(2016, 3, 4, 5, 6, 7, 890),
+    datetime.datetime(2016, 3, 4, 5, 6, 7, tzinfo=UTC),
+    datetime.datetime(2016, 3, 4, 5, 6, 7, tzinfo=PLUS_FIVE),
+    datetime.date(2016, 3, 4), datetime.time(5, 6, 7, 8),
+    Point(), {'nested': [Point(), datetime.date(2016, 3, 4)]},
+]
+
+
+def _engines():
+    engines = []
+    for name in sorted(JSON_ENGINES):
+        try:
+            engines.append(get_json_engine(name))
+        except ImportError:
+            pass
+    return engines
+
+
+@pytest.mark.parametrize('sample', SAMPLES, ids=repr)
+def test_engines_conform(sample):
+    outputs = set(engine.dumpb(sample) for engine in _engines())
+    assert len(outputs) == 1
+    output = outputs.pop()
+    assert isinstance(output, bytes)
+    for engine in _engines():
+        assert engine.dumps(sample) == output.decode('utf-8')
+
+
+def test_formats():
+    engine = get_json_engine('stdlib')
+    when = datetime.datetime(2016, 3, 4, 5, 6, 7, 890)
+    assert engine.dumpb({'when': when, 'text': '\xe9'}) == (
+        b'{"when":"2016-03-04T05:06:07Z","text":"\xc3\xa9"}')
+    with pytest.raises(TypeError):
+        engine.dumpb(object())
+
+
+def test_loads():
+    for engine in _engines():
+        for data in (b'{"a":[1,2]}', '{"a":[1,2]}',
+                     memoryview(b'{"a":[1,2]}')):
+            assert engine.loads(data) == {'a': [1, 2]}
+        with pytest.raises(ValueError):
+            engine.loads(b'{')
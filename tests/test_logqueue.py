@@ -0,0 +1,106 @@
+import logging
+import queue
+
+from axonal.logqueue import (DroppingQueueHandler, RateLimitFilter, install,
+                             install_record_factory)
+from axonal.middleware.dispatcher import ClassInstanceDispatcher
+from axonal.struct import Context, Request, Target
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class Noisy(object):
+    def shout(self, count):
+        log = logging.getLogger('test.logqueue.noisy')
+        for num in range(count):
+            log.warning('shout %d', num)
+
+
+def test_queue_guid_and_rate_limit():
+    logger = logging.getLogger('test.logqueue.noisy')
+    logger.propagate = False
+    target = ListHandler()
+    logger.addHandler(target)
+    listener = install(size=100, burst=3)
+    try:
+        dispatcher = ClassInstanceDispatcher(Noisy())
+        context = Context(Target('test.noisy', '1', 'shout'), 'guid-1',
+                          None, None)
+        dispatcher.dispatch(Request(context, [10]))
+    finally:
+        listener.stop()
+        logger.propagate = True
+    assert logger.handlers == [target]
+    assert [r.getMessage() for r in target.records] == [
+        'shout 0', 'shout 1', 'shout 2']
+    assert set(r.guid for r in target.records) == set(['guid-1'])
+
+
+def test_rate_limit_per_handler():
+    parent = logging.getLogger('test.logqueue')
+    child = logging.getLogger('test.logqueue.noisy')
+    parent_target, child_target = ListHandler(), ListHandler()
+    parent.addHandler(parent_target)
+    child.addHandler(child_target)
+    parent.propagate = False
+    listener = install(size=100, burst=3)
+    try:
+        Noisy().shout(10)
+    finally:
+        listener.stop()
+        parent.propagate = True
+        parent.removeHandler(parent_target)
+        child.removeHandler(child_target)
+    assert len(parent_target.records) == len(child_target.records) == 3
+
+
+def test_guid_without_queue():
+    install_record_factory()
+    install_record_factory()
+    record = logging.getLogger('test.logqueue.plain').makeRecord(
+        'test', logging.INFO, 'f.py', 1, 'msg', None, None)
+    assert logging.Formatter('%(guid)s %(message)s').format(record) == \
+        '- msg'
+
+
+def test_rate_limit_reports_suppressed():
+    limiter = RateLimitFilter(burst=1, interval=0)
+    record = logging.LogRecord('x', logging.INFO, 'f.py', 1, 'msg', None,
+                               None)
+    assert limiter.filter(record)
+    limiter.interval = 60
+    assert not limiter.filter(record)
+    limiter.interval = 0
+    assert limiter.filter(record)
+    assert record.getMessage() == 'msg (1 similar suppressed)'
+
+
+def _emit(handler, num):
+    handler.emit(logging.LogRecord('x', logging.INFO, 'f.py', 1, 'msg %d',
+                                   (num,), None))
+
+
+def test_full_queue_drops():
+    log_queue = queue.Queue(2)
+    handler = DroppingQueueHandler(log_queue, 'root')
+    for num in range(5):
+        _emit(handler, num)
+    assert handler.dropped == 3
+    assert [log_queue.get_nowait().msg for _ in range(2)] == [
+        'msg 0', 'msg 1']
+    _emit(handler, 5)
+    assert log_queue.get_nowait().msg == 'msg 5 (3 records dropped)'
+
+    handler = DroppingQueueHandler(log_queue, 'root', 'old')
+    for num in range(5):
+        _emit(handler, num)
+    assert handler.dropped == 3
+    assert log_queue.get_nowait().msg.startswith('msg 3 ')
+    assert log_queue.get_nowait().msg.startswith('msg 4 ')
@@ -0,0 +1,34 @@
+import asyncio
+import socket
+
+import aiohttp
+from aiohttp import web
+
+from axonal.server.httpd import _NoDelayOff
+
+
+def test_no_nodelay_clears_option():
+    async def main():
+        runner = web.AppRunner(web.Application())
+        await runner.setup()
+        protocols = []
+
+        def factory():
+            protocols.append(_NoDelayOff(runner.server()))
+            return protocols[-1]
+        loop = asyncio.get_running_loop()
+        srv = await loop.create_server(factory, '127.0.0.1', 0)
+        port = srv.sockets[0].getsockname()[1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                url = 'http://127.0.0.1:%d/' % (port,)
+                async with session.get(url) as resp:
+                    assert resp.status == 404
+                    sock = protocols[0].transport.get_extra_info('socket')
+                    assert sock.getsockopt(socket.IPPROTO_TCP,
+                                           socket.TCP_NODELAY) == 0
+        finally:
+            srv.close()
+            await srv.wait_closed()
+            await runner.cleanup()
+    asyncio.run(main())
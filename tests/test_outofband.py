@@ -0,0 +1,36 @@
+import pytest
+
+from axonal.proto.internal import (MsgpackInternalProtocol,
+                                   PickleInternalProtocol, Segments)
+from axonal.struct import Context, Request, Response, Target
+
+
+def _request(args):
+    return Request(Context(Target('test.blob', '1', 'put'), 'x', None, None),
+                   args)
+
+
+@pytest.mark.parametrize('proto', [
+    PickleInternalProtocol(out_of_band=True, oob_threshold=1024),
+    MsgpackInternalProtocol(out_of_band=True, oob_threshold=1024),
+])
+def test_out_of_band_roundtrip(proto):
+    blob = b'\x01' * (1024 * 1024)
+    data = proto.encode(_request(['name', {'blob': blob, 'small': b'ab'}]))
+    assert isinstance(data, Segments)
+    assert len(data) == 2
+    assert len(data[0]) < 1024
+    request = proto.decode(data)
+    received = request.args[1]['blob']
+    assert isinstance(received, memoryview)
+    assert received.obj is blob
+    assert bytes(request.args[1]['small']) == b'ab'
+
+    packed = data.pack()
+    request = proto.decode(packed)
+    assert request.args[1]['blob'] == blob
+    assert request.args[1]['blob'].obj is packed
+
+    small = proto.encode(Response(request.context, b'tiny'))
+    assert not isinstance(small, Segments)
+    assert proto.decode(small).data == b'tiny'
@@ -0,0 +1,57 @@
+import os
+import signal
+import sys
+import threading
+
+import pytest
+
+from axonal.profiler import SignalProfiler
+from axonal.registry import Registry
+
+
+class HotService(object):
+    _service_name = 'test.hot'
+    _service_versions = ['1']
+
+    def spin(self, count):
+        return sum(range(count))
+
+
+def test_signal_profiler(tmp_path):
+    registry = Registry()
+    registry.classes = [HotService]
+    profiler = SignalProfiler(str(tmp_path), registry)
+    old_handlers = (signal.getsignal(signal.SIGUSR1),
+                    signal.getsignal(signal.SIGUSR2))
+    try:
+        profiler.install()
+        assert not profiler.active
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert profiler.active
+        HotService().spin(1000)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        assert not profiler.active
+        os.kill(os.getpid(), signal.SIGUSR2)
+    finally:
+        signal.signal(signal.SIGUSR1, old_handlers[0])
+        signal.signal(signal.SIGUSR2, old_handlers[1])
+    pid = os.getpid()
+    assert (tmp_path / ('axonal-%d.prof' % (pid,))).exists()
+    summary = (tmp_path / ('axonal-%d.txt' % (pid,))).read_text()
+    assert summary.startswith('test.hot\n  spin ')
+
+
+@pytest.mark.skipif(sys.version_info < (3, 12),
+                    reason='cProfile only sees every thread from 3.12')
+def test_profiles_worker_threads(tmp_path):
+    registry = Registry()
+    registry.classes = [HotService]
+    profiler = SignalProfiler(str(tmp_path), registry)
+    profiler.start()
+    worker = threading.Thread(target=HotService().spin, args=(1000,))
+    worker.start()
+    worker.join()
+    profiler.stop()
+    profiler.dump()
+    summary = (tmp_path / ('axonal-%d.txt' % (os.getpid(),))).read_text()
+    assert summary.startswith('test.hot\n  spin ')
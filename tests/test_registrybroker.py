@@ -0,0 +1,103 @@
+import threading
+
+import pytest
+
+from axonal.middleware.broker import RegistryBroker
+from axonal.registry import Registry
+from axonal.struct import Context, Fault, Request, Target
+
+
+class CountedService(object):
+    _service_name = 'test.counted'
+    _service_versions = ['1.2']
+    created = 0
+
+    def __init__(self):
+        CountedService.created += 1
+
+    def ident(self):
+        return id(self)
+
+    def count(self):
+        for num in range(2):
+            yield id(self), num
+
+
+def _registry():
+    registry = Registry()
+    registry.services = {'test.counted': {'1.2.X': CountedService,
+                                          '1.X.X': CountedService}}
+    registry.classes = [CountedService]
+    return registry
+
+
+def _request(version, method='ident'):
+    ctx = Context(Target('test.counted', version, method), 'x', None, None)
+    return Request(ctx, [])
+
+
+def test_registry_broker_lifecycle():
+    CountedService.created = 0
+    broker = RegistryBroker(_registry(), eager=True)
+    assert CountedService.created == 1
+    first = broker.dispatch(_request('1')).data
+    assert broker.dispatch(_request('1.2')).data == first
+    assert CountedService.created == 1
+    assert broker.instances[CountedService] == {('test.counted', '1'),
+                                                ('test.counted', '1.2')}
+    broker.idle_timeout = 10
+    broker.evict_idle(now=float('inf'))
+    assert not broker.services
+    broker.dispatch(_request('1'))
+    assert CountedService.created == 2
+
+
+def test_registry_broker_pool():
+    CountedService.created = 0
+    broker = RegistryBroker(_registry(), pool_size=2)
+    barrier = threading.Barrier(4)
+    seen = set()
+
+    def _worker():
+        barrier.wait()
+        for _ in range(50):
+            seen.add(broker.dispatch(_request('1')).data)
+    threads = [threading.Thread(target=_worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert CountedService.created <= 2
+    assert len(seen) == CountedService.created
+
+
+def test_registry_broker_pool_streams():
+    CountedService.created = 0
+    broker = RegistryBroker(_registry(), pool_size=2)
+    first = iter(broker.dispatch(_request('1', 'count')))
+    second = iter(broker.dispatch(_request('1', 'count')))
+    # Both streams are open, each holds its own instance
+    assert next(first)[0] != next(second)[0]
+    assert CountedService.created == 2
+    pool = broker.services[('test.counted', '1')]._pool
+    assert pool.qsize() == 0
+    list(first)
+    second.close()
+    assert pool.qsize() == 2
+    # Streams dropped without being read return their instance too
+    for _ in range(3):
+        broker.dispatch(_request('1', 'count'))
+    assert pool.qsize() == 2
+    assert CountedService.created == 2
+
+
+def test_registry_broker_pool_timeout():
+    broker = RegistryBroker(_registry(), pool_size=1, pool_timeout=0.01)
+    held = iter(broker.dispatch(_request('1', 'count')))
+    next(held)
+    # The only instance is busy with the open stream
+    with pytest.raises(Fault) as excinfo:
+        broker.dispatch(_request('1'))
+    assert excinfo.value.code == Fault.INTERNAL_ERROR
+    held.close()
+    broker.dispatch(_request('1'))
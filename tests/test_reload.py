@@ -0,0 +1,121 @@
+import asyncio
+import os
+import sys
+import textwrap
+from unittest import mock
+
+from aiohttp.test_utils import TestClient, TestServer, make_mocked_request
+
+from axonal.middleware.broker import RegistryBroker
+from axonal.registry import GlobalRegistry, Registry
+from axonal.reload import Reloader
+from axonal.server.httpd import ADMIN_TOKEN_HEADER, RpcHttpApp
+from axonal.struct import Context, Request, Target
+
+SOURCE = '''
+from axonal.registry import register
+
+@register('test.reloaded', '1')
+class ReloadedService(object):
+    def answer(self):
+        return %r
+'''
+
+
+def _write(path, answer, mtime):
+    with open(path, 'w') as handle:
+        handle.write(textwrap.dedent(SOURCE % (answer,)))
+    os.utime(path, (mtime, mtime))
+
+
+def _answer(broker):
+    ctx = Context(Target('test.reloaded', '1', 'answer'), 'x', None, None)
+    return broker.dispatch(Request(ctx, [])).data
+
+
+def test_reload_swaps_class(tmpdir):
+    path = str(tmpdir.join('reloaded_service.py'))
+    _write(path, 'old', 1000000000)
+    sys.path.insert(0, str(tmpdir))
+    registry = GlobalRegistry()
+    try:
+        import reloaded_service
+        old_cls = reloaded_service.ReloadedService
+        broker = RegistryBroker(registry)
+        assert _answer(broker) == 'old'
+        old_dispatcher = broker.services[('test.reloaded', '1')]
+
+        reloader = Reloader(lock_path=str(tmpdir.join('reload.lock')))
+        assert reloader.reload() == []
+        _write(path, 'new', 1000000010)
+        assert reloader.reload() == ['reloaded_service']
+
+        new_cls = sys.modules['reloaded_service'].ReloadedService
+        assert new_cls is not old_cls
+        assert old_cls not in registry.classes
+        assert registry.lookup('test.reloaded', '1') is new_cls
+        assert _answer(broker) == 'new'
+        # A call holding the old instance still completes there
+        assert old_dispatcher.dispatch(Request(Context(
+            Target('test.reloaded', '1', 'answer'), 'y', None, None),
+            [])).data == 'old'
+    finally:
+        sys.path.remove(str(tmpdir))
+        sys.modules.pop('reloaded_service', None)
+        for cls in list(registry.classes):
+            if cls.__module__ == 'reloaded_service':
+                registry.remove(cls)
+
+
+def test_reload_own_registry(tmpdir):
+    path = str(tmpdir.join('reloaded_service.py'))
+    _write(path, 'old', 1000000000)
+    sys.path.insert(0, str(tmpdir))
+    registry = Registry()
+    changes = []
+
+    class Listener(object):
+        def changed(self, old_cls, new_cls):
+            changes.append((old_cls, new_cls))
+    listener = Listener()
+    try:
+        import reloaded_service
+        old_cls = reloaded_service.ReloadedService
+        registry.add_listener(listener.changed)
+        _write(path, 'new', 1000000010)
+        reloader = Reloader(registry, str(tmpdir.join('reload.lock')))
+        assert reloader.reload(['reloaded_service']) == [
+            'reloaded_service']
+        new_cls = sys.modules['reloaded_service'].ReloadedService
+        # Swapped in through the registry being reloaded, not added anew
+        assert changes == [(old_cls, new_cls)]
+        assert registry.lookup('test.reloaded', '1') is new_cls
+    finally:
+        sys.path.remove(str(tmpdir))
+        sys.modules.pop('reloaded_service', None)
+        for cls in list(registry.classes):
+            if cls.__module__ == 'reloaded_service':
+                registry.remove(cls)
+
+
+def test_admin_reload_restricted():
+    reloader = Reloader(Registry())
+
+    async def main(token, headers, status):
+        app = RpcHttpApp(None, reloader=reloader, admin_token=token)
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.post('/admin/reload', headers=headers)
+            assert resp.status == status
+            if status == 200:
+                assert await resp.json() == {'reloaded': []}
+
+    asyncio.run(main(None, {}, 200))
+    transport = mock.Mock()
+    transport.get_extra_info.return_value = ('10.1.2.3', 4567)
+    remote = make_mocked_request('POST', '/admin/reload',
+                                 transport=transport)
+    assert not RpcHttpApp(None, reloader=reloader)._admin_allowed(remote)
+
+    asyncio.run(main('s3cret', {}, 401))
+    asyncio.run(main('s3cret', {ADMIN_TOKEN_HEADER: 'wrong'}, 401))
+    asyncio.run(main('s3cret', {ADMIN_TOKEN_HEADER: 's3cret'}, 200))
@@ -0,0 +1,114 @@
+import pytest
+
+from axonal.interface import Dispatcher
+from axonal.middleware.balance import LeastOutstandingPolicy
+from axonal.middleware.breaker import CircuitBreakerDispatcher
+from axonal.middleware.broker import Router
+from axonal.struct import (Context, Fault, Request, Response, Target,
+                           TransportFault)
+
+
+class CountingDispatcher(Dispatcher):
+    def __init__(self, service, fail=False, fault=TransportFault):
+        self.service = service
+        self.fail = fail
+        self.fault = fault
+        self.probes = 0
+        self.calls = 0
+
+    def can_dispatch(self, request):
+        self.probes += 1
+        return request.context.target.service == self.service
+
+    def dispatch(self, request):
+        self.calls += 1
+        if request.context.target.service != self.service:
+            raise Fault(request.context, Fault.SERVICE_UNKNOWN)
+        if self.fail:
+            raise self.fault(request.context, Fault.INTERNAL_ERROR)
+        return Response(request.context, self.service)
+
+
+def _request(service):
+    return Request(Context(Target(service, '1', 'echo'), 'x', None, None), [])
+
+
+def test_router_balances_replicas():
+    replicas = [CountingDispatcher('svc.a') for _ in range(3)]
+    other = CountingDispatcher('svc.b')
+    router = Router(replicas + [other])
+    for _ in range(300):
+        assert router.dispatch(_request('svc.a')).data == 'svc.a'
+    assert [replica.calls for replica in replicas] == [100, 100, 100]
+    assert all(replica.probes == 1 for replica in replicas + [other])
+    assert other.calls == 0
+
+
+def test_router_evicts_failing_backend():
+    bad = CountingDispatcher('svc.a', fail=True)
+    good = CountingDispatcher('svc.a')
+    router = Router([bad, good], LeastOutstandingPolicy(), max_failures=2)
+    for _ in range(2):
+        with pytest.raises(Fault):
+            router.dispatch(_request('svc.a'))
+    for _ in range(5):
+        router.dispatch(_request('svc.a'))
+    assert bad.calls == 2
+    assert good.calls == 5
+    with pytest.raises(Fault) as excinfo:
+        router.dispatch(_request('svc.c'))
+    assert excinfo.value.code == Fault.SERVICE_UNKNOWN
+
+
+def test_router_ignores_application_faults():
+    only = CountingDispatcher('svc.a', fail=True, fault=Fault)
+    other = CountingDispatcher('svc.b')
+    router = Router([only, other], max_failures=2)
+    for _ in range(5):
+        with pytest.raises(Fault):
+            router.dispatch(_request('svc.a'))
+    assert only.calls == 5
+    assert router.dispatch(_request('svc.b')).data == 'svc.b'
+
+    # Nor is the last backend able to serve a key evicted
+    only.fault = TransportFault
+    for _ in range(5):
+        with pytest.raises(TransportFault):
+            router.dispatch(_request('svc.a'))
+    assert only.calls == 10
+
+
+def test_router_forgets_moved_services():
+    moved = CountingDispatcher('svc.a')
+    router = Router([moved, CountingDispatcher('svc.b')])
+    router.dispatch(_request('svc.a'))
+    moved.service = 'svc.c'
+    for _ in range(2):
+        with pytest.raises(Fault) as excinfo:
+            router.dispatch(_request('svc.a'))
+        assert excinfo.value.code == Fault.SERVICE_UNKNOWN
+    # The stale entry was dropped rather than counted as a failure
+    assert moved.calls == 2
+    assert moved.probes == 2
+    assert router._backends[0].failures == 0
+
+
+def test_router_skips_open_circuits():
+    bad = CountingDispatcher('svc.a', fail=True, fault=Fault)
+    good = CountingDispatcher('svc.a')
+    tripped = CircuitBreakerDispatcher(bad, 'bad', min_calls=1,
+                                       open_seconds=60)
+    with pytest.raises(Fault):
+        tripped.dispatch(_request('svc.a'))
+    router = Router([tripped, good], max_failures=1)
+    for _ in range(4):
+        assert router.dispatch(_request('svc.a')).data == 'svc.a'
+    assert bad.calls == 1
+    assert good.calls == 4
+    assert all(backend.failures == 0 for backend in router._backends)
+
+    # With no other candidate the open circuit is reported
+    router = Router([tripped])
+    with pytest.raises(Fault) as excinfo:
+        router.dispatch(_request('svc.a'))
+    assert excinfo.value.code == Fault.CIRCUIT_OPEN
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+from axonal.interface import Dispatcher
+from axonal.middleware.scheduler import SchedulingDispatcher
+from axonal.struct import Context, Fault, Request, Response, Target
+
+
+class GatedDispatcher(Dispatcher):
+    def __init__(self):
+        self.gate = threading.Event()
+        self.order = []
+
+    def can_dispatch(self, request):
+        return True
+
+    def dispatch(self, request):
+        self.gate.wait()
+        self.order.append(request.context.guid)
+        return Response(request.context, request.context.guid)
+
+
+def _request(guid, tenant, priority=None):
+    meta = {'priority': priority} if priority else None
+    return Request(Context(Target('test.sched', '1', 'run'), guid, tenant,
+                           meta), [])
+
+
+def test_priority_and_fair_share():
+    inner = GatedDispatcher()
+    sched = SchedulingDispatcher(inner, workers=1, max_wait=60)
+    blocker = sched.submit(_request('blocker', 'x'))
+    while not blocker.running():
+        time.sleep(0.001)
+    futures = [sched.submit(_request('noisy%d' % (num,), 'noisy', 'batch'))
+               for num in range(4)]
+    futures += [sched.submit(_request('quiet%d' % (num,), 'quiet', 'batch'))
+                for num in range(2)]
+    futures.append(sched.submit(_request('click', 'user', 'interactive')))
+    inner.gate.set()
+    assert blocker.result(5).data == 'blocker'
+    for future in futures:
+        future.result(5)
+    assert inner.order == ['blocker', 'click', 'noisy0', 'quiet0', 'noisy1',
+                           'quiet1', 'noisy2', 'noisy3']
+    sched.close()
+
+
+def test_rate_limit():
+    inner = GatedDispatcher()
+    inner.gate.set()
+    sched = SchedulingDispatcher(inner, workers=2,
+                                 rate_limits={'greedy': (0.001, 2)})
+    for num in range(2):
+        assert sched.dispatch(_request(str(num), 'greedy')).data == str(num)
+    with pytest.raises(Fault) as excinfo:
+        sched.dispatch(_request('3', 'greedy'))
+    assert excinfo.value.code == Fault.RATE_LIMITED
+    assert sched.dispatch(_request('4', 'other')).data == '4'
+    sched.close()
+
+
+def test_close_fails_pending():
+    inner = GatedDispatcher()
+    sched = SchedulingDispatcher(inner, workers=1)
+    blocker = sched.submit(_request('blocker', 'x'))
+    while not blocker.running():
+        time.sleep(0.001)
+    pending = [sched.submit(_request(str(num), 'x')) for num in range(3)]
+    closer = threading.Thread(target=sched.close)
+    closer.start()
+    for future in pending:
+        with pytest.raises(Fault) as excinfo:
+            future.result(5)
+        assert excinfo.value.code == Fault.INTERNAL_ERROR
+    inner.gate.set()
+    closer.join()
+    assert blocker.result(5).data == 'blocker'
+    with pytest.raises(Fault):
+        sched.submit(_request('late', 'x'))
+
+
+def test_stale_entries_compacted():
+    inner = GatedDispatcher()
+    inner.gate.set()
+    # Every request is taken from the FIFO, leaving its heap entry stale
+    sched = SchedulingDispatcher(inner, workers=1, max_wait=0)
+    for num in range(500):
+        sched.dispatch(_request(str(num), 'x', 'batch'))
+    assert sum(len(heap) for heap in sched._heaps) <= 65
+    sched.close()
@@ -0,0 +1,48 @@
+import pytest
+
+from axonal.middleware.broker import Router, RegistryBroker
+from axonal.middleware.dispatcher import (ProtocolTransportDispatcher,
+                                          ProtocolDispatcherTransport)
+from axonal.middleware.proxy import ServiceProxy
+from axonal.proto.internal import JsonInternalProtocol
+from axonal.registry import GlobalRegistry, register
+from axonal.struct import Fault
+
+PRODUCED = []
+
+
+@register('test.stream', '1')
+class StreamService(object):
+    def count(self, total):
+        for num in range(int(total)):
+            PRODUCED.append(num)
+            yield {'n': num}
+
+    def broken(self):
+        yield 1
+        raise RuntimeError('Broken stream')
+
+
+def _proxy():
+    json_proto = JsonInternalProtocol()
+    transport = ProtocolDispatcherTransport(
+        json_proto, RegistryBroker(GlobalRegistry()))
+    router = Router([ProtocolTransportDispatcher(json_proto, transport)])
+    return ServiceProxy(router, 'test.stream', '1')
+
+
+def test_stream_over_protocol():
+    del PRODUCED[:]
+    items = _proxy().count.stream(1000000)
+    assert next(items) == {'n': 0}
+    assert next(items) == {'n': 1}
+    assert len(PRODUCED) == 2
+    items.close()
+
+
+def test_stream_fault():
+    items = _proxy().broken.stream()
+    assert next(items) == 1
+    with pytest.raises(Fault) as excinfo:
+        next(items)
+    assert excinfo.value.message == 'Broken stream'
@@ -0,0 +1,28 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from axonal.server.websocket import WebSocketHub
+
+
+def _run(check):
+    async def _main():
+        app = web.Application()
+        app.router.add_get('/ws', WebSocketHub(None).handle)
+        async with TestClient(TestServer(app)) as client:
+            await check(client)
+    asyncio.run(_main())
+
+
+def test_untrusted_protocols_refused():
+    async def check(client):
+        ws = await client.ws_connect('/ws?proto=msgpack')
+        await ws.close()
+        for name in ('pickle', 'nonsense'):
+            with pytest.raises(aiohttp.WSServerHandshakeError) as excinfo:
+                await client.ws_connect('/ws?proto=' + name)
+            assert excinfo.value.status == 400
+    _run(check)